@@ -8,6 +8,7 @@ import pandas as pd
 from mongoengine import *
 
 from models import *
+from models.dbs.tick_mongo import get_dyn_ticks_doc, bulk_insert_ticks
 
 # 设置logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s: %(name)s: %(levelname)s: %(message)s',
@@ -21,21 +22,11 @@ connect(host=URI_ticks,  alias='ticks')
 # connect(host=URI_kline,  alias='kline')
 
 
-def load_df(tmpPath):
-    pd_data = pd.read_csv(tmpPath, names=[
-                        'InstrumentID', 'MarketID', 'LastPrice', 'LastVolume', 'hhmmss', 'Reserved', 'UpdateTime', 'AskPrice1',
-                        'AskVolume1', 'BidPrice1', 'BidVolume1', 'AskPrice2', 'AskVolume2', 'BidPrice2', 'BidVolume2',
-                        'AskPrice3', 'AskVolume3', 'BidPrice3', 'BidVolume3', 'AskPrice4', 'AskVolume4', 'BidPrice4', 'BidVolume4',
-                        'AskPrice5', 'AskVolume5', 'BidPrice5', 'BidVolume5', 'OpenInterest', 'Turnover', 'AvePrice', 'invol', 'outvol',
-                        'Attr1', 'Volume1', 'Attr2', 'Volume2', 'HighestPrice', 'LowestPrice', 'SettlePrice', 'OpenPrice', 'fill'
-                    ], low_memory=False, parse_dates=['UpdateTime'], dtype={'hhmmss': str})
-    pd_data.drop([
-                    'Reserved', 'AskPrice2', 'AskVolume2', 'BidPrice2', 'BidVolume2',
-                    'AskPrice3', 'AskVolume3', 'BidPrice3', 'BidVolume3', 'AskPrice4', 'AskVolume4', 'BidPrice4', 'BidVolume4',
-                    'AskPrice5', 'AskVolume5', 'BidPrice5', 'BidVolume5', 'invol', 'outvol',
-                    'Attr1', 'Volume1', 'Attr2', 'Volume2', 'SettlePrice', 'fill'], axis=1, inplace=True)
-
-    pd_data['subID'] = pd_data.InstrumentID.str[-4:]
+# subID: 子代码，同一个目录下的文件都相同，不用逐行计算
+# 这里的文件是41列的格式(没有`mainID`)
+def load_df(tmpPath, subID):
+    pd_data = read_raw_csv(tmpPath, get_raw_columns(4, subID), names=RAW_CSV_COLUMNS_NO_MAIN)
+    pd_data['subID'] = subID
 
     # pd_data = pd_data.drop_duplicates(['hhmmss'], keep='last')
     # pd_data_market = pd_data.reset_index(drop=True)
@@ -88,7 +79,7 @@ if __name__ == "__main__":
                 spt_cnt += 1
                 print_cnt += 1
                 try:
-                    pd_data = load_df(_file)
+                    pd_data = load_df(_file, subdir.stem[-4:])
                 except Exception:
                     if dbg:
                         logger.error(f'{_file}', exc_info=0)
@@ -97,12 +88,11 @@ if __name__ == "__main__":
                         continue
 
                 if not dbg:
-                    for i in range(pd_data.shape[0]):
-                        try:
-                            d_doc(**pd_data.iloc[i]).save()
-                        except Exception:
-                            logger.error(f'[{year}] Exception: {_file}: Line={cnt}. {pd_data.iloc[i]}')
-                            continue
+                    try:
+                        bulk_insert_ticks(d_doc, pd_data, file_key=_file.relative_to(base_dir))
+                    except Exception:
+                        logger.error(f'[{year}] Exception: {_file}: Line={cnt}.', exc_info=1)
+                        continue
 
                     exec_time = time.time() - st
                     if print_cnt >= 20 or exec_time > 80:
@@ -1,21 +1,35 @@
 import logging
+import datetime
 import numpy as np
 import pandas as pd
 from pandas.tseries.offsets import *
 from tqdm import tqdm_notebook as tqdm
 
-from ..dbs.tick_file_doc import *
+from ..dbs.tick_mongo import *
+from ..dbs.conf import KLINE_STORE_BATCH_ROWS
+from ..dbs.kline_store import kline_store
+from ..dbs.sessions import calc_session_bins, calc_trading_day_start
 from .apis import *
+from .apis import chunks_from_array
+from .kline_bars import *
+from .parallel_process import parallel_process_grps
 
-__all__ = ('load_ticks_by_id', 'gen_kline_from_pd', 'save_kline_by_id', 'save_1day_kline_by_id', 'calc_kline_by_id', 'load_kline_to_df', 'load_1day_kline_to_df', )
+__all__ = ('KLINE_LEVELS', 'load_ticks_by_id', 'gen_kline_from_pd', 'gen_klines_from_pd', 'save_kline_by_id', 'save_1day_kline_by_id', 'calc_kline_by_id', 'update_kline_by_id', 'load_kline_to_df', 'load_1day_kline_to_df', )
 
 logger = logging.getLogger(__name__)
 
+KLINE_LEVELS = ['1min', *KLINE_BINS_LIST]       # `KlineDoc`中保存的粒度，日K单独保存在`StatisDayDoc`中
 
-def load_ticks_by_id(_id):
+
+# 加载合约的ticks
+#   - start: 只加载`UpdateTime`不早于start的ticks，用于增量更新
+def load_ticks_by_id(_id, start=None):
     d_doc = get_dyn_ticks_doc(_id[:2])
 
-    trads = d_doc.objects(InstrumentID=_id).only('LastPrice', 'LastVolume', 'UpdateTime', 'OpenInterest', 'Turnover', 'AvePrice', 'HighestPrice', 'LowestPrice', 'OpenPrice')
+    q_f = dict(InstrumentID=_id)
+    if start is not None:
+        q_f['UpdateTime__gte'] = pd.Timestamp(start).to_pydatetime()
+    trads = d_doc.objects(**q_f).only('LastPrice', 'LastVolume', 'UpdateTime', 'OpenInterest', 'Turnover', 'AvePrice', 'HighestPrice', 'LowestPrice', 'OpenPrice')
     total = trads.count()
     if total < 2:
         logger.warn(f'{_id} has less than 2 items, Ignore.')
@@ -82,47 +96,29 @@ def load_ticks_by_id(_id):
 
 # 生成kline df
 def gen_kline_from_pd(_id, df, level, MarketID=4, dbg=False):
-    if df.empty:
-        logger.warn(f'[{level}-{_id}]: Get empty df.')
-        return pd.DataFrame()
-
-    # 生成日K
-    kline_df = df.LastPrice.resample(level).ohlc()
-
-    # kline_df.columns = ['OpenPrice', 'HighestPrice', 'LowestPrice', ]
-    kline_df['InstrumentID'] = _id
-    kline_df['category'] = _id[:2]
-    # kline_df['subID'] = _id[2:]
-    kline_df['MarketID'] = MarketID
-    kline_df['level'] = level
-
-    kline_df['TotalVolume'] = df.LastVolume.resample(level).sum()
-    kline_df['volume_std'] = df.LastVolume.resample(level).std()
-    kline_df.volume_std.fillna(1.0, inplace=True)
+    return gen_klines_from_pd(_id, df, [level], MarketID=MarketID)[level]
 
-    kline_df['OpenPrice'] = df.OpenPrice.resample(level).first()
-    kline_df['HighestPrice'] = df.HighestPrice.resample(level).last()
-    kline_df['LowestPrice'] = df.LowestPrice.resample(level).last()
-    kline_df['AvePrice'] = df.AvePrice.resample(level).last()
-    kline_df['OpenInterest'] = df.OpenInterest.resample(level).last()
-    kline_df['Turnover'] = df.Turnover.resample(level).last()
-    kline_df['Turnover_new'] = (df.LastPrice * df.LastVolume * 10).resample(level).sum()
 
-    kline_df['tick_num'] = df.Turnover.resample(level).count()
-
-    # 处理
-    dst_0_idx = kline_df[dst] == 0
-    for dst, src in [('HighestPrice', 'high'), ('LowestPrice', 'low'), ('OpenPrice', 'open')]:
-        kline_df.loc[dst_0_idx, dst] = kline_df.loc[dst_0_idx, src]
-
-    kline_df.reset_index(inplace=True)
-    kline_df.dropna(inplace=True)
+# 一次生成多个粒度的kline df，返回{level: kline_df}。
+# ticks只聚合一次，生成1分钟的基础K线，其它粒度(包括日K)都由基础K线聚合得到，见`kline_bars.py`。
+def gen_klines_from_pd(_id, df, levels, MarketID=4):
+    if df.empty:
+        logger.warn(f'[{levels}-{_id}]: Get empty df.')
+        return {level: pd.DataFrame() for level in levels}
 
-    return kline_df
+    with Dbg_Timer(f'base_bars-{_id}', 10):
+        bars = calc_base_bars(df)
+    return gen_klines_from_bars(_id, bars, levels, MarketID=MarketID)
 
 
 # bulk save
+# 启用了`kline_store`时写入列式存储，否则写入`KlineDoc`
 def save_kline_by_id(_id, kline_df, level):
+    if kline_store.enabled:
+        if kline_df.empty:      # 同`KlineDoc`，删除之前的数据
+            return kline_store.delete(_id[:2], level, [_id])
+        return kline_store.save(kline_df)
+
     # 删除之前的数据
     cnt = KlineDoc.objects(InstrumentID=_id, level=level).delete()
     if cnt:
@@ -133,24 +129,17 @@ def save_kline_by_id(_id, kline_df, level):
         return pd.DataFrame()
 
     # save
-    cnt = 0
-    day_ks = []
     with Dbg_Timer(f'save_kline-{level}-{_id}', 15):
-        for i in range(kline_df.shape[0]):
-            cnt += 1
-            day_ks.append(KlineDoc(**kline_df.iloc[i].to_dict()))
-            if cnt > 1000:
-                if day_ks:
-                    KlineDoc.objects.insert(day_ks, load_bulk=False)
-                cnt = 0
-                day_ks = []
-        if day_ks:
-            KlineDoc.objects.insert(day_ks, load_bulk=False)
+        bulk_write_klines(KlineDoc, kline_df)
 
 
 # bulk save 日K
 def save_1day_kline_by_id(_id, kline_df):
     level = '1d'
+    if kline_store.enabled:
+        if kline_df.empty:      # 同`KlineDoc`，删除之前的数据
+            return kline_store.delete(_id[:2], level, [_id])
+        return kline_store.save(kline_df)
 
     # 删除之前的数据
     cnt = StatisDayDoc.objects(InstrumentID=_id).delete()
@@ -164,88 +153,193 @@ def save_1day_kline_by_id(_id, kline_df):
     kline_df = kline_df.drop('level', axis=1)
 
     # save
-    cnt = 0
-    day_ks = []
     with Dbg_Timer(f'save_kline-{level}-{_id}', 15):
-        for i in range(kline_df.shape[0]):
-            cnt += 1
-            day_ks.append(StatisDayDoc(**kline_df.iloc[i].to_dict()))
-            if cnt > 1000:
-                if day_ks:
-                    StatisDayDoc.objects.insert(day_ks, load_bulk=False)
-                cnt = 0
-                day_ks = []
-        if day_ks:
-            StatisDayDoc.objects.insert(day_ks, load_bulk=False)
+        bulk_write_klines(StatisDayDoc, kline_df)
 
 
 def calc_kline_by_id(_ids):
-    for _id in _ids:
-        df = load_ticks_by_id(_id)
-        for level in ['1min', '3min', '5min', '15min', '30min', '1H']:
-            kline_df = gen_kline_from_pd(_id, df, level, MarketID=4)
-            save_kline_by_id(_id, kline_df, level)
-
-        kline_df = gen_kline_from_pd(_id, df, '1d', MarketID=4)
-        save_1day_kline_by_id(_id, kline_df)
+    with _KlineStoreBatch() as batch:
+        for _id in _ids:
+            _calc_kline(_id, batch)
+
+
+# 全量计算一个合约的K线。启用了`kline_store`时加入batch，和同一批的其它合约一起写入。
+def _calc_kline(_id, batch):
+    df = load_ticks_by_id(_id)
+    klines = gen_klines_from_pd(_id, df, [*KLINE_LEVELS, '1d'], MarketID=4)
+    if kline_store.enabled:
+        batch.add(_id, klines)
+        return
+    for level in KLINE_LEVELS:
+        save_kline_by_id(_id, klines[level], level)
+    save_1day_kline_by_id(_id, klines['1d'])
+    _save_kline_progress(_id, _last_bars(klines))
+
+
+# 一批合约的K线合并之后再写入`kline_store`，每个分区只读写一次，见`KlineStore.save()`。
+# 缓存超过`max_rows`行时先写入一次，限制内存；`KlineProgressDoc`在K线写入之后才更新。
+# 全量计算时某个粒度没有K线的合约，删除以前的K线，和写入`KlineDoc`时一致。
+# `with`块中出现异常时，已经加入的合约先写入再抛出异常。
+class _KlineStoreBatch():
+    def __init__(self, max_rows=KLINE_STORE_BATCH_ROWS):
+        self.max_rows = max_rows
+        self._frames = {}       # (level, incremental) -> [kline_df]
+        self._ids = {}          # (level, incremental) -> {_id}
+        self._progress = {}     # _id -> {level: last_bar}
+        self._rows = 0
+
+    # incremental: 见`KlineStore.save()`
+    def add(self, _id, klines, incremental=False):
+        for level, kline_df in klines.items():
+            self._ids.setdefault((level, incremental), set()).add(_id)
+            if kline_df.empty:
+                continue
+            self._frames.setdefault((level, incremental), []).append(kline_df)
+            self._rows += kline_df.shape[0]
+        self._progress.setdefault(_id, {}).update(_last_bars(klines))
+        if self._rows >= self.max_rows:
+            self.flush()
+
+    def flush(self):
+        frames, ids, progress = self._frames, self._ids, self._progress
+        self._frames, self._ids, self._progress, self._rows = {}, {}, {}, 0
+        for (level, incremental), _ids in ids.items():
+            _frames = frames.get((level, incremental), [])
+            if _frames:
+                with Dbg_Timer(f'save_kline-{level}-{len(_frames)}', 15):
+                    kline_df = pd.concat(_frames, ignore_index=True)
+                    kline_store.save(kline_df, incremental=incremental)
+                _ids = _ids - set(kline_df['InstrumentID'].unique())
+            if incremental:
+                continue
+            for category in sorted({_id[:2] for _id in _ids}):
+                kline_store.delete(category, level, [_id for _id in _ids if _id[:2] == category])
+        for _id, last_bars in progress.items():
+            _save_kline_progress(_id, last_bars)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+            return
+        try:
+            self.flush()
+        except Exception:
+            logger.error('Save klines of finished instruments fail.', exc_info=1)
+
+
+# 增量计算K线：只加载新入库的交易日的ticks，重新计算这些交易日的K线并upsert。
+# 每个(合约, 粒度)的进度见`KlineProgressDoc`，最后一根K线可能不完整(交易日还没结束时入库)，
+# 所以从它所在的交易日开始加载ticks，`TradingTime`不早于它的K线都重新计算、覆盖。
+# 没有进度的合约(以前没有计算过，或者是用旧版本计算的)用`calc_kline_by_id()`全量计算。
+def update_kline_by_id(_ids):
+    levels = [*KLINE_LEVELS, '1d']
+    progresses = {}
+    for doc in KlineProgressDoc.objects(InstrumentID__in=list(_ids)).only('InstrumentID', 'level', 'last_bar').as_pymongo():
+        progresses.setdefault(doc['InstrumentID'], {})[doc['level']] = doc.get('last_bar')
+
+    with _KlineStoreBatch() as batch:
+        for _id in _ids:
+            progress = progresses.get(_id, {})
+            if any(progress.get(level) is None for level in levels):
+                logger.info(f'{_id}: no kline progress, calc all klines.')
+                _calc_kline(_id, batch)
+                continue
+
+            day = min(_kline_trading_day(progress[level], level) for level in levels)
+            df = load_ticks_by_id(_id, start=calc_trading_day_start(day))
+            if df.empty:
+                continue
+            klines = gen_klines_from_pd(_id, df, levels, MarketID=4)
+
+            dirty = {}
+            for level, kline_df in klines.items():
+                if not kline_df.empty:
+                    kline_df = kline_df[kline_df['TradingTime'] >= progress[level]]
+                dirty[level] = kline_df
+            logger.info(f'{_id}: update {sum(_df.shape[0] for _df in dirty.values())} klines since {day}.')
+            if kline_store.enabled:
+                batch.add(_id, dirty, incremental=True)
+                continue
+
+            for level, kline_df in dirty.items():
+                if kline_df.empty:
+                    continue
+                with Dbg_Timer(f'update_kline-{level}-{_id}', 15):
+                    if level == '1d':
+                        bulk_write_klines(StatisDayDoc, kline_df.drop('level', axis=1), upsert=True)
+                    else:
+                        bulk_write_klines(KlineDoc, kline_df, upsert=True)
+            _save_kline_progress(_id, _last_bars(dirty))
+
+
+# K线所在的交易日，`last_bar`为`TradingTime`
+def _kline_trading_day(last_bar, level):
+    last_bar = np.datetime64(pd.Timestamp(last_bar), 'ns')
+    if level == '1d':
+        return last_bar.astype('datetime64[D]')
+    _, bins = calc_session_bins([last_bar - TRADING_TIME_OFFSET.to_timedelta64()], '1d')
+    return bins[0].astype('datetime64[D]')
+
+
+# 每个粒度最后一根K线的`TradingTime`
+def _last_bars(klines):
+    return {level: kline_df['TradingTime'].max() for level, kline_df in klines.items() if not kline_df.empty}
+
+
+# 记录每个粒度最后一根K线的`TradingTime`，见`KlineProgressDoc`
+def _save_kline_progress(_id, last_bars):
+    for level, last_bar in last_bars.items():
+        KlineProgressDoc.objects(InstrumentID=_id, level=level).update_one(
+            upsert=True,
+            set__last_bar=pd.Timestamp(last_bar).to_pydatetime(),
+            set__update_time=datetime.datetime.now(),
+        )
 
 
 # 从数据库中load指定的kline数据
 def load_kline_to_df(cat, level):
-    day_k = KlineDoc.objects(category=cat, level=level)
-    total = day_k.count()
-    if not total:
-        raise
-
-    dicts = []
-    with tqdm(total=total, desc=f'process:') as pbar:
-        for trad in day_k:
-            pbar.update(1)
-            t_dict = trad.to_mongo().to_dict()
-            del t_dict['_id']
-            # del t_dict['tags']
-            dicts.append(t_dict)
-
-    with Dbg_Timer(f'from_dict', 5):
-        df = pd.DataFrame.from_dict(dicts)
-        del dicts
-
-        df = df.set_index('TradingTime')
-        df = df.sort_index()
-        df = df.reset_index()
-
-    return df
+    if kline_store.enabled:
+        df = kline_store.load(cat, level)
+        if df.empty:
+            raise ModelException(f'[{level}-{cat}]: kline not exists.')
+        return df.sort_values('TradingTime', kind='stable', ignore_index=True)
+
+    with Dbg_Timer(f'load_kline-{level}-{cat}', 5):
+        df = load_klines_df(KlineDoc, category=cat, level=level)
+    if df.empty:
+        raise ModelException(f'[{level}-{cat}]: kline not exists.')
+    return _sort_kline_df(df)
 
 
 # 从数据库中load指定的日K数据
+#   - main: 只加载主力合约。`kline_store`中的`isDominant`默认为False，用`KlineStore.update_columns()`设置
 def load_1day_kline_to_df(cat, main=True):
+    if kline_store.enabled:
+        df = kline_store.load(cat, '1d')
+        if main:
+            df = df[df['isDominant'] == True] if 'isDominant' in df.columns else df.iloc[0:0]
+        if df.empty:
+            raise ModelException(f'[1d-{cat}]: {"dominant " if main else ""}kline not exists.')
+        return df.drop('level', axis=1, errors='ignore').sort_values('TradingTime', kind='stable', ignore_index=True)
+
     q_f = dict(category=cat)
     if main:
         q_f['isDominant'] = True
 
-    day_k = StatisDayDoc.objects(**q_f)
-    total = day_k.count()
-    if not total:
-        raise
-
-    dicts = []
-    with tqdm(total=total, desc=f'process:') as pbar:
-        for trad in day_k:
-            pbar.update(1)
-            t_dict = trad.to_mongo().to_dict()
-            del t_dict['_id']
-            del t_dict['tags']
-            dicts.append(t_dict)
-
-    with Dbg_Timer(f'from_dict', 5):
-        df = pd.DataFrame.from_dict(dicts)
-        del dicts
+    with Dbg_Timer(f'load_kline-1d-{cat}', 5):
+        df = load_klines_df(StatisDayDoc, columns=[col for col in StatisDayDoc._fields_ordered if col not in ['id', 'tags']], **q_f)
+    if df.empty:
+        raise ModelException(f'[1d-{cat}]: kline not exists.')
+    return _sort_kline_df(df)
 
-        df = df.set_index('TradingTime')
-        df = df.sort_index()
-        df = df.reset_index()
 
-    return df
+# 按`TradingTime`排序；没有值的字段`to_mongo()`时不保存，这些列去掉，和以前逐条转换的结果一致
+def _sort_kline_df(df):
+    df = df.dropna(axis=1, how='all')
+    return df.sort_values('TradingTime', kind='stable', ignore_index=True)
 
 
 # Demo: 并发计算Kline数据并入库
@@ -260,4 +354,4 @@ if '__main__' == __name__:
 
     ids = list(chunks_from_array(instIDs, 120))
 
-    parallel_process_grps(ids, calc_1H_kline_by_id, pool_size=6, spawn=False)
+    parallel_process_grps(ids, calc_kline_by_id, pool_size=6, spawn=False)
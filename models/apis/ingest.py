@@ -0,0 +1,514 @@
+import io
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from mongoengine import NotUniqueError, disconnect_all
+from ..dbs.conf import RAW_DATA_PATH
+from fnmatch import fnmatch
+from ..dbs.tick_file_doc import TickFilesDoc, INGEST_SKIP_TAGS
+from ..dbs.meta_buffer import meta_buffer
+from ..dbs.storage import sweep_tmp_files
+from ..mongo import conn_mongo
+from .apis import format_file_size
+
+__all__ = ('find_raw_files', 'discover_raw_files', 'ingest_raw_files', 'ingest_pipeline', 'load_retry_list', 'IngestJournal', )
+
+logger = logging.getLogger(__name__)
+
+
+# 查找原始文件，返回相对`RAW_DATA_PATH`的路径
+# '/data/raw_data/2022/5/UR/UR2208/2022/202206/20220606.spt'
+def find_raw_files(year, mkt, cat='*'):
+    for _file in RAW_DATA_PATH.glob(f'{year}/{mkt}/{cat}/*/*/*/*.spt'):
+        yield str(_file.relative_to(RAW_DATA_PATH))
+
+
+# 增量发现需要入库的原始文件，返回相对`RAW_DATA_PATH`的路径。
+# 一次查询加载该市场/年份已知文件的元数据，和文件系统扫描的结果比较，不需要每个文件查一次Mongo。
+# 返回的文件：
+#   - new: Mongo中没有记录
+#   - changed: size或mtime变化(以前没有记录mtime的只比较size)
+#   - unzipped: 还没有处理过(`line_num`为空，也没有`INGEST_SKIP_TAGS`)，包括进程崩溃时元数据丢失的文件
+def discover_raw_files(year, mkt, cat='*'):
+    q_f = dict(year=str(year), MarketID=int(mkt))
+    if cat != '*':
+        q_f['category'] = cat
+    known = {}
+    for doc in TickFilesDoc.objects(**q_f).only('path', 'size', 'mtime', 'zip_path', 'line_num', 'tags', 'MarketID', 'subID').as_pymongo():
+        known[doc['path']] = doc
+
+    files = []
+    cnt = dict(new=0, changed=0, unzipped=0, unchanged=0)
+    for relative_file, size, mtime in _scan_raw_files(year, mkt, cat):
+        doc = known.get(relative_file)
+        if doc is None:
+            status = 'new'
+        elif doc.get('size') != size or (doc.get('mtime') is not None and doc['mtime'] != mtime):
+            status = 'changed'
+        elif (not doc.get('zip_path') and doc.get('line_num') is None and not set(doc.get('tags', [])) & set(INGEST_SKIP_TAGS)
+                and TickFilesDoc.ingestable(doc.get('MarketID'), doc.get('subID'))):
+            status = 'unzipped'
+        else:
+            status = 'unchanged'
+        cnt[status] += 1
+        if status != 'unchanged':
+            files.append(relative_file)
+    logger.info(f'[ingest]: discover {year}/{mkt}/{cat}: {cnt}, known={len(known)}.')
+    return files
+
+
+# 扫描原始文件，返回(relative_file, size, mtime)。`os.scandir`的stat结果有缓存，比`glob()`后再`stat()`快。
+def _scan_raw_files(year, mkt, cat='*'):
+    def _sub_dirs(path, pattern='*'):
+        try:
+            with os.scandir(path) as it:
+                return [entry.path for entry in it if entry.is_dir() and fnmatch(entry.name, pattern)]
+        except FileNotFoundError:
+            return []
+
+    root = str(RAW_DATA_PATH)
+    for cat_dir in _sub_dirs(os.path.join(root, str(year), str(mkt)), cat):
+        for inst_dir in _sub_dirs(cat_dir):
+            for year_dir in _sub_dirs(inst_dir):
+                for month_dir in _sub_dirs(year_dir):
+                    with os.scandir(month_dir) as it:
+                        for entry in it:
+                            if entry.name.endswith('.spt') and entry.is_file():
+                                stat = entry.stat()
+                                yield os.path.relpath(entry.path, root), stat.st_size, stat.st_mtime
+
+
+# 读取失败重试列表
+def load_retry_list(retry_file):
+    with open(retry_file) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# 并发入库原始文件
+#   - files: 相对`RAW_DATA_PATH`的路径
+#   - pool_size: 进程数，0表示cpu_count-1
+#   - max_pending: 已提交但没有完成的文件数上限，避免一次把所有任务塞进队列
+#   - retry_file: 失败的文件写入这个文件，可以用`load_retry_list()`读出来重试
+#   - report_sec: 打印进度的间隔
+#   - chunk_rows: 分块处理原始文件，见`TickFilesDoc.csv_to_pickle()`
+#   - flush_docs/flush_sec: 子进程不写元数据，修改返回给主进程，由主进程批量写入，见`meta_buffer.py`
+#   - journal_file: 入库日志，中断后用同一个日志重新运行，从中断的地方继续，见`IngestJournal`
+def ingest_raw_files(files, pool_size=0, max_pending=0, retry_file=None, report_sec=60, chunk_rows=None, flush_docs=500, flush_sec=5,
+                     journal_file=None):
+    import multiprocessing as mp
+
+    if pool_size == 0:
+        pool_size = mp.cpu_count() - 1
+    max_pending = max_pending or pool_size * 4
+
+    stat = _IngestStat(report_sec)
+    pending = threading.BoundedSemaphore(max_pending)
+    journal = IngestJournal(journal_file)
+
+    # 回调在pool的结果线程中执行，不能抛出异常，否则结果线程退出，主进程一直等待`pending`
+    def _on_done(res):
+        relative_file, status, size, exec_time, error, updates = res
+        try:
+            try:
+                meta_buffer.add_raw(updates)
+                journal.finish(relative_file, status)
+            except Exception as e:
+                logger.error(f'[ingest]: {relative_file}: save meta fail.', exc_info=1)
+                status, error = 'failed', repr(e)
+            stat.add(relative_file, status, size, exec_time, error)
+            stat.report()
+        finally:
+            pending.release()
+
+    def _on_error(relative_file, e):        # 子进程异常退出等情况
+        try:
+            stat.add(relative_file, 'failed', 0, 0, repr(e))
+            journal.finish(relative_file, 'failed')
+        except Exception:
+            logger.error(f'[ingest]: {relative_file}: save journal fail.', exc_info=1)
+        finally:
+            pending.release()
+
+    # 连接不能跨进程使用，每个进程单独连接
+    with journal, meta_buffer.setup(flush_docs, flush_sec, on_flush=journal.commit), mp.Pool(pool_size, initializer=_init_worker) as pool:
+        for relative_file, resume in journal.resume(files):
+            pending.acquire()
+            journal.start(relative_file)
+            pool.apply_async(_ingest_file, (relative_file, chunk_rows, resume), callback=_on_done,
+                             error_callback=lambda e, f=relative_file: _on_error(f, e))
+        pool.close()
+        pool.join()
+    stat.report(force=True)
+
+    if retry_file and stat.failed:
+        with open(retry_file, 'w') as f:
+            f.writelines(f'{_file}\n' for _file, _ in stat.failed)
+        logger.info(f'[ingest]: {len(stat.failed)} failed files are saved to {retry_file}.')
+    return stat
+
+
+# 单机流水线入库：读文件、解析、压缩写入、写元数据分为几个阶段，每个阶段多个线程，之间用有界队列连接。
+# 磁盘IO、压缩和解析可以同时进行；下游处理不过来时上游阻塞，内存占用有上限。
+# 读文件、pyarrow解析csv和zlib/lz4/zstd压缩时会释放GIL，所以用线程；数据不需要在进程间复制。
+# 但`_ingest_transform()`中pandas清洗、排序和统计的部分大多持有GIL，多个解析线程基本是串行的。
+# 解析是瓶颈时设置`transform_procs`，把解析放到进程池中执行，代价是原始数据和解析结果要在进程间复制；
+# CPU密集的大批量入库也可以直接用`ingest_raw_files()`。
+#   - readers/workers/writers: 读文件、解析(`_ingest_transform()`)、压缩写入(`_ingest_store()`)的线程数
+#   - transform_procs: 解析进程数，0表示在解析线程中执行。解析线程只等待进程的结果，`workers`不应少于进程数
+#   - queue_size: 每个队列的长度
+#   - 元数据由一个线程通过`meta_buffer`批量写入
+# 只支持整个文件处理，不支持`chunk_rows`。结束时打印每个阶段的耗时。
+def ingest_pipeline(files, readers=2, workers=4, writers=2, queue_size=8, retry_file=None, report_sec=60, flush_docs=500, flush_sec=5,
+                    journal_file=None, transform_procs=0):
+    import queue
+    from concurrent.futures import ProcessPoolExecutor
+
+    stat = _IngestStat(report_sec)
+    journal = IngestJournal(journal_file)
+    q_read, q_transform, q_store, q_meta = [queue.Queue(queue_size) for _ in range(4)]
+    stages = [
+        _Stage('read', _read_stage, readers, q_read, q_transform),
+        _Stage('transform', lambda item: _transform_stage(item, procs), workers, q_transform, q_store),
+        _Stage('store', _store_stage, writers, q_store, q_meta),
+        _Stage('meta', lambda item: _meta_stage(item, stat, journal), 1, q_meta, None),
+    ]
+
+    procs = ProcessPoolExecutor(transform_procs) if transform_procs else None
+    try:
+        with journal, meta_buffer.setup(flush_docs, flush_sec, on_flush=journal.commit):
+            for stage in stages:
+                stage.start()
+            for relative_file, resume in journal.resume(files):
+                journal.start(relative_file)
+                q_read.put(_IngestItem(relative_file, resume))
+            for stage in stages:        # 依次结束每个阶段
+                stage.stop()
+    finally:
+        if procs is not None:
+            procs.shutdown()
+    stat.report(force=True)
+    for stage in stages:
+        logger.info(f'[ingest]: {stage!r}')
+
+    if retry_file and stat.failed:
+        with open(retry_file, 'w') as f:
+            f.writelines(f'{_file}\n' for _file, _ in stat.failed)
+        logger.info(f'[ingest]: {len(stat.failed)} failed files are saved to {retry_file}.')
+    return stat
+
+
+# 流水线中的一个文件
+class _IngestItem():
+    def __init__(self, relative_file, resume=False):
+        self.relative_file = relative_file
+        self.resume = resume
+        self.start = time.time()
+        self.doc = None
+        self.data = None
+        self.df = None
+        self.update_d = None
+        self.status = None      # 不为None时跳过之后的阶段，直接写元数据
+        self.error = None
+
+
+def _read_stage(item):
+    item.doc, force = _open_doc(item.relative_file, item.resume)
+    if force is None or not item.doc._need_ingest(force=force):
+        item.status = 'exists' if item.doc.zip_path else 'skipped'
+        return
+    with open(RAW_DATA_PATH / item.relative_file, 'rb') as f:
+        item.data = io.BytesIO(f.read())
+
+
+# procs: 不为None时在进程池中解析
+def _transform_stage(item, procs=None):
+    if procs is None:
+        item.df, item.update_d = item.doc._ingest_transform(item.data)
+    else:
+        item.df, item.update_d = procs.submit(_transform_in_proc, item.doc, item.data.getvalue()).result()
+    item.data = None
+    if item.df is None:
+        item.status = 'skipped'
+
+
+# 在解析进程中执行，doc和结果通过pickle在进程间传递
+def _transform_in_proc(doc, data):
+    return doc._ingest_transform(io.BytesIO(data))
+
+
+def _store_stage(item):
+    item.update_d = item.doc._ingest_store(item.df, item.update_d)
+    item.df = None
+    item.status = 'done'
+
+
+def _meta_stage(item, stat, journal):
+    if item.update_d:
+        try:
+            meta_buffer.update(item.doc, **item.update_d)
+        except Exception as e:
+            logger.error(f'[ingest]: meta {item.relative_file} fail.', exc_info=1)
+            item.status, item.error = 'failed', repr(e)
+    journal.finish(item.relative_file, item.status or 'failed')
+    size = (item.doc.size or 0) if item.doc is not None else 0
+    stat.add(item.relative_file, item.status or 'failed', size, time.time() - item.start, item.error)
+    stat.report()
+
+
+# 流水线的一个阶段：`workers`个线程从`in_q`中取出item，执行`func(item)`后放入`out_q`。
+# 出错的item标记为failed，继续传给下游(最后一个阶段记录结果)。
+class _Stage():
+    _STOP = object()
+
+    def __init__(self, name, func, workers, in_q, out_q):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.in_q = in_q
+        self.out_q = out_q
+        self.cnt = 0
+        self.busy = 0           # 处理的总耗时
+        self.blocked = 0        # 等待下游的总耗时
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._run, name=f'ingest-{self.name}-{i}', daemon=True) for i in range(self.workers)]
+        for t in self._threads:
+            t.start()
+
+    # 上游结束后调用，处理完队列中剩余的item后退出
+    def stop(self):
+        for _ in self._threads:
+            self.in_q.put(self._STOP)
+        for t in self._threads:
+            t.join()
+
+    def _run(self):
+        while True:
+            item = self.in_q.get()
+            if item is self._STOP:
+                return
+            st = time.time()
+            if item.status is None or self.out_q is None:
+                try:
+                    self.func(item)
+                except Exception as e:
+                    logger.error(f'[ingest]: {self.name} {item.relative_file} fail.', exc_info=1)
+                    item.status, item.error = 'failed', repr(e)
+                    item.data = item.df = None
+            busy = time.time() - st
+            if self.out_q is not None:
+                self.out_q.put(item)
+            with self._lock:
+                self.cnt += 1
+                self.busy += busy
+                self.blocked += time.time() - st - busy
+
+    def __repr__(self):
+        avg = self.busy / self.cnt if self.cnt else 0
+        return f'Stage({self.name}, workers={self.workers}, cnt={self.cnt}, busy={self.busy:.1f}s, avg={avg * 1000:.0f}ms, blocked={self.blocked:.1f}s)'
+
+
+def _init_worker():
+    disconnect_all()
+    conn_mongo('ticks')
+    meta_buffer.setup(sys.maxsize, float('inf'))     # 只缓冲，由`_ingest_file()`取出返回给主进程
+
+
+# 入库单个文件，返回(relative_file, status, size, exec_time, error, updates)
+#   status: done/exists/skipped/failed
+#   updates: 没有写入的元数据修改，见`MetaUpdateBuffer.pop_pending()`
+#   resume: 上次中断时正在处理的文件，见`_open_doc()`
+def _ingest_file(relative_file, chunk_rows=None, resume=False):
+    st = time.time()
+    size = 0
+    try:
+        doc, force = _open_doc(relative_file, resume)
+        size = doc.size or 0
+        if force is None or (not force and doc.zip_path):
+            return relative_file, 'exists', size, time.time() - st, None, meta_buffer.pop_pending()
+
+        doc.csv_to_pickle(force=force, chunk_rows=chunk_rows)
+        status = 'done' if doc.zip_path else 'skipped'
+        return relative_file, status, size, time.time() - st, None, meta_buffer.pop_pending()
+    except Exception as e:
+        logger.error(f'[ingest]: {relative_file} fail.', exc_info=1)
+        return relative_file, 'failed', size, time.time() - st, repr(e), meta_buffer.pop_pending()
+
+
+# 返回(doc, force)，没有doc时新建。
+#   force: 原始文件变化了，或者是上次中断时正在处理的文件(resume)，需要重新处理；
+#          None表示中断时文件和元数据都已经写完(校验和一致)，不需要处理
+def _open_doc(relative_file, resume=False):
+    doc = TickFilesDoc.objects(path=relative_file).first()
+    if doc is None:
+        doc = _new_doc(relative_file)
+
+    stat = (RAW_DATA_PATH / relative_file).stat()
+    changed = stat.st_size != doc.size or (doc.mtime is not None and stat.st_mtime != doc.mtime)
+    if changed:
+        logger.info(f'[ingest]: {relative_file} changed, size: {doc.size}->{stat.st_size}.')
+        meta_buffer.update(doc, set__size=stat.st_size, set__mtime=stat.st_mtime)
+        return doc, True
+    if resume:
+        sweep_tmp_files(doc.file)       # 上次中断时可能留下了临时文件
+        if doc.zip_path and doc.verify_zip():
+            return doc, None
+        return doc, True
+    return doc, False
+
+
+def _new_doc(relative_file):
+    # ('2022', '5', 'UR', 'UR2208', '2022', '202206', '20220606.spt')
+    _year, _mkt, _cat, _inst, _, _month, _day = relative_file.split('/')
+    _day = _day.split('.')[0]
+    stat = (RAW_DATA_PATH / relative_file).stat()
+    try:
+        return TickFilesDoc(**dict(
+            MarketID = int(_mkt),           # 市场代码(上证1, 深证2, 中金所3, 上期4, 郑商5, 大商6)
+            category = _cat,                # 合约品种: AU/AG/CU...
+            InstrumentID = _inst,           # 合约代码
+            subID = _inst[-4:],             # 子代码(日期)，从InstrumentID中提取。2210
+
+            data_type = 'tick',             # tick/9999/0000/1day_k... subID: 9999表示主力dominant，0000表示指数index
+            year = _year,                   # '2019'
+            month = _month,                 # '201909'
+            day = _day,                     # '20190925'
+            # 原始文件
+            path = relative_file,           # 存放相对路径
+            size = stat.st_size,
+            mtime = stat.st_mtime,
+        )).save()
+    except NotUniqueError:                  # 其它进程已经添加了
+        return TickFilesDoc.objects(path=relative_file).first()
+
+
+_FINISHED_STATES = ('done', 'exists', 'skipped')      # 入库日志中算作完成的状态
+
+
+# 入库日志，每行一个json：{"time": ..., "file": ..., "state": "start/done/exists/skipped/failed"}。
+#   - start(file): 开始处理；
+#   - finish(file, status): 处理完，元数据已经交给`meta_buffer`；
+#   - commit(): `meta_buffer`写入Mongo后调用，把finish过的文件记为完成(status)。
+# 中断后用同一个日志重新运行时，`resume(files)`跳过已经完成的文件(不查Mongo)，
+# 先返回上次start了但没有完成的文件(resume=True)：校验和一致的直接跳过，否则强制重新处理。
+# 失败(failed)的文件不算完成，重新运行时也会再处理。
+# 日志只追加，每次写入都flush，进程被杀掉时最多丢失最后一行。全部完成后可以删掉。
+# `path`为None时不记录。
+class IngestJournal():
+    def __init__(self, path=None):
+        self.path = path
+        self.started = set()
+        self.finished = set()
+        self._staged = []           # [(file, status)]，等待元数据写入
+        self._lock = threading.Lock()
+        self._f = None
+        if path is not None:
+            self._load()
+            self._f = open(path, 'a')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:          # 最后一行可能不完整
+                    continue
+                if rec['state'] == 'start':
+                    self.started.add(rec['file'])
+                elif rec['state'] in _FINISHED_STATES:
+                    self.finished.add(rec['file'])
+                else:                       # failed，重新运行时再处理
+                    self.finished.discard(rec['file'])
+        logger.info(f'[journal]: {self.path}: finished={len(self.finished)}, unfinished={len(self.unfinished())}.')
+
+    def unfinished(self):
+        return self.started - self.finished
+
+    # 返回(file, resume)
+    def resume(self, files):
+        unfinished = self.unfinished()
+        for relative_file in sorted(unfinished):
+            yield relative_file, True
+        for relative_file in files:
+            if relative_file not in self.finished and relative_file not in unfinished:
+                yield relative_file, False
+
+    def _write(self, relative_file, state):
+        if self._f is None:
+            return
+        self._f.write(json.dumps(dict(time=time.time(), file=relative_file, state=state)) + '\n')
+        self._f.flush()
+
+    def start(self, relative_file):
+        with self._lock:
+            self._write(relative_file, 'start')
+
+    def finish(self, relative_file, status):
+        with self._lock:
+            if status == 'failed':      # 失败的文件写入重试列表，不需要等元数据
+                self._write(relative_file, status)
+            else:
+                self._staged.append((relative_file, status))
+
+    def commit(self, *args):
+        with self._lock:
+            for relative_file, status in self._staged:
+                self._write(relative_file, status)
+                self.finished.add(relative_file)
+            self._staged = []
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    # `meta_buffer`在此之前已经flush，剩下的是没有元数据修改的文件
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        self.close()
+
+
+# 入库进度统计，在结果回调线程中更新
+#   - name: 日志前缀，切分等其它批量任务也用这个类统计
+class _IngestStat():
+    def __init__(self, report_sec=60, name='ingest'):
+        self.name = name
+        self.report_sec = report_sec
+        self.start = self._last_report = time.time()
+        self.cnt = {}
+        self.size = 0
+        self.exec_time = 0
+        self.failed = []        # [(relative_file, error)]
+        self._lock = threading.Lock()
+
+    @property
+    def total(self):
+        return sum(self.cnt.values())
+
+    def add(self, relative_file, status, size, exec_time, error):
+        with self._lock:
+            self.cnt[status] = self.cnt.get(status, 0) + 1
+            self.size += size
+            self.exec_time += exec_time
+            if status == 'failed':
+                self.failed.append((relative_file, error))
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self._last_report < self.report_sec:
+            return
+        self._last_report = now
+        elapsed = max(now - self.start, 1e-6)
+        logger.info(f'[{self.name}]: {self.total} files, {self.cnt}, {format_file_size(self.size)}, '
+                    f'{self.total / elapsed:.2f} files/s, {format_file_size(self.size / elapsed)}/s, Time={elapsed:.1f}s.')
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from ..dbs.sessions import TIME_PERIODS, calc_session_bins
+
+__all__ = ('KLINE_BASE_LEVEL', 'TRADING_TIME_OFFSET', 'calc_base_bars', 'rollup_bars', 'gen_klines_from_bars', )
+
+
+KLINE_BASE_LEVEL = '1min'       # 基础K线粒度，其它粒度都由它聚合得到，必须能整除其它粒度
+TRADING_TIME_OFFSET = pd.Timedelta(hours=6)     # `TradingTime` = `UpdateTime` + 6h，和以前的K线数据保持一致
+
+# 聚合方式：(基础K线的列, 聚合函数)，ticks -> 基础K线、基础K线 -> 其它粒度分别见`_TICK_AGGS`、`_BAR_AGGS`
+_TICK_AGGS = dict(
+    open=('LastPrice', 'first'),
+    high=('LastPrice', 'max'),
+    low=('LastPrice', 'min'),
+    close=('LastPrice', 'last'),
+    TotalVolume=('LastVolume', 'sum'),
+    _vol_sumsq=('_vol_sq', 'sum'),      # 成交量的平方和、个数，用于聚合后计算`volume_std`
+    _vol_cnt=('LastVolume', 'count'),
+    OpenPrice=('OpenPrice', 'first'),
+    HighestPrice=('HighestPrice', 'last'),
+    LowestPrice=('LowestPrice', 'last'),
+    AvePrice=('AvePrice', 'last'),
+    OpenInterest=('OpenInterest', 'last'),
+    Turnover=('Turnover', 'last'),
+    Turnover_new=('_turnover', 'sum'),
+    tick_num=('Turnover', 'count'),
+)
+_BAR_AGGS = dict(
+    open='first', high='max', low='min', close='last',
+    TotalVolume='sum', _vol_sumsq='sum', _vol_cnt='sum',
+    OpenPrice='first', HighestPrice='last', LowestPrice='last', AvePrice='last', OpenInterest='last', Turnover='last',
+    Turnover_new='sum', tick_num='sum',
+)
+
+
+# ticks生成基础K线，一次groupby完成所有列的聚合。
+#   - df: 有`UpdateTime`列的ticks，见`load_ticks_by_id()`
+# K线按交易时段划分，见`calc_session_bins()`。返回index为K线起始时间(`UpdateTime`的时间)的df，只有有ticks的K线。
+def calc_base_bars(df, level=KLINE_BASE_LEVEL):
+    _, bins = calc_session_bins(df['UpdateTime'], level)
+    df = df.assign(
+            _vol_sq=df.LastVolume.astype('float64') ** 2,
+            _turnover=df.LastPrice * df.LastVolume * 10,     # 同`Turnover_new`字段的说明
+        )
+    bars = df.groupby(pd.DatetimeIndex(bins, name='UpdateTime'), sort=True).agg(**_TICK_AGGS)
+    return bars
+
+
+# 基础K线聚合为更粗的粒度，各列的聚合方式见`_BAR_AGGS`。
+# `volume_std`由成交量的和、平方和、个数计算，和直接在ticks上计算的样本标准差一致。
+# 基础K线不跨时段，按K线起始时间划分即可。
+def rollup_bars(bars, level):
+    if level == KLINE_BASE_LEVEL:
+        return bars
+    _, bins = calc_session_bins(bars.index, level)
+    return bars.groupby(pd.DatetimeIndex(bins, name='UpdateTime'), sort=True).agg(_BAR_AGGS)
+
+
+# 计算`volume_std`，去掉中间结果
+def _finish_bars(bars):
+    n = bars['_vol_cnt'].to_numpy(dtype='float64')
+    s = bars['TotalVolume'].to_numpy(dtype='float64')
+    ss = bars['_vol_sumsq'].to_numpy(dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (ss - s * s / n) / (n - 1)
+    var = np.where(n > 1, np.maximum(var, 0), np.nan)
+    bars = bars.drop(['_vol_sumsq', '_vol_cnt'], axis=1)
+    bars.insert(bars.columns.get_loc('TotalVolume') + 1, 'volume_std', np.sqrt(var))
+    return bars
+
+
+# 由基础K线生成多个粒度的K线，返回{level: kline_df}，格式同`gen_kline_from_pd()`。
+# `TradingTime`：日K为交易日，其它为K线起始时间 + `TRADING_TIME_OFFSET`；日内的K线不跨时段，同时给出`time_type`。
+def gen_klines_from_bars(_id, bars, levels, MarketID=4):
+    klines = {}
+    for level in levels:
+        kline_df = _finish_bars(rollup_bars(bars, level))
+        kline_df['volume_std'] = kline_df['volume_std'].fillna(1.0)
+
+        kline_df.insert(4, 'InstrumentID', _id)
+        kline_df.insert(5, 'category', _id[:2])
+        kline_df.insert(6, 'MarketID', MarketID)
+        kline_df.insert(7, 'level', level)
+        if level == '1d':
+            kline_df.index.name = 'TradingTime'
+        else:
+            codes, _ = calc_session_bins(kline_df.index, level)
+            kline_df.insert(8, 'time_type', np.array(list(TIME_PERIODS), dtype=object)[codes])
+            kline_df.index = pd.DatetimeIndex(kline_df.index + TRADING_TIME_OFFSET, name='TradingTime')
+
+        # 处理：ticks中的开盘/最高/最低价为0时用OHLC的值
+        for dst, src in [('HighestPrice', 'high'), ('LowestPrice', 'low'), ('OpenPrice', 'open')]:
+            dst_0_idx = kline_df[dst] == 0
+            kline_df.loc[dst_0_idx, dst] = kline_df.loc[dst_0_idx, src]
+
+        kline_df.reset_index(inplace=True)
+        kline_df.dropna(inplace=True)
+        klines[level] = kline_df
+    return klines
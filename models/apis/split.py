@@ -0,0 +1,119 @@
+import time
+import logging
+import threading
+from ..dbs.tick_file_doc import TickFilesDoc, TickSplitPklFilesDoc
+from ..dbs.meta_buffer import meta_buffer
+from .ingest import _IngestStat, _init_worker
+
+__all__ = ('split_tick_files', )
+
+logger = logging.getLogger(__name__)
+
+
+# 批量按交易时段切分tick文件，见`TickFilesDoc.save_splited()`
+#   - queryset: `TickFilesDoc`的queryset，例如`TickFilesDoc.main`
+#   - pool_size: 进程数，0表示cpu_count-1
+#   - max_pending: 已提交但没有完成的文件数上限
+#   - batch_files: 主进程每收到这么多文件的结果，用`TickSplitPklFilesDoc.replace_splits()`批量删除旧切分、写入新切分
+#   - flush_docs/flush_sec: `TickFilesDoc`的修改由主进程批量写入，见`meta_buffer.py`
+#   - retry_file: 失败的文件(pk)写入这个文件
+# 子进程只读Mongo、写切分文件，返回切分的元数据；所有Mongo写入都在主进程批量完成。
+# `TickFilesDoc`的`splited`在新切分写入之后才更新，中断后重新运行没有`splited`的文件即可。
+def split_tick_files(queryset, pool_size=0, max_pending=0, batch_files=200, report_sec=60, flush_docs=500, flush_sec=5, retry_file=None):
+    import multiprocessing as mp
+
+    if pool_size == 0:
+        pool_size = mp.cpu_count() - 1
+    max_pending = max_pending or pool_size * 4
+
+    pks = list(queryset.scalar('id'))
+    logger.info(f'[split]: {len(pks)} files.')
+    stat = _IngestStat(report_sec, name='split')
+    pending = threading.BoundedSemaphore(max_pending)
+    batch = _SplitBatch(batch_files)
+
+    def _on_done(res):
+        pk, status, size, exec_time, error, splits, updates = res
+        batch.add(pk, splits, updates)
+        stat.add(str(pk), status, size, exec_time, error)
+        pending.release()
+        stat.report()
+
+    def _on_error(pk, e):
+        stat.add(str(pk), 'failed', 0, 0, repr(e))
+        pending.release()
+
+    with meta_buffer.setup(flush_docs, flush_sec), mp.Pool(pool_size, initializer=_init_worker) as pool:
+        for pk in pks:
+            pending.acquire()
+            pool.apply_async(_split_file, (pk, ), callback=_on_done, error_callback=lambda e, pk=pk: _on_error(pk, e))
+        pool.close()
+        pool.join()
+        batch.flush()
+    stat.failed += batch.failed
+    stat.report(force=True)
+    logger.info(f'[split]: {batch.split_cnt} splits are saved.')
+
+    if retry_file and stat.failed:
+        with open(retry_file, 'w') as f:
+            f.writelines(f'{_pk}\n' for _pk, _ in stat.failed)
+        logger.info(f'[split]: {len(stat.failed)} failed files are saved to {retry_file}.')
+    return stat
+
+
+# 主进程中缓存子进程返回的切分，凑够`batch_files`个文件后一起写入
+class _SplitBatch():
+    def __init__(self, batch_files):
+        self.batch_files = batch_files
+        self.split_cnt = 0
+        self.failed = []        # [(pk, error)]，写入失败的文件
+        self._splits = {}
+        self._updates = []
+        self._lock = threading.RLock()
+
+    def add(self, pk, splits, updates):
+        with self._lock:
+            if splits is not None:
+                self._splits[pk] = splits
+            self._updates += updates
+            if len(self._splits) >= self.batch_files:
+                self.flush()
+
+    # 在结果回调线程中执行，不能抛出异常，失败的文件记在`failed`中
+    def flush(self):
+        with self._lock:
+            splits, updates = self._splits, self._updates
+            self._splits, self._updates = {}, []
+            try:
+                self.split_cnt += TickSplitPklFilesDoc.replace_splits(splits)
+            except Exception as e:
+                logger.error(f'[split]: save splits of {len(splits)} files fail.', exc_info=1)
+                self.failed += [(pk, repr(e)) for pk in splits]
+                return      # 切分没有写入，不能标记`splited`
+            try:
+                meta_buffer.add_raw(updates)        # 切分写入之后才更新`TickFilesDoc`
+            except Exception:
+                logger.error(f'[split]: update {len(updates)} file docs fail.', exc_info=1)
+
+
+# 切分单个文件，返回(pk, status, size, exec_time, error, splits, updates)
+#   status: done/skipped/failed
+#   splits: 见`TickFilesDoc._split_to_files()`
+#   updates: `TickFilesDoc`的修改，见`MetaUpdateBuffer.pop_pending()`
+def _split_file(pk):
+    st = time.time()
+    size = 0
+    try:
+        doc = TickFilesDoc.objects(pk=pk).first()
+        if doc is None:
+            return pk, 'skipped', size, time.time() - st, None, None, []
+        size = doc.size or 0
+        splits, update_d = doc._split_to_files()
+        if update_d:
+            meta_buffer.update(doc, **update_d)
+        status = 'skipped' if splits is None else 'done'
+        return pk, status, size, time.time() - st, None, splits, meta_buffer.pop_pending()
+    except Exception as e:
+        logger.error(f'[split]: {pk} fail.', exc_info=1)
+        meta_buffer.pop_pending()
+        return pk, 'failed', size, time.time() - st, repr(e), None, []
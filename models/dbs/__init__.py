@@ -3,5 +3,17 @@
 from .tick_file_doc import *
 from .tick_pickle import *
 from .stock_1d import *
+from .storage import *
+from . import tick_cache as _tick_cache, local_tier as _local_tier, meta_buffer as _meta_buffer, kline_store as _kline_store     # 模块名和全局实例同名，star import之后会被覆盖
+from .tick_cache import *
+from .local_tier import *
+from .tick_catalog import *
+from .raw_csv import *
+from .sessions import *
+from .tick_stats import *
+from .meta_buffer import *
+from .kline_store import *
 
-__all__ = (tick_file_doc.__all__ + tick_pickle.__all__ + stock_1d.__all__)
+__all__ = (tick_file_doc.__all__ + tick_pickle.__all__ + stock_1d.__all__ + storage.__all__ + _tick_cache.__all__ + _local_tier.__all__ +
+           tick_catalog.__all__ + raw_csv.__all__ + sessions.__all__ + tick_stats.__all__ + _meta_buffer.__all__ +
+           _kline_store.__all__)
@@ -6,5 +6,32 @@ RAW_DATA_PATH = Path('/data/raw_data')
 PICKLE_COMPRESSION = 'zip'     # 测试下来读写性能综合考虑zip是最优的方法
 PICKLE_COMPRESSION_VER = 1
 
+# tick文件的存储格式，记录在`zip_ver`字段中，新旧格式的文件可以同时存在。
+STORAGE_VER_PICKLE_ZIP = PICKLE_COMPRESSION_VER     # pickle + zip，历史数据都是这个格式
+STORAGE_VER_PARQUET_ZSTD = 2
+STORAGE_VER_PARQUET_SNAPPY = 3
+STORAGE_VER_FEATHER = 4                             # Arrow IPC(feather v2) + lz4，读最快
+
+DEFAULT_STORAGE_VER = STORAGE_VER_PICKLE_ZIP
+CATEGORY_STORAGE_VER = {}       # 按品种指定新文件的存储格式，如：{'AG': STORAGE_VER_FEATHER}
+STORAGE_CHUNK_ROWS = 10000      # 列式存储每个row group/record batch的行数，按时间范围读取时以此为单位跳过
+STALE_TMP_SEC = 3600            # 写入进程已经不存在、并且超过这个时间没有修改的临时文件才会被清理，见`sweep_tmp_files()`
+
+INGEST_CHUNK_ROWS = 0           # 入库时分块解析原始csv的行数，内存占用和文件大小无关；0表示整个文件一次加载
+STREAM_STORAGE_VER = STORAGE_VER_PARQUET_ZSTD       # 分块入库时品种的存储格式不能追加写入，改用这个格式
+
+TICK_CACHE_BYTES = 0            # 进程内已解码tick数据的缓存容量，0表示不启用，见`tick_cache.py`
+LOCAL_TIER_PATH = None          # 本地盘上的解压缓存目录，如：Path('/nvme/ticks_cache')，见`local_tier.py`
+LOCAL_TIER_BYTES = 0            # 本地解压缓存的容量，0表示不启用
+
+META_FLUSH_DOCS = 0             # 元数据修改攒够多少个doc写一次Mongo，0表示不缓冲，见`meta_buffer.py`
+META_FLUSH_SEC = 5              # 元数据修改最多缓冲多少秒
+
+CATALOG_PATH = TICKS_PATH / 'tick_files_catalog.parquet'       # `TickFilesDoc`的本地快照，见`tick_catalog.py`
+
+KLINE_PATH = None               # 列式K线存储的目录，如：Path('/data/kline')；None表示K线仍然存在Mongo中，见`kline_store.py`
+KLINE_STORAGE_VER = STORAGE_VER_PARQUET_ZSTD        # K线分区文件的格式，只支持parquet
+KLINE_STORE_BATCH_ROWS = 5000000    # 写入列式K线存储之前，一批合约最多缓存多少行K线
+
 MAX_DATE = '2025-12-12'
 MIN_DATE = '2015-12-12'
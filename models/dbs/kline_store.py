@@ -0,0 +1,255 @@
+import fcntl
+import datetime
+import logging
+import pandas as pd
+from pathlib import Path
+from contextlib import contextmanager
+from mongoengine import *
+from .conf import *
+from .storage import get_engine
+
+__all__ = (
+        'KlinePartitionDoc', 'KlineStore', 'kline_store',
+    )
+
+logger = logging.getLogger()
+
+# 不是由ticks生成、之后单独设置的列及其默认值(同`KlineDoc`/`StatisDayDoc`)，重新写入K线时保留原来的值，见`update_columns()`
+_KEPT_COLUMNS = {'isDominant': False}
+_KEYS = ['InstrumentID', 'TradingTime']
+
+
+# K线文件的清单，每个分区(品种/粒度/年)一个doc
+class KlinePartitionDoc(Document):
+    meta = {
+        'collection': 'kline_partitions',
+        'db_alias': 'kline',
+        'index_background': True,
+        'auto_create_index': True,          # 每次操作都检查。TODO: Disabling this will improve performance.
+        'indexes': [
+            ('category', 'level', 'year'),
+            'instruments',
+        ]
+    }
+    category = StringField()                # 合约品种
+    level = StringField()                   # K线粒度
+    year = StringField()                    # `TradingTime`的年份
+
+    path = StringField()                    # 相对`KLINE_PATH`的路径
+    zip_ver = IntField()                    # 存储格式，见`storage.py`
+    rows = IntField()
+    instruments = ListField(StringField())  # 分区中的合约
+    start = DateTimeField()                 # `TradingTime`的范围
+    end = DateTimeField()
+    update_time = DateTimeField()
+
+    def __repr__(self):
+        return f'[{self.category}-{self.level}-{self.year}]: file={self.path}, rows={self.rows}, instruments={len(self.instruments)}'
+
+
+# 列式K线存储，代替逐条写入`KlineDoc`/`StatisDayDoc`。
+# 按品种/粒度/年分区，每个分区一个parquet文件：`KLINE_PATH/{category}/{level}/{year}.parquet`，
+# 文件内按(InstrumentID, TradingTime)排序，读取时用row group的统计信息跳过不需要的合约。
+# 每次写入都要读写整个分区，多个合约的K线应该合并之后一次`save()`。
+#   - save(kline_df): 写入一个或多个合约的K线(列同`gen_kline_from_pd()`的结果)，替换这些合约以前的K线；
+#   - delete(category, level, instruments): 删除一些合约的K线；
+#   - replace_partition(): 整个分区替换；
+#   - update_columns(category, level, df): 修改已有K线的某些列，如`isDominant`；
+#   - load(category, level, InstrumentIDs, start, end): 一次加载多个合约，返回一个df。
+# 写入时先写临时文件再rename，读的一方只会看到完整的旧文件或新文件；同一分区的读-改-写用文件锁串行化，
+# 多个进程可以同时写不同的合约。分区文件写完之后再更新`KlinePartitionDoc`。
+# 用法：
+#   kline_store.setup('/data/kline')
+#   kline_store.save(kline_df)
+#   df = kline_store.load('AG', '1min')
+class KlineStore():
+    def __init__(self, root=None, zip_ver=None):
+        self.setup(root, zip_ver)
+
+    def setup(self, root, zip_ver=None):
+        self.root = Path(root) if root else None
+        self.engine = get_engine(zip_ver or KLINE_STORAGE_VER)
+
+    @property
+    def enabled(self):
+        return self.root is not None
+
+    def _rel_file(self, category, level, year):
+        return Path(category) / level / f'{year}{self.engine.suffix}'
+
+    # 写入K线，kline_df中每个合约的K线替换该合约以前在同一粒度的所有K线
+    #   - incremental: 只替换每个合约`TradingTime`不早于kline_df中第一根K线的部分，用于增量更新
+    def save(self, kline_df, incremental=False):
+        if kline_df.empty:
+            return 0
+        kline_df = kline_df.assign(_year=kline_df['TradingTime'].dt.strftime('%Y'))
+        cnt = 0
+        for (category, level), _df in kline_df.groupby(['category', 'level'], sort=False):
+            instruments = list(_df['InstrumentID'].unique())
+            years = set(_df['_year'].unique())
+            since = None
+            if incremental:
+                since = _df.groupby('InstrumentID')['TradingTime'].min()
+            else:       # 这些合约以前所在的分区也要删掉旧数据
+                years |= set(KlinePartitionDoc.objects(category=category, level=level, instruments__in=instruments).distinct('year'))
+            groups = dict(list(_df.groupby('_year', sort=False)))
+            for year in sorted(years):
+                new_df = groups.get(year)
+                new_df = None if new_df is None else new_df.drop('_year', axis=1)
+                self._merge_partition(category, level, year, new_df, instruments, since)
+                cnt += 0 if new_df is None else new_df.shape[0]
+        return cnt
+
+    # 删除这些合约在该粒度的所有K线，用于ticks被删除、K线为空的合约
+    def delete(self, category, level, instruments):
+        instruments = list(instruments)
+        years = KlinePartitionDoc.objects(category=category, level=level, instruments__in=instruments).distinct('year')
+        for year in sorted(years):
+            self._merge_partition(category, level, year, None, instruments)
+
+    # 整个分区替换为df
+    def replace_partition(self, category, level, year, df):
+        with self._lock(category, level, year):
+            self._write_partition(category, level, year, df)
+
+    # 按(InstrumentID, TradingTime)修改已有K线的列，df中除这两列之外的列都写入，返回修改的K线数。
+    # 例如设置主力合约：kline_store.update_columns('AG', '1d', df[['InstrumentID', 'TradingTime', 'isDominant']])
+    def update_columns(self, category, level, df):
+        cols = [col for col in df.columns if col not in _KEYS]
+        df = df.drop_duplicates(_KEYS, keep='last')
+        cnt = 0
+        for year, _df in df.groupby(df['TradingTime'].dt.strftime('%Y'), sort=True):
+            with self._lock(category, level, year):
+                old_df = self._read_partition(category, level, year)
+                if old_df is None:
+                    continue
+                idx = pd.MultiIndex.from_frame(old_df[_KEYS])
+                pos = idx.get_indexer(pd.MultiIndex.from_frame(_df[_KEYS]))
+                found = pos >= 0
+                if not found.any():
+                    continue
+                for col in cols:
+                    if col not in old_df.columns:
+                        old_df[col] = _KEPT_COLUMNS.get(col)
+                    values = old_df[col].to_numpy(copy=True)
+                    values[pos[found]] = _df[col].to_numpy()[found]
+                    old_df[col] = values
+                self._write_partition(category, level, year, old_df)
+                cnt += int(found.sum())
+        return cnt
+
+    # since: {InstrumentID: TradingTime}，只删除这个时间之后的旧K线；None表示删除这些合约的所有旧K线
+    def _merge_partition(self, category, level, year, new_df, instruments, since=None):
+        with self._lock(category, level, year):
+            old_df = self._read_partition(category, level, year)
+            if old_df is not None:
+                stale = old_df['InstrumentID'].isin(instruments)
+                if since is not None:
+                    stale &= old_df['TradingTime'] >= old_df['InstrumentID'].map(since)
+                if new_df is not None:
+                    new_df = _keep_columns(new_df, old_df[stale])
+                old_df = old_df[~stale]
+            elif new_df is not None:
+                new_df = _keep_columns(new_df, None)
+            frames = [_df for _df in [old_df, new_df] if _df is not None and not _df.empty]
+            df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+            self._write_partition(category, level, year, df)
+
+    def _read_partition(self, category, level, year):
+        file = self.root / self._rel_file(category, level, year)
+        if not file.exists():
+            return None
+        return self.engine.read(file)
+
+    def _write_partition(self, category, level, year, df):
+        rel_file = self._rel_file(category, level, year)
+        file = self.root / rel_file
+        q_f = dict(category=category, level=level, year=str(year))
+        if df.empty:
+            file.unlink(missing_ok=True)
+            KlinePartitionDoc.objects(**q_f).delete()
+            return
+
+        df = df.sort_values(['InstrumentID', 'TradingTime'], kind='stable').reset_index(drop=True)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        self.engine.write(df, file)
+        KlinePartitionDoc.objects(**q_f).update_one(
+            upsert=True,
+            set__path=str(rel_file),
+            set__zip_ver=self.engine.ver,
+            set__rows=df.shape[0],
+            set__instruments=sorted(df['InstrumentID'].unique()),
+            set__start=df['TradingTime'].min().to_pydatetime(),
+            set__end=df['TradingTime'].max().to_pydatetime(),
+            set__update_time=datetime.datetime.now(),
+        )
+
+    # 同一分区的读-改-写加文件锁，多个进程之间也有效
+    @contextmanager
+    def _lock(self, category, level, year):
+        lock_file = self.root / self._rel_file(category, level, year).with_suffix('.lock')
+        lock_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(lock_file, 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    # 加载K线，按(InstrumentID, TradingTime)排序
+    #   - InstrumentIDs: 只加载这些合约，None表示所有合约
+    #   - start/end: 只加载`TradingTime`在[start, end]之间的K线
+    #   - columns: 只加载指定的列
+    def load(self, category, level, InstrumentIDs=None, start=None, end=None, columns=None):
+        q_f = dict(category=category, level=level)
+        if InstrumentIDs is not None:
+            q_f['instruments__in'] = list(InstrumentIDs)
+        if start is not None:
+            q_f['end__gte'] = pd.Timestamp(start).to_pydatetime()
+        if end is not None:
+            q_f['start__lte'] = pd.Timestamp(end).to_pydatetime()
+        parts = KlinePartitionDoc.objects(**q_f).only('year', 'path').order_by('year')
+
+        filters = []
+        if InstrumentIDs is not None:
+            filters.append(('InstrumentID', 'in', list(InstrumentIDs)))
+        if start is not None:
+            filters.append(('TradingTime', '>=', pd.Timestamp(start)))
+        if end is not None:
+            filters.append(('TradingTime', '<=', pd.Timestamp(end)))
+
+        frames = []
+        for part in parts:
+            file = self.root / part.path
+            if not file.exists():
+                logger.warning(f'Kline partition not exists: {part!r}')
+                continue
+            frames.append(pd.read_parquet(file, engine='pyarrow', columns=columns, filters=filters or None))
+        if not frames:
+            return pd.DataFrame()
+        df = pd.concat(frames, ignore_index=True)
+        if columns is None or {'InstrumentID', 'TradingTime'} <= set(columns):
+            df = df.sort_values(['InstrumentID', 'TradingTime'], kind='stable', ignore_index=True)
+        return df
+
+
+# `_KEPT_COLUMNS`中new_df没有的列，用被替换的K线(old_df)中同一(InstrumentID, TradingTime)的值，没有时用默认值
+def _keep_columns(new_df, old_df):
+    cols = [col for col in _KEPT_COLUMNS if col not in new_df.columns]
+    if not cols:
+        return new_df
+    new_df = new_df.copy()
+    keys = pd.MultiIndex.from_frame(new_df[_KEYS])
+    for col in cols:
+        default = _KEPT_COLUMNS[col]
+        if old_df is None or old_df.empty or col not in old_df.columns:
+            new_df[col] = default
+            continue
+        old = old_df.set_index(_KEYS)[col]
+        old = old[~old.index.duplicated(keep='last')]
+        values = old.reindex(keys)
+        new_df[col] = values.where(values.notna(), default).astype(type(default)).to_numpy()
+    return new_df
+
+
+kline_store = KlineStore(KLINE_PATH)
@@ -0,0 +1,124 @@
+import os
+import time
+import hashlib
+import logging
+from pathlib import Path
+from .conf import *
+from .storage import FeatherEngine, _filter_time, _select_columns
+
+__all__ = (
+        'LocalTickTier', 'local_tier',
+    )
+
+logger = logging.getLogger()
+
+_SRC_MTIME = b'src_mtime_ns'
+_SRC_SIZE = b'src_size'
+
+
+# 本地盘(NVMe)上的第二级缓存，存放最近读过的tick文件的解压副本。
+# 副本是不压缩的Arrow IPC文件，读取时memory map，不需要再解压。
+#   - 副本中记录了源文件的mtime/size，源文件变化后副本自动失效；
+#   - 每次命中都会更新副本的mtime，超出容量时按mtime淘汰最久没用的副本，淘汰到容量的`evict_ratio`；
+#   - 目录的总大小在内存中累计，只有超出容量或距上次扫描超过`scan_sec`秒(其它进程也会写入)时才扫描目录；
+#   - 写入时先写临时文件再rename，同一台机器上的多个进程可以共用一个目录。
+# 用法：
+#   local_tier.setup('/nvme/ticks_cache', 200 * 1024**3)
+class LocalTickTier():
+    suffix = '.arrow'
+    evict_ratio = 0.9
+    scan_sec = 60
+
+    def __init__(self, root=None, max_bytes=0):
+        self._engine = FeatherEngine(None, compression='uncompressed')
+        self.setup(root, max_bytes)
+
+    def setup(self, root, max_bytes):
+        self.root = Path(root) if root else None
+        self.max_bytes = max_bytes
+        self._total = None          # 目录的总大小(估计值)，None表示还没有扫描过
+        self._last_scan = 0
+
+    @property
+    def enabled(self):
+        return self.root is not None and self.max_bytes > 0
+
+    def _local_file(self, file):
+        key = hashlib.md5(str(file).encode()).hexdigest()
+        return self.root / key[:2] / f'{key}{self.suffix}'
+
+    # 加载文件，参数同`StorageEngine.read`。先查本地副本，没有或已失效时从源文件加载并生成副本。
+    # 没有命中时要解码整个源文件来生成副本，`columns`/`start`/`end`在解码之后才筛选，
+    # 所以第一次读取比直接读源文件慢，之后的读取只解码需要的部分。
+    def read(self, file, engine, columns=None, start=None, end=None):
+        if not self.enabled:
+            return engine.read(file, columns=columns, start=start, end=end)
+
+        stat = file.stat()
+        local_file = self._local_file(file)
+        if self._is_valid(local_file, stat):
+            try:
+                df = self._engine.read(local_file, columns=columns, start=start, end=end)
+                os.utime(local_file)
+                return df
+            except Exception:
+                logger.warning(f'Read local copy fail: {local_file}, load from {file}.', exc_info=1)
+
+        df = engine.read(file)
+        self._put(local_file, df, stat)
+        df = _filter_time(df, start, end)
+        if columns is not None:
+            df = df[_select_columns(df.columns, columns)]
+        return df
+
+    def _is_valid(self, local_file, stat):
+        try:
+            metadata = self._engine.read_metadata(local_file)
+        except Exception:       # 文件不存在或不完整
+            return False
+        return metadata.get(_SRC_MTIME) == str(stat.st_mtime_ns).encode() and metadata.get(_SRC_SIZE) == str(stat.st_size).encode()
+
+    def _put(self, local_file, df, stat):
+        metadata = {_SRC_MTIME: str(stat.st_mtime_ns), _SRC_SIZE: str(stat.st_size)}
+        try:
+            old_size = local_file.stat().st_size if local_file.exists() else 0
+            local_file.parent.mkdir(parents=True, exist_ok=True)
+            self._engine.write(df, local_file, metadata=metadata)      # 先写临时文件再rename
+            size = local_file.stat().st_size
+        except Exception:
+            logger.warning(f'Write local copy fail: {local_file}.', exc_info=1)
+            return
+        if self._total is not None:
+            self._total += size - old_size
+        if self._total is None or self._total > self.max_bytes or time.time() - self._last_scan >= self.scan_sec:
+            self.evict()
+
+    # 扫描目录，超出容量时删掉最久没用的副本，直到总大小不超过容量的`evict_ratio`
+    def evict(self):
+        files = []
+        total = 0
+        for _file in self.root.glob(f'*/*{self.suffix}'):
+            try:
+                stat = _file.stat()
+            except FileNotFoundError:       # 被其它进程删掉了
+                continue
+            files.append((stat.st_mtime, stat.st_size, _file))
+            total += stat.st_size
+
+        if total > self.max_bytes:
+            files.sort()
+            for _, size, _file in files:
+                if total <= self.max_bytes * self.evict_ratio:
+                    break
+                _file.unlink(missing_ok=True)
+                total -= size
+        self._total = total
+        self._last_scan = time.time()
+
+    def clear(self):
+        for _file in self.root.glob(f'*/*{self.suffix}'):
+            _file.unlink(missing_ok=True)
+        self._total = 0
+
+
+local_tier = LocalTickTier(LOCAL_TIER_PATH, LOCAL_TIER_BYTES)
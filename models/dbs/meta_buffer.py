@@ -0,0 +1,218 @@
+import time
+import atexit
+import datetime
+import logging
+import threading
+from mongoengine.connection import get_db
+from mongoengine.queryset.transform import update as _transform_update
+from .conf import *
+
+__all__ = (
+        'MetaUpdateBuffer', 'meta_buffer',
+    )
+
+logger = logging.getLogger()
+
+_MERGE_OPS = {'$set', '$unset', '$inc', '$addToSet', '$push'}
+
+
+# 元数据的写缓冲：按doc合并`update()`的修改，每`flush_docs`个doc或每`flush_sec`秒用无序的`bulk_write`写入一次。
+# 写入时机：
+#   - 调用`update()`/`add_raw()`时检查数量和时间；
+#   - `flush()`、`setup()`、`with`块结束(包括异常退出)、进程退出(atexit)。
+# `with meta_buffer.setup(...)`结束后恢复之前的设置(默认不缓冲)，之后的`update()`直接写入。
+# 写入失败时修改保留在缓冲中，下次flush重试；`bulk_write`部分失败时只保留失败的修改，成功的`$inc`/`$push`不会重复执行。
+# 进程崩溃时没有写入的修改会丢失：数据文件已经生成但doc没有`zip_path`，`csv_to_pickle()`会重新处理这类文件。
+# `update()`同时修改内存中的doc，不需要再`reload()`。
+# 多进程：子进程用`pop_pending()`取出修改返回给主进程，主进程用`add_raw()`加入自己的缓冲。
+#   - flush_docs: 0表示不缓冲，`update()`直接写入
+#   - on_flush: 写入后的回调，参数为写入的doc数
+# 用法：
+#   with meta_buffer.setup(500, 5):
+#       for doc in docs:
+#           doc.csv_to_pickle()
+class MetaUpdateBuffer():
+    def __init__(self, flush_docs=0, flush_sec=5, on_flush=None):
+        self._pending = {}      # (db_alias, collection, pk) -> raw update
+        self._lock = threading.RLock()
+        self.flush_docs, self.flush_sec, self.on_flush = flush_docs, flush_sec, on_flush
+        self.setup(flush_docs, flush_sec, on_flush)
+
+    # 修改设置，之前缓冲的修改先用之前的设置写入。
+    # 返回的对象可以用于`with`，块结束后flush并恢复这次修改之前的设置。
+    def setup(self, flush_docs, flush_sec=5, on_flush=None):
+        with self._lock:
+            self.flush()
+            prev = (self.flush_docs, self.flush_sec, self.on_flush)
+            self._apply(flush_docs, flush_sec, on_flush)
+        return _SetupContext(self, prev)
+
+    def _apply(self, flush_docs, flush_sec, on_flush):
+        self.flush_docs = flush_docs
+        self.flush_sec = flush_sec
+        self.on_flush = on_flush
+        self._last_flush = time.time()
+
+    @property
+    def enabled(self):
+        return self.flush_docs > 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    # 参数同`Document.update()`
+    def update(self, doc, **kwargs):
+        if 'update_time' in doc._fields:
+            kwargs.setdefault('set__update_time', datetime.datetime.now())
+        if not self.enabled:
+            doc.update(**kwargs)
+        else:
+            key = (doc._meta.get('db_alias', 'default'), doc._get_collection_name(), doc.pk)
+            self.add_raw([(key, _transform_update(doc.__class__, **kwargs))])
+        _apply_local(doc, kwargs)
+
+    # 加入原始修改：[((db_alias, collection, pk), raw_update)]
+    def add_raw(self, items):
+        with self._lock:
+            for key, raw in items:
+                pending = self._pending.get(key)
+                if pending is None:
+                    self._pending[key] = _copy_raw(raw)
+                elif not _merge_raw(pending, raw):      # 不能合并的修改，先写入之前的
+                    self.flush()
+                    self._pending[key] = _copy_raw(raw)
+            if not self.enabled or len(self._pending) >= self.flush_docs or time.time() - self._last_flush >= self.flush_sec:
+                self.flush()
+
+    # 取出还没写入的修改
+    def pop_pending(self):
+        with self._lock:
+            items = list(self._pending.items())
+            self._pending.clear()
+        return items
+
+    def flush(self):
+        with self._lock:
+            self._last_flush = time.time()
+            if not self._pending:
+                return 0
+            from pymongo import UpdateOne
+            from pymongo.errors import BulkWriteError
+            groups = {}
+            for (alias, collection, pk), raw in self._pending.items():
+                groups.setdefault((alias, collection), []).append((pk, raw))
+
+            for (alias, collection), items in groups.items():
+                ops = [UpdateOne({'_id': pk}, raw) for pk, raw in items]
+                try:
+                    get_db(alias)[collection].bulk_write(ops, ordered=False)
+                except BulkWriteError as e:
+                    # 已经成功的修改不能保留，`$inc`/`$push`重复执行结果会变；只保留失败的修改，下次重试
+                    failed = {err['index'] for err in e.details.get('writeErrors', [])}
+                    for i, (pk, _) in enumerate(items):
+                        if i not in failed:
+                            self._pending.pop((alias, collection, pk), None)
+                    raise
+                for pk, _ in items:
+                    self._pending.pop((alias, collection, pk), None)
+                logger.debug(f'[meta_buffer]: flush {len(ops)} docs to {collection}.')
+                if self.on_flush is not None:
+                    self.on_flush(len(ops))
+            return sum(len(items) for items in groups.values())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+
+# `with meta_buffer.setup(...)`：进入时返回buffer，结束时(包括异常退出)flush并恢复`setup()`之前的设置
+class _SetupContext():
+    def __init__(self, buffer, prev):
+        self.buffer = buffer
+        self.prev = prev
+
+    def __enter__(self):
+        return self.buffer
+
+    def __exit__(self, exc_type, exc, tb):
+        with self.buffer._lock:
+            try:
+                self.buffer.flush()
+            finally:
+                self.buffer._apply(*self.prev)
+
+
+# 合并两个原始修改，有冲突(同一个字段的不同操作)时返回False
+def _merge_raw(dst, src):
+    if any(op not in _MERGE_OPS for op in set(dst) | set(src)):
+        return False
+    dst_fields = {field: op for op, fields in dst.items() for field in fields}
+    for op, fields in src.items():
+        for field in fields:
+            _op = dst_fields.get(field)
+            if _op is not None and _op != op and {_op, op} != {'$set', '$unset'}:
+                return False
+
+    for op, fields in src.items():
+        cur = dst.setdefault(op, {})
+        for field, value in fields.items():
+            if op == '$set':
+                dst.get('$unset', {}).pop(field, None)
+                cur[field] = value
+            elif op == '$unset':
+                dst.get('$set', {}).pop(field, None)
+                cur[field] = value
+            elif field not in cur:
+                cur[field] = value
+            elif op == '$inc':
+                cur[field] += value
+            else:       # $addToSet/$push
+                cur[field] = {'$each': _each(cur[field]) + _each(value)}
+    for op in [op for op, fields in dst.items() if not fields]:
+        del dst[op]
+    return True
+
+
+def _each(value):
+    if isinstance(value, dict) and '$each' in value:
+        return list(value['$each'])
+    return [value]
+
+
+def _copy_raw(raw):
+    return {op: dict(fields) for op, fields in raw.items()}
+
+
+# 把修改同步到内存中的doc，只处理顶层字段
+def _apply_local(doc, kwargs):
+    for key, value in kwargs.items():
+        op, _, field = key.partition('__')
+        if '__' in field or field not in doc._fields:
+            continue
+        if op == 'set':
+            setattr(doc, field, value)
+        elif op == 'unset':
+            setattr(doc, field, None)
+        elif op == 'inc':
+            setattr(doc, field, (getattr(doc, field) or 0) + value)
+        elif op in ['add_to_set', 'push']:
+            values = list(getattr(doc, field) or [])
+            if op == 'push' or value not in values:
+                values.append(value)
+            setattr(doc, field, values)
+        elif op == 'pull':
+            setattr(doc, field, [v for v in (getattr(doc, field) or []) if v != value])
+    doc._clear_changed_fields()
+
+
+def _flush_at_exit():
+    try:
+        meta_buffer.flush()
+    except Exception:
+        logger.error(f'[meta_buffer]: flush at exit fail, {len(meta_buffer)} docs are not updated.', exc_info=1)
+
+
+meta_buffer = MetaUpdateBuffer(META_FLUSH_DOCS, META_FLUSH_SEC)
+atexit.register(_flush_at_exit)
@@ -0,0 +1,180 @@
+import logging
+import pandas as pd
+from .conf import *
+
+__all__ = (
+        'RAW_CSV_COLUMNS', 'RAW_CSV_COLUMNS_NO_MAIN', 'get_raw_columns', 'read_raw_csv', 'iter_raw_csv', 'wash_raw_df',
+    )
+
+logger = logging.getLogger()
+
+
+# 原始csv文件的所有列
+RAW_CSV_COLUMNS = [
+    'InstrumentID', 'MarketID', 'LastPrice', 'LastVolume', 'hhmmss', 'Reserved', 'UpdateTime', 'AskPrice1',
+    'AskVolume1', 'BidPrice1', 'BidVolume1', 'AskPrice2', 'AskVolume2', 'BidPrice2', 'BidVolume2',
+    'AskPrice3', 'AskVolume3', 'BidPrice3', 'BidVolume3', 'AskPrice4', 'AskVolume4', 'BidPrice4', 'BidVolume4',
+    'AskPrice5', 'AskVolume5', 'BidPrice5', 'BidVolume5', 'OpenInterest', 'Turnover', 'AvePrice', 'invol', 'outvol',
+    'Attr1', 'Volume1', 'Attr2', 'Volume2', 'HighestPrice', 'LowestPrice', 'SettlePrice', 'OpenPrice', 'mainID', 'fill',
+]
+# 没有`mainID`的41列格式，`import_to_db.py`导入的文件是这种格式
+RAW_CSV_COLUMNS_NO_MAIN = [col for col in RAW_CSV_COLUMNS if col != 'mainID']
+
+# 需要保留的列的类型
+RAW_CSV_DTYPES = {
+    'InstrumentID': 'str',
+    'MarketID': 'int64',
+    'LastPrice': 'float64',
+    'LastVolume': 'int64',
+    'hhmmss': 'str',
+    'UpdateTime': 'datetime64[ns]',
+    **{f'AskPrice{i}': 'float64' for i in range(1, 6)},
+    **{f'AskVolume{i}': 'int64' for i in range(1, 6)},
+    **{f'BidPrice{i}': 'float64' for i in range(1, 6)},
+    **{f'BidVolume{i}': 'int64' for i in range(1, 6)},
+    'OpenInterest': 'int64',
+    'Turnover': 'float64',
+    'AvePrice': 'float64',
+    'HighestPrice': 'float64',
+    'LowestPrice': 'float64',
+    'OpenPrice': 'float64',
+    'mainID': 'str',
+}
+
+RAW_TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+_RAW_ROW_BYTES = 256        # 原始文件每行的大致字节数，用于估算pyarrow分块读取的block_size
+
+_LEVEL1_COLS = ['AskPrice1', 'AskVolume1', 'BidPrice1', 'BidVolume1']
+_LEVEL5_COLS = [f'{side}{field}{i}' for i in range(2, 6) for side in ['Ask', 'Bid'] for field in ['Price', 'Volume']]
+_STAT_COLS = ['HighestPrice', 'LowestPrice', 'OpenPrice', 'Turnover', 'AvePrice']
+
+
+# 按数据类型返回需要保留的列(按原始文件中的顺序)：
+#   - 只有中金所(MarketID=3)有五档数据，其余只有一档；
+#   - 9999(主力)多一个`mainID`；
+#   - 0000(指数)没有最高/最低/开盘价、成交额、均价。
+#   - full: 保留所有列(类型未声明的列自动推断)
+def get_raw_columns(MarketID, subID, full=False):
+    if full:
+        return list(RAW_CSV_COLUMNS)
+    cols = ['InstrumentID', 'MarketID', 'LastPrice', 'LastVolume', 'hhmmss', 'UpdateTime', *_LEVEL1_COLS, 'OpenInterest', *_STAT_COLS]
+    if MarketID == 3:
+        cols += _LEVEL5_COLS
+    if subID == '9999':
+        cols += ['mainID']
+    elif subID == '0000':
+        cols = [col for col in cols if col not in _STAT_COLS]
+    cols = set(cols)
+    return [col for col in RAW_CSV_COLUMNS if col in cols]
+
+
+# 加载原始csv，只解析`columns`中的列，使用固定的类型和时间格式。
+#   - source: 文件路径或file-like对象
+#   - skip_bad_lines: 跳过列数不对的行
+#   - names: 文件中所有列的列名，见`RAW_CSV_COLUMNS`/`RAW_CSV_COLUMNS_NO_MAIN`，`columns`中不在其中的列忽略
+# 优先使用pyarrow的多线程csv解析，类型不符等情况再用pandas解析；pandas按固定类型解析失败时，退回到自动推断类型。
+# 时间解析失败的值为NaT，会在`wash_raw_df()`中删掉。
+def read_raw_csv(source, columns, skip_bad_lines=False, names=RAW_CSV_COLUMNS):
+    columns = [col for col in columns if col in names]
+    try:
+        return _read_csv_arrow(source, columns, names)
+    except ImportError:
+        pass
+    except Exception as e:
+        logger.info(f'[{source}]: read csv by pyarrow fail, use pandas instead: {e!r}')
+    if hasattr(source, 'seek'):
+        source.seek(0)
+
+    kwargs = dict(names=names, usecols=columns, low_memory=False, on_bad_lines='skip' if skip_bad_lines else 'error')
+    try:
+        dtype = {col: RAW_CSV_DTYPES[col] for col in columns if col in RAW_CSV_DTYPES and col != 'UpdateTime'}
+        df = pd.read_csv(source, dtype={**dtype, 'UpdateTime': 'str'}, **kwargs)
+    except (ValueError, TypeError, OverflowError):
+        if hasattr(source, 'seek'):
+            source.seek(0)
+        df = pd.read_csv(source, dtype={'hhmmss': 'str', 'UpdateTime': 'str'}, **kwargs)
+    df['UpdateTime'] = _parse_time(df['UpdateTime'])
+    return df
+
+
+# 分块加载原始csv，每次返回(df, 原始行数)，参数同`read_raw_csv()`。
+# 每块大约`chunk_rows`行，index是行在文件中的序号。
+# 只按固定的类型解析，类型不符或有列数不对的行时抛出异常，由调用方决定是否整个文件重新加载。
+def iter_raw_csv(source, columns, chunk_rows, skip_bad_lines=False):
+    try:
+        from pyarrow import csv
+    except ImportError:
+        csv = None
+    if csv is not None:
+        yield from _iter_csv_arrow(source, columns, chunk_rows, skip_bad_lines)
+        return
+
+    dtype = {col: RAW_CSV_DTYPES[col] for col in columns if col in RAW_CSV_DTYPES and col != 'UpdateTime'}
+    with pd.read_csv(source, names=RAW_CSV_COLUMNS, usecols=columns, dtype={**dtype, 'UpdateTime': 'str'},
+                     chunksize=chunk_rows, on_bad_lines='skip' if skip_bad_lines else 'error') as reader:
+        for df in reader:
+            line_num = df.shape[0]
+            df['UpdateTime'] = _parse_time(df['UpdateTime'])
+            yield df, line_num
+
+
+def _iter_csv_arrow(source, columns, chunk_rows, skip_bad_lines):
+    from pyarrow import csv
+
+    # 不能在回调里抛异常，返回'error'由pyarrow报错(ArrowInvalid是ValueError的子类)
+    def _on_bad_line(row):
+        return 'skip' if skip_bad_lines else 'error'
+
+    reader = csv.open_csv(
+                source,
+                read_options=csv.ReadOptions(column_names=RAW_CSV_COLUMNS, block_size=max(chunk_rows * _RAW_ROW_BYTES, 1 << 20)),
+                parse_options=csv.ParseOptions(invalid_row_handler=_on_bad_line),
+                convert_options=csv.ConvertOptions(include_columns=columns, column_types=_arrow_types(columns)),
+            )
+    offset = 0
+    for batch in reader:
+        df = batch.to_pandas()
+        df.index = pd.RangeIndex(offset, offset + df.shape[0])
+        offset += df.shape[0]
+        yield df, df.shape[0]
+
+
+def _arrow_types(columns):
+    import pyarrow as pa
+    types = dict(str=pa.string(), int64=pa.int64(), float64=pa.float64())
+    return {col: types.get(RAW_CSV_DTYPES[col], pa.timestamp('ns')) for col in columns if col in RAW_CSV_DTYPES}
+
+
+def _read_csv_arrow(source, columns, names):
+    from pyarrow import csv
+
+    bad_lines = []
+    def _on_bad_line(row):
+        bad_lines.append(row.number)
+        return 'skip'
+
+    table = csv.read_csv(
+                source,
+                read_options=csv.ReadOptions(column_names=names, use_threads=True),
+                parse_options=csv.ParseOptions(invalid_row_handler=_on_bad_line),
+                convert_options=csv.ConvertOptions(include_columns=columns, column_types=_arrow_types(columns)),
+            )
+    # 列数不对的文件交给pandas处理，和以前的行为保持一致
+    if bad_lines:
+        raise ValueError(f'{len(bad_lines)} bad lines, first at line {bad_lines[0]}.')
+    return table.to_pandas()
+
+
+def _parse_time(s):
+    res = pd.to_datetime(s, format=RAW_TIME_FORMAT, errors='coerce')
+    retry = res.isna() & s.notna()
+    if retry.any():     # 没有毫秒等其它格式
+        res[retry] = pd.to_datetime(s[retry], errors='coerce')
+    return res
+
+
+# 清洗：删掉时间不在[MIN_DATE, MAX_DATE]之间和成交量为负的数据
+def wash_raw_df(df):
+    df = df[(df.UpdateTime < MAX_DATE) & (df.UpdateTime > MIN_DATE)]
+    df = df[df.LastVolume >= 0]
+    return df
@@ -0,0 +1,123 @@
+import datetime
+import numpy as np
+import pandas as pd
+
+__all__ = (
+        'TIME_PERIODS', 'TRADING_SESSIONS', 'calc_time_type', 'calc_session_bins', 'calc_trading_day_start', 'SPLIT_PERIODS', 'calc_split_code', 'calc_trading_day',
+    )
+
+
+# 将日夜盘交易时间拉会到同一天处理：
+#    09:00:00 -> 05:40:00
+#    10:15:00 -> 06:55:00
+#    10:30:00 -> 07:10:00
+#    11:30:00 -> 08:10:00
+#    13:30:00 -> 10:10:00
+#    15:00:00 -> 11:40:00
+#    21:00:00 -> 17:40:00
+#    02:30:00 -> 23:10:00
+TIME_DELAY = datetime.timedelta(hours=-3, minutes=-20)
+TIME_PERIODS = dict(
+    fam=(4, 6),     # 05:40:00 <= _ <= 06:55:00,    4 <= _ <= 6
+    bam=(7, 8),     # 07:10:00 <= _ <= 08:10:00,    7 <= _ <= 8
+    pm=(9, 14),     # 10:10:00 <= _ <= 11:40:00,    9 <= _ <= 14
+    night=(15, 24), # 17:40:00 <= _ <= 23:10:00,   15 <= _ <= 24
+)
+
+
+# 交易时段的开盘、收盘时间，时段名同`TIME_PERIODS`。K线只在时段内生成，并且从开盘时间开始划分，见`calc_session_bins()`。
+# 夜盘按收盘最晚的品种，收盘早的品种只是没有后面的K线。
+TRADING_SESSIONS = dict(
+    fam  =('09:00', '10:15'),
+    bam  =('10:30', '11:30'),
+    pm   =('13:30', '15:00'),
+    night=('21:00', '02:30'),
+)
+
+
+# 计算每行所属的交易时段(`time_type`)，不在任何时段内的为'unknow'
+def calc_time_type(update_time):
+    codes = _calc_time_code(update_time)
+    time_type = np.select([codes == i for i in range(len(TIME_PERIODS))], list(TIME_PERIODS), default='unknow').astype(object)
+    return pd.Series(time_type, index=update_time.index)
+
+
+# 交易时段的序号(`TIME_PERIODS`中的顺序)，不在任何时段内的为-1
+def _calc_time_code(update_time):
+    values = np.asarray(update_time, dtype='datetime64[ns]') + np.timedelta64(TIME_DELAY)
+    hour = (values - values.astype('datetime64[D]')) // np.timedelta64(1, 'h')
+    conds = [(hour >= _start) & (hour <= _end) for _start, _end in TIME_PERIODS.values()]
+    return np.select(conds, np.arange(len(conds), dtype='int8'), default=-1).astype('int8')
+
+
+# 按交易时段计算每个时间所属的K线，返回(时段序号, K线起始时间)，都是numpy数组：
+#   - 时段由`TIME_PERIODS`确定(和tick的`time_type`一致)，K线从`TRADING_SESSIONS`的开盘时间开始按`level`划分，
+#     不跨时段，时段最后一根K线可能不完整(如'1H'的fam：09:00、10:00)；
+#   - 开盘前(集合竞价)的数据归到第一根K线，收盘之后的归到最后一根；不在任何时段内的K线起始时间为NaT；
+#   - level='1d'时返回交易日(夜盘归到下一个工作日)。
+def calc_session_bins(update_time, level):
+    values = np.asarray(update_time, dtype='datetime64[ns]')
+    codes = _calc_time_code(values)
+    day = (values + np.timedelta64(TIME_DELAY)).astype('datetime64[D]')
+    if level == '1d':
+        night = codes == list(TIME_PERIODS).index('night')
+        bins = np.where(night, np.busday_offset(day, 1, roll='forward'), day).astype('datetime64[ns]')
+    else:
+        freq = pd.Timedelta(level.replace('H', 'h')).to_timedelta64()
+        opens, lengths = _session_offsets()
+        _codes = np.where(codes >= 0, codes, 0)
+        _open = day + opens[_codes]
+        offset = np.clip(values - _open, np.timedelta64(0, 'ns'), lengths[_codes] - np.timedelta64(1, 'ns'))
+        bins = _open + offset // freq * freq
+    bins[codes < 0] = np.datetime64('NaT')
+    return codes, bins
+
+
+# 交易日(`calc_session_bins()`的'1d')开始的时间：属于这个交易日的最早的夜盘时段(`TIME_PERIODS['night']`)的开始。
+# 夜盘属于下一个工作日，周末的夜盘先滚动到周一再加一天，所以从前两个工作日的第二天开始。
+# 从这个时间开始加载ticks，就能完整地重新计算这个交易日及之后的所有K线。
+def calc_trading_day_start(day):
+    first_night = np.busday_offset(np.asarray(day, dtype='datetime64[D]'), -2, roll='forward') + np.timedelta64(1, 'D')
+    return first_night + np.timedelta64(TIME_PERIODS['night'][0], 'h') - np.timedelta64(TIME_DELAY)
+
+
+# `TRADING_SESSIONS`转为`TIME_PERIODS`的顺序：(开盘时间相对当天0点的偏移, 时段长度)
+def _session_offsets():
+    opens, lengths = [], []
+    for name in TIME_PERIODS:
+        _open, _close = [pd.Timedelta(f'{_t}:00').to_timedelta64().astype('timedelta64[ns]') for _t in TRADING_SESSIONS[name]]
+        opens.append(_open)
+        lengths.append((_close - _open) % np.timedelta64(1, 'D'))
+    return np.array(opens), np.array(lengths)
+
+
+# 切分文件(`save_splited()`)用的交易时段，两端都包含，night跨过0点：
+#   fam: 09:00 - 10:15, 1:15, 75' ,  ticks=9000
+#   bam: 10:30 - 11:30, 1:00, 60' ,  ticks=7200
+#    pm: 13:30 - 15:00, 1:30, 90' ,  ticks=10800
+# night: 21:00 - 02:30, 5:00, 300',  ticks=36000
+SPLIT_PERIODS = dict(
+    fam  =('09:00', '10:15'),
+    bam  =('10:30', '11:30'),
+    pm   =('13:00', '15:01'),
+    night=('21:00', '03:00'),
+)
+
+
+# 计算每行所属的切分时段，返回`SPLIT_PERIODS`中的序号(int8)，不在任何时段内的为-1
+def calc_split_code(update_time):
+    values = update_time.to_numpy(dtype='datetime64[ns]')
+    tod = values - values.astype('datetime64[D]')           # 当天的时间
+    conds = []
+    for _start, _end in SPLIT_PERIODS.values():
+        _start, _end = pd.Timedelta(f'{_start}:00').to_timedelta64(), pd.Timedelta(f'{_end}:00').to_timedelta64()
+        if _start <= _end:
+            conds.append((tod >= _start) & (tod <= _end))
+        else:
+            conds.append((tod >= _start) | (tod <= _end))
+    return np.select(conds, np.arange(len(conds), dtype='int8'), default=-1).astype('int8')
+
+
+# 计算每行所属的日期(datetime64[D])，按`TIME_DELAY`平移，0点之后的夜盘归到前一天
+def calc_trading_day(update_time):
+    return (update_time.to_numpy(dtype='datetime64[ns]') + np.timedelta64(TIME_DELAY)).astype('datetime64[D]')
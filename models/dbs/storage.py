@@ -0,0 +1,313 @@
+import os
+import json
+import logging
+import time
+import threading
+from abc import ABC, abstractmethod
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from .conf import *
+
+__all__ = (
+        'StorageEngine', 'get_engine', 'get_storage_ver', 'sweep_tmp_files',
+    )
+
+logger = logging.getLogger()
+
+
+class StorageException(Exception):
+    pass
+
+
+# tick文件的存储引擎，每个引擎对应一个`zip_ver`。
+# 文件用哪个引擎读写由doc上的`zip_ver`决定，所以不同格式的文件可以同时存在。
+# 提供的方法有：
+#   - write(df, file)
+#   - read(file, columns=None, start=None, end=None):
+#     `columns`只加载指定的列，文件中不存在的列忽略；
+#     `start`/`end`只返回`UpdateTime`在[start, end]之间的行，这时返回的index从0开始；
+#     列式存储(parquet/feather)只解码需要的列，并按每个row group/record batch的时间范围跳过不需要的行，
+#     pickle只能全部加载后再筛选。
+#   - open_writer(file): 分块追加写入，只有`appendable`的引擎支持
+# 写入都是先写临时文件再rename，进程被杀掉时不会留下不完整的文件。子类实现`_write()`和`read()`。
+class StorageEngine(ABC):
+    ver = None
+    suffix = None
+    appendable = False
+
+    def write(self, df, file, **kwargs):
+        file = Path(file)
+        tmp_file = _tmp_file(file)
+        try:
+            self._write(df, tmp_file, **kwargs)
+            os.replace(tmp_file, file)
+        except BaseException:
+            tmp_file.unlink(missing_ok=True)
+            raise
+
+    @abstractmethod
+    def _write(self, df, file):
+        pass
+
+    def open_writer(self, file):
+        raise StorageException(f'{self!r} does not support appending.')
+
+    @abstractmethod
+    def read(self, file, columns=None, start=None, end=None):
+        pass
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(ver={self.ver}, suffix={self.suffix})'
+
+
+# 原有的pickle + zip格式
+class PickleZipEngine(StorageEngine):
+    ver = STORAGE_VER_PICKLE_ZIP
+    suffix = '.pkl'
+
+    def _write(self, df, file):
+        df.to_pickle(file, compression=PICKLE_COMPRESSION)
+
+    def read(self, file, columns=None, start=None, end=None):
+        df = pd.read_pickle(file, compression=PICKLE_COMPRESSION)
+        df = _filter_time(df, start, end)
+        if columns is not None:
+            df = df[_select_columns(df.columns, columns)]
+        return df
+
+
+# parquet格式，依赖pyarrow
+class ParquetEngine(StorageEngine):
+    suffix = '.parquet'
+    appendable = True
+
+    def __init__(self, ver, compression):
+        self.ver = ver
+        self.compression = compression
+
+    def _write(self, df, file):
+        df.to_parquet(file, engine='pyarrow', compression=self.compression, row_group_size=STORAGE_CHUNK_ROWS)
+
+    # parquet的row group带有min/max统计，pyarrow用`filters`跳过不在范围内的row group
+    def read(self, file, columns=None, start=None, end=None):
+        if columns is not None:
+            from pyarrow import parquet
+            columns = _select_columns(parquet.read_schema(file).names, columns)
+        filters = []
+        if start is not None:
+            filters.append(('UpdateTime', '>=', pd.Timestamp(start)))
+        if end is not None:
+            filters.append(('UpdateTime', '<=', pd.Timestamp(end)))
+        df = pd.read_parquet(file, engine='pyarrow', columns=columns, filters=filters or None)
+        return df.reset_index(drop=True) if filters else df
+
+    def open_writer(self, file):
+        return ParquetChunkWriter(file, self.compression)
+
+
+# 分块写入parquet，依次调用`write(df)`，最后`commit()`或`abort()`。
+#   - 每块的列和类型必须和第一块一致，否则抛出异常；
+#   - 先写到临时文件，commit时再rename，中途失败不会留下不完整的文件。
+# 用法：
+#   with engine.open_writer(file) as writer:
+#       for df in chunks:
+#           writer.write(df)
+class ParquetChunkWriter():
+    def __init__(self, file, compression):
+        self.file = Path(file)
+        self.tmp_file = _tmp_file(self.file)
+        self.compression = compression
+        self.schema = None
+        self.rows = 0
+        self._writer = None
+
+    def write(self, df):
+        import pyarrow as pa
+        from pyarrow import parquet
+        if self._writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=True)
+            self.schema = table.schema
+            self._writer = parquet.ParquetWriter(self.tmp_file, self.schema, compression=self.compression)
+        else:
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=True)
+        self._writer.write_table(table, row_group_size=STORAGE_CHUNK_ROWS)
+        self.rows += df.shape[0]
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def commit(self):
+        self._close()
+        os.replace(self.tmp_file, self.file)
+
+    def abort(self):
+        try:
+            self._close()
+        finally:
+            self.tmp_file.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+# feather(Arrow IPC)格式，依赖pyarrow。
+# 直接用pyarrow读写，这样可以保留非默认的index。
+# 按`STORAGE_CHUNK_ROWS`分成多个record batch，每个batch的`UpdateTime`范围存在schema的metadata中(`time_index`)，
+# 按时间范围读取时只解码相关的batch。
+class FeatherEngine(StorageEngine):
+    suffix = '.feather'
+
+    def __init__(self, ver, compression='lz4'):
+        self.ver = ver
+        self.compression = compression
+
+    # `metadata`: 额外写入schema的信息，用`read_metadata()`读取
+    def _write(self, df, file, metadata=None):
+        import pyarrow as pa
+        from pyarrow import feather
+        table = pa.Table.from_pandas(df)
+        _metadata = {**(table.schema.metadata or {}), **(metadata or {})}
+        if 'UpdateTime' in df.columns:
+            _metadata[b'time_index'] = json.dumps(_calc_time_index(df['UpdateTime']))
+        table = table.replace_schema_metadata(_metadata)
+        feather.write_feather(table, file, compression=self.compression, chunksize=STORAGE_CHUNK_ROWS)
+
+    def read_metadata(self, file):
+        import pyarrow as pa
+        with pa.memory_map(str(file)) as source:
+            return pa.ipc.open_file(source).schema.metadata or {}
+
+    def read(self, file, columns=None, start=None, end=None):
+        import pyarrow as pa
+        with pa.memory_map(str(file)) as source:
+            schema = pa.ipc.open_file(source).schema
+            options = None
+            if columns is not None:
+                # index列也要加载
+                _columns = _select_columns(schema.names, _with_time_column(columns, start, end))
+                _columns += [name for name in schema.names if name.startswith('__index_level_')]
+                options = pa.ipc.IpcReadOptions(included_fields=[schema.get_field_index(name) for name in _columns])
+            reader = pa.ipc.open_file(source, options=options)
+
+            batches = range(reader.num_record_batches)
+            time_index = (schema.metadata or {}).get(b'time_index')
+            if time_index is not None and (start is not None or end is not None):
+                batches = _select_batches(json.loads(time_index), start, end)
+            table = pa.Table.from_batches([reader.get_batch(i) for i in batches], schema=reader.schema)
+            df = table.to_pandas()
+
+        df = _filter_time(df, start, end)
+        if columns is not None:
+            df = df[_select_columns(df.columns, columns)]
+        return df
+
+
+# 同一目录下的临时文件，加上进程和线程号，多个进程/线程同时写同一个文件时互不影响
+def _tmp_file(file):
+    return file.with_name(f'.{file.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+
+
+# 清理`file`旁边遗留的临时文件(写入进程被SIGKILL时来不及删除)，返回清理的个数。
+# 文件名中的进程已经不存在、并且超过`STALE_TMP_SEC`秒没有修改的才删除，不影响正在写入的进程(包括其它机器上的)。
+# 所有存储格式的临时文件都清理，`zip_ver`变化后文件名的后缀也会变。
+def sweep_tmp_files(file):
+    file = Path(file)
+    cnt = 0
+    for tmp_file in file.parent.glob(f'.{file.stem}.*.tmp'):
+        try:
+            pid = int(tmp_file.name.split('.')[-3])
+            if _pid_alive(pid) or time.time() - tmp_file.stat().st_mtime < STALE_TMP_SEC:
+                continue
+            tmp_file.unlink()
+        except (ValueError, IndexError, FileNotFoundError):     # 不是`_tmp_file()`的文件名，或者已经被删掉了
+            continue
+        logger.info(f'Remove stale tmp file: {tmp_file}')
+        cnt += 1
+    return cnt
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:     # 其它用户的进程
+        return True
+    return True
+
+
+# 按`columns`的顺序返回文件中存在的列
+def _select_columns(names, columns):
+    names = set(names)
+    return [col for col in columns if col in names]
+
+
+# 按时间筛选时需要加载`UpdateTime`
+def _with_time_column(columns, start, end):
+    if (start is not None or end is not None) and 'UpdateTime' not in columns:
+        return ['UpdateTime', *columns]
+    return columns
+
+
+# 按时间筛选之后的index重新从0开始，各个引擎的结果一致(feather只加载部分batch时原来的index已经不对了)
+def _filter_time(df, start, end):
+    if start is None and end is None:
+        return df
+    if start is not None:
+        df = df[df['UpdateTime'] >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df['UpdateTime'] <= pd.Timestamp(end)]
+    return df.reset_index(drop=True)
+
+
+# 每`STORAGE_CHUNK_ROWS`行的[min, max]，单位ns
+def _calc_time_index(update_time):
+    values = update_time.values.astype('datetime64[ns]').view('i8')
+    time_index = []
+    for i in range(0, len(values), STORAGE_CHUNK_ROWS):
+        chunk = values[i:i+STORAGE_CHUNK_ROWS]
+        time_index.append([int(chunk.min()), int(chunk.max())])
+    return time_index
+
+
+# 和[start, end]有交集的batch
+def _select_batches(time_index, start, end):
+    time_index = np.asarray(time_index, dtype='i8').reshape(-1, 2)
+    mask = np.ones(len(time_index), dtype=bool)
+    if start is not None:
+        mask &= time_index[:, 1] >= pd.Timestamp(start).value
+    if end is not None:
+        mask &= time_index[:, 0] <= pd.Timestamp(end).value
+    return np.flatnonzero(mask).tolist()
+
+
+_engines = {
+    STORAGE_VER_PICKLE_ZIP: PickleZipEngine(),
+    STORAGE_VER_PARQUET_ZSTD: ParquetEngine(STORAGE_VER_PARQUET_ZSTD, 'zstd'),
+    STORAGE_VER_PARQUET_SNAPPY: ParquetEngine(STORAGE_VER_PARQUET_SNAPPY, 'snappy'),
+    STORAGE_VER_FEATHER: FeatherEngine(STORAGE_VER_FEATHER),
+}
+
+
+# 根据`zip_ver`获取存储引擎
+def get_engine(zip_ver=None):
+    if zip_ver is None:
+        zip_ver = DEFAULT_STORAGE_VER
+    try:
+        return _engines[zip_ver]
+    except KeyError:
+        raise StorageException(f'Unknown zip_ver={zip_ver}.')
+
+
+# 新生成的文件使用的存储格式
+def get_storage_ver(category=None):
+    return CATEGORY_STORAGE_VER.get(category, DEFAULT_STORAGE_VER)
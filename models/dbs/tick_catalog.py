@@ -0,0 +1,171 @@
+import os
+import datetime
+import logging
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from bson import ObjectId
+from mongoengine import Q
+from .conf import *
+from .tick_file_doc import TickFilesDoc, MAIN_FILTER, SUB_MAIN_FILTER
+
+__all__ = (
+        'TickCatalog',
+    )
+
+logger = logging.getLogger()
+
+_LIST_FIELDS = ['tags']
+_REFRESH_TIME = b'refresh_time'
+_REFRESH_MARGIN = datetime.timedelta(minutes=5)     # 增量刷新时多查一段时间，避免多台机器时钟不一致时漏数据
+
+
+class CatalogException(Exception):
+    pass
+
+
+# `TickFilesDoc`的本地快照，保存为parquet文件。
+# 选择文件时用DataFrame的向量化过滤代替Mongo查询，Mongo不可用时也能加载数据。
+#   - refresh(): 从Mongo导出。增量刷新只查询新增(`_id`更大)和`update_time`在上次刷新之后的doc；
+#                Mongo中删掉的doc不会同步，需要`refresh(full=True)`。
+#   - query(main_cls='main', **q_f): 支持的条件同mongoengine：`field`, `field__ne/in/nin/gt/gte/lt/lte/exists`
+#   - to_docs(df): 把查询结果转为`TickFilesDoc`，不访问Mongo
+# 用法：
+#   catalog = TickCatalog()
+#   catalog.refresh()
+#   ticks = PickleDbTicks(dict(InstrumentID='AG9999'), catalog=catalog)
+class TickCatalog():
+    def __init__(self, path=None):
+        self.path = Path(path or CATALOG_PATH)
+        self.df = None
+        self.refresh_time = None
+
+    def load(self):
+        if self.df is None:
+            if not self.path.exists():
+                raise CatalogException(f'Catalog not exists: {self.path}, pls refresh first.')
+            from pyarrow import parquet
+            table = parquet.read_table(self.path)
+            self.df = table.to_pandas()
+            refresh_time = (table.schema.metadata or {}).get(_REFRESH_TIME)
+            self.refresh_time = datetime.datetime.fromisoformat(refresh_time.decode()) if refresh_time else None
+        return self.df
+
+    # 从Mongo导出
+    def refresh(self, full=False):
+        refresh_time = datetime.datetime.now()
+        df = None
+        if not full and self.path.exists():
+            df = self.load()
+
+        if df is None or df.empty or self.refresh_time is None:
+            docs = TickFilesDoc.objects().as_pymongo()
+        else:
+            q = Q(id__gt=ObjectId(df['_id'].max())) | Q(update_time__gte=self.refresh_time - _REFRESH_MARGIN)
+            docs = TickFilesDoc.objects(q).as_pymongo()
+        new_df = pd.DataFrame(list(docs))
+
+        if not new_df.empty:
+            new_df['_id'] = new_df['_id'].astype(str)
+        if df is not None and not df.empty:
+            new_df = pd.concat([df[~df['_id'].isin(new_df.get('_id', []))], new_df], sort=False)
+        new_df = new_df.sort_values('_id').reset_index(drop=True) if not new_df.empty else new_df
+        logger.info(f'[catalog]: refresh {self.path}, full={full}, total={new_df.shape[0]}.')
+
+        self._save(new_df, refresh_time)
+        self.df = new_df
+        self.refresh_time = refresh_time
+        return new_df
+
+    def _save(self, df, refresh_time):
+        import pyarrow as pa
+        from pyarrow import parquet
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), _REFRESH_TIME: refresh_time.isoformat()})
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = self.path.with_name(f'.{self.path.name}.{os.getpid()}.tmp')
+        parquet.write_table(table, tmp_file)
+        os.replace(tmp_file, self.path)
+
+    # 查询，`main_cls`同`PickleDbTicks`
+    def query(self, main_cls='main', **q_f):
+        df = self.load()
+        if main_cls == 'main':
+            q_f = {**MAIN_FILTER, **q_f}
+        elif main_cls == 'sub_main':
+            q_f = {**SUB_MAIN_FILTER, **q_f}
+
+        mask = np.ones(df.shape[0], dtype=bool)
+        for key, value in q_f.items():
+            mask &= _mask(df, key, value)
+        return df[mask]
+
+    # 把查询结果转为`TickFilesDoc`
+    @staticmethod
+    def to_docs(df):
+        return [TickFilesDoc._from_son(_to_son(item)) for item in df.to_dict('records')]
+
+
+def _mask(df, key, value):
+    field, _, op = key.partition('__')
+    if field in ['id', 'pk']:
+        field = '_id'
+        value = [str(v) for v in value] if isinstance(value, (list, tuple, set)) else str(value)
+    if field not in df.columns:
+        col = pd.Series([None] * df.shape[0], index=df.index, dtype=object)
+    else:
+        col = df[field]
+
+    if field in _LIST_FIELDS:
+        return _list_mask(col, op, value)
+
+    if op == '':
+        return col.isna().to_numpy() if value is None else (col == value).to_numpy()
+    if op == 'ne':
+        return col.notna().to_numpy() if value is None else ((col != value) | col.isna()).to_numpy()
+    if op == 'in':
+        return col.isin(list(value)).to_numpy()
+    if op == 'nin':
+        return (~col.isin(list(value))).to_numpy()
+    if op == 'exists':
+        return (col.notna() == bool(value)).to_numpy()
+    if op in ['gt', 'gte', 'lt', 'lte']:
+        if isinstance(value, (datetime.datetime, datetime.date, str)) and col.dtype.kind == 'M':
+            value = pd.Timestamp(value)
+        res = dict(gt=col > value, gte=col >= value, lt=col < value, lte=col <= value)[op]
+        return res.fillna(False).to_numpy(dtype=bool)
+    raise CatalogException(f'Unsupported query: {key}={value!r}')
+
+
+# 列表字段(tags)的查询：`tags=[]`精确匹配，`tags='x'`包含，`tags__in/nin`有/没有交集
+def _list_mask(col, op, value):
+    col = col.map(lambda x: [] if x is None or (isinstance(x, float) and np.isnan(x)) else list(x))
+    if op == '' and isinstance(value, (list, tuple)):
+        return col.map(lambda x: x == list(value)).to_numpy(dtype=bool)
+
+    values = list(value) if op in ['in', 'nin'] else [value]
+    exploded = col.explode()
+    hit = exploded.isin(values).groupby(level=0).any().reindex(col.index, fill_value=False).to_numpy(dtype=bool)
+    if op in ['', 'in']:
+        return hit
+    if op in ['ne', 'nin']:
+        return ~hit
+    raise CatalogException(f'Unsupported query on list field: {op}={value!r}')
+
+
+# parquet读出来的值转为Mongo中的格式
+def _to_son(item):
+    son = {}
+    for key, value in item.items():
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        elif value is None or value is pd.NaT or (isinstance(value, float) and np.isnan(value)):
+            continue
+        elif isinstance(value, pd.Timestamp):
+            value = value.to_pydatetime()
+        elif isinstance(value, np.generic):
+            value = value.item()
+        son[key] = value
+    if '_id' in son:
+        son['_id'] = ObjectId(son['_id'])
+    return son
@@ -5,7 +5,13 @@ import pandas as pd
 from pathlib import Path
 from ..apis.apis import format_file_size, format_time
 from .conf import *
-from .utils import delete_file
+from .storage import get_engine, get_storage_ver
+from .raw_csv import get_raw_columns, read_raw_csv, iter_raw_csv, wash_raw_df
+from .sessions import calc_time_type, calc_split_code, calc_trading_day, SPLIT_PERIODS
+from .tick_stats import TickStats
+from .meta_buffer import meta_buffer
+from .tick_cache import tick_cache
+from .utils import delete_file, delete_files, file_checksum
 from tqdm import tqdm_notebook as tqdm
 
 __all__ = (
@@ -34,6 +40,14 @@ KLINE_BINS_LIST = ['3min', '5min', '15min', '30min', '1H', '2H']
 class ModelException(Exception):
     pass
 
+
+# 带有这些tag的文件`csv_to_pickle()`不再处理，除非`force=True`
+INGEST_SKIP_TAGS = ['empty_df', 'load_df_fail']
+
+# 主力/次主力的筛选条件，`TickCatalog`中也会用到
+MAIN_FILTER = dict(zip_path__ne=None, high__ne=None, subID__nin=['0000', '9999'], tags__nin=['invalid_day', 'too_small', 'dup_time', 'time_no_ms'], isDominant=True)
+SUB_MAIN_FILTER = dict(zip_path__ne=None, high__ne=None, subID__nin=['0000', '9999'], tags__nin=['invalid_day', 'too_small', 'dup_time', 'time_no_ms'], is2ndDominant=True)
+
 class TickFilesDoc(Document):
     '''
     Tick文件记录，存放在Mongo中。
@@ -62,6 +76,7 @@ class TickFilesDoc(Document):
             'isDominant',
             'is2ndDominant',
             'zip_line_num',
+            'update_time',
         ]
     }
     MarketID = IntField()                   # 市场代码(上证1, 深证2, 中金所3, 上期4, 郑商5, 大商6)
@@ -87,13 +102,15 @@ class TickFilesDoc(Document):
     # 原始文件
     path = StringField(unique=True)         # 存放相对路径
     size = IntField()                       # bytes
+    mtime = FloatField()                    # 修改时间(timestamp)，和`size`一起判断原始文件是否变化
     line_num = IntField()
 
     # pkl压缩文件
     zip_path = StringField()                # 存放清理后的数据
     zip_line_num = IntField(default=0)
     column_num = IntField(default=0)
-    zip_ver = IntField(default=1)
+    zip_ver = IntField(default=1)           # 存储格式，见`storage.py`
+    zip_checksum = StringField()            # 文件内容的校验和，见`verify_zip()`
 
     stored = BooleanField(default=False)    # 暂时没有使用
     doc_num = IntField()
@@ -111,6 +128,8 @@ class TickFilesDoc(Document):
 
     volume_sum = IntField()                 # 总成交量
 
+    update_time = DateTimeField()           # 最后修改时间，用于增量刷新`TickCatalog`
+
     ###############################################
     @queryset_manager
     def wait_import(doc_cls, queryset):     # 增量添加了文件，但没有生成pkl文件
@@ -126,15 +145,23 @@ class TickFilesDoc(Document):
 
     @queryset_manager
     def main(doc_cls, queryset):            # 主力
-        return queryset.filter(zip_path__ne=None, high__ne=None, subID__nin=['0000', '9999'], tags__nin=['invalid_day', 'too_small', 'dup_time', 'time_no_ms'], isDominant=True)
+        return queryset.filter(**MAIN_FILTER)
 
     @queryset_manager
     def sub_main(doc_cls, queryset):        # 次主力
-        return queryset.filter(zip_path__ne=None, high__ne=None, subID__nin=['0000', '9999'], tags__nin=['invalid_day', 'too_small', 'dup_time', 'time_no_ms'], is2ndDominant=True)
+        return queryset.filter(**SUB_MAIN_FILTER)
 
     def __repr__(self):
         return f'[{self.InstrumentID}-{self.day}]: file={self.path}({format_file_size(self.size)}), {self.zip_line_num}/{self.line_num}, tags={self.tags}, time_len={format_time(self.diff_sec)}'
 
+    # 所有修改都记录`update_time`
+    def clean(self):
+        self.update_time = datetime.datetime.now()
+
+    def update(self, **kwargs):
+        kwargs.setdefault('set__update_time', datetime.datetime.now())
+        return super().update(**kwargs)
+
     ###############################################
     @property
     def _rel_path(self):
@@ -143,8 +170,11 @@ class TickFilesDoc(Document):
     def abs_path(self):     # 绝对路径，用于创建目录
         return TICKS_PATH / self._rel_path
     @property
+    def engine(self):       # 存储引擎，由`zip_ver`决定
+        return get_engine(self.zip_ver)
+    @property
     def _f_name(self):      # 文件名
-        return f'{self.InstrumentID}_{self.day}.pkl'
+        return f'{self.InstrumentID}_{self.day}{self.engine.suffix}'
     @property
     def rel_file(self):     # 相对路径，to save in db
         return self._rel_path / self._f_name
@@ -159,6 +189,12 @@ class TickFilesDoc(Document):
             logger.warning(f'Pls check: zip_exists={zip_exists}, zip_path={self.zip_path}')
         return zip_exists
 
+    # 检查zip文件是否完整，以前没有记录校验和的文件只检查是否存在
+    def verify_zip(self):
+        if not self.zip_exists():
+            return False
+        return not self.zip_checksum or file_checksum(self.file) == self.zip_checksum
+
     # 删除zip文件
     def del_zip(self, update_doc=True):
         delete_file(self.file)
@@ -174,13 +210,25 @@ class TickFilesDoc(Document):
         self.del_zip(update_doc=False)
         self.delete()
 
+    # 文件的时间范围和[start, end]是否有交集
+    def in_time_range(self, start=None, end=None):
+        if start is not None and self.end is not None and self.end < start:
+            return False
+        if end is not None and self.start is not None and self.start > end:
+            return False
+        return True
+
     # 加载ticks
-    def load_ticks(self):
+    #   - columns: 只加载指定的列
+    #   - start/end: 只加载`UpdateTime`在[start, end]之间的数据
+    def load_ticks(self, columns=None, start=None, end=None):
+        if not self.in_time_range(start, end):
+            return pd.DataFrame([])
         if not self.zip_exists():
             if self.zip_path and 'empty_df' not in self.tags:
                 logger.error(f'ERROR: tick[{self.pk}] has not stored, but file[{self.zip_path}] exists!')
             return pd.DataFrame([])
-        _df = pd.read_pickle(self.file, compression=PICKLE_COMPRESSION)
+        _df = tick_cache.load(self.file, self.engine, columns=columns, start=start, end=end)
         return _df
 
     # 加载ticks.
@@ -191,27 +239,41 @@ class TickFilesDoc(Document):
         df = func(df)
         assert row_num == df.shape[0], f'[{self}] 处理前后行数不一致！'
         self._to_pkl(df)
-        self.update(set__column_num=len(df.columns))
+        self.update(set__column_num=len(df.columns), set__zip_checksum=file_checksum(self.file))
         return df
 
+    # 转换存储格式，用于把热点品种迁移到读取更快的格式
+    def convert_storage(self, zip_ver):
+        if zip_ver == self.zip_ver or not self.zip_exists():
+            return
+        df = self.load_ticks()
+        old_file = self.file
+        self.zip_ver = zip_ver
+        self._to_pkl(df)
+        self.update(set__zip_ver=zip_ver, set__zip_path=str(self.rel_file), set__zip_checksum=file_checksum(self.file))
+        delete_file(old_file, recursion=False)
+
     # 按照日夜盘存储，暂未使用
+    # 替换以前的切分文件，批量处理见`split_tick_files()`
     def save_splited(self):
-        if 'too_small' in self.tags or 'invalid_day' in self.tags:
+        splits, update_d = self._split_to_files()
+        if splits is None:
             return None
+        TickSplitPklFilesDoc.replace_splits({self.pk: splits})
+        meta_buffer.update(self, **update_d)
+
+    # 清洗、切分并写入切分文件，不修改`TickSplitPklFilesDoc`，由调用方用`TickSplitPklFilesDoc.replace_splits()`批量替换。
+    # 返回(splits, update_d)：
+    #   - splits: 新切分的`TickSplitPklFilesDoc`字段的list；None表示没有加载到数据，以前的切分保持不变
+    #   - update_d: 替换之后对本doc的修改(`splited`或者出错的tag)
+    def _split_to_files(self):
+        if 'too_small' in self.tags or 'invalid_day' in self.tags:
+            return None, {}
 
         df = self.load_ticks()
         if df is None or df.empty:
             logger.warn(f'ERROR: df not exists: {self!r}')
-            return None
-
-        # 删除已经存在的数据
-        __ticks = TickSplitPklFilesDoc.objects(file_doc=self)
-        if __ticks.count():
-            for __tick in __ticks:
-                __tick.del_zip()
-            TickSplitPklFilesDoc.objects(file_doc=self).delete()
-            # self.update(pull__tags='splited', set__doc_num=0)
-            self.reload()
+            return None, {}
 
         # 去重
         _pre_shape = df.shape[0]
@@ -222,22 +284,20 @@ class TickFilesDoc(Document):
 
         # 对于早期数据，有时间上的问题，比如millisecond=1，参见：[AG1406][20140217]
         # 这造成的问题是asfreq('500ms')得到一半无用数据，所以应该在数据源头做处理。
-        df = df.set_index('UpdateTime')
-        _ms = df.index.microsecond.value_counts().to_dict()
-        if set(_ms.keys()) ^ set([500000, 0]):
-            logger.info(f'Time.microsecond: {_ms}: {self!r}')
-            df.index = df.index.map(lambda x: x.replace(microsecond=500000) if x.microsecond != 0 else x)
-
-        _ms = df.index.microsecond.value_counts().to_dict()
-        if len(_ms) < 2:
-            logger.warn(f'Time.microsecond: {_ms}: {self!r}')
-            self.update(add_to_set__tags='time_no_ms')
-            self.reload()
-            return
+        _ms = df['UpdateTime'].dt.microsecond
+        _ms_cnt = _ms.value_counts().to_dict()
+        if set(_ms_cnt.keys()) ^ set([500000, 0]):
+            logger.info(f'Time.microsecond: {_ms_cnt}: {self!r}')
+            df['UpdateTime'] = df['UpdateTime'].where(_ms == 0, df['UpdateTime'].dt.floor('s') + pd.Timedelta(milliseconds=500))
 
-        # assert not (set(_ms.keys()) ^ set([500000, 0])), f'Time.microsecond Exception: {_ms}: {self!r}'
+        _ms_cnt = df['UpdateTime'].dt.microsecond.value_counts().to_dict()
+        if len(_ms_cnt) < 2:
+            logger.warn(f'Time.microsecond: {_ms_cnt}: {self!r}')
+            return [], dict(add_to_set__tags='time_no_ms')
 
-        df = df.sort_index().reset_index()      # 排序、重置index
+        # assert not (set(_ms_cnt.keys()) ^ set([500000, 0])), f'Time.microsecond Exception: {_ms_cnt}: {self!r}'
+
+        df = df.sort_values('UpdateTime', kind='stable').reset_index(drop=True)      # 排序、重置index
         # 按时间去重
         _pre_shape = df.shape[0]
         df = df.drop_duplicates('UpdateTime', keep='first')
@@ -246,156 +306,152 @@ class TickFilesDoc(Document):
             logger.info(f'DropDupByTime, Droped={_diff_shape}, Left={df.shape[0]}: {self!r}')
         if _diff_shape > 100:
             logger.warn(f'DropDupByTime: Drop too many, set Invalid. {self!r}')
-            self.update(add_to_set__tags='dup_time')
-            self.reload()
-            return
-
-        # 日夜盘切分
-        #   fam: 09:00 - 10:15, 1:15, 75' ,  ticks=9000
-        #   bam: 10:30 - 11:30, 1:00, 60' ,  ticks=7200
-        #    pm: 13:30 - 15:00, 1:30, 90' ,  ticks=10800
-        # night: 21:00 - 02:30, 5:00, 300',  ticks=36000
-        df = df.set_index('UpdateTime')
-        df['time_type'] = 'unknow'
-
-        time_period = dict(
-            fam  =('09:00', '10:15'),
-            bam  =('10:30', '11:30'),
-            pm   =('13:00', '15:01'),
-            night=('21:00', '03:00'),
-        )
-        for _type, _time in time_period.items():
-            _start, _end = _time
-            df.loc[df.between_time(_start, _end).index, 'time_type'] = _type
-
-        unknow_num = df[df.time_type == 'unknow'].shape[0]
+            return [], dict(add_to_set__tags='dup_time')
+
+        frames = self._split_frames(df)
+        if frames is None:
+            return [], {}
+
+        engine = get_engine(get_storage_ver(self.category))
+        splits = []
+        for day, time_type, _df, statics_d in frames:
+            # 相关路径的计算
+            __f_name = f'{self.InstrumentID}_{self.day}_{day}_{time_type}{engine.suffix}'
+            _rel_file = self._rel_path / __f_name   # to save in db
+            _file = self.abs_path / __f_name
+
+            start = statics_d.pop('start')
+            end = statics_d.pop('end')
+            engine.write(_df, _file)
+
+            splits.append(dict(
+                file_doc=self.pk,
+                MarketID=self.MarketID,
+                category=self.category,
+                InstrumentID=self.InstrumentID,
+                data_type=self.data_type,
+                isDominant=self.isDominant,
+                is2ndDominant=self.is2ndDominant,
+
+                year=start.strftime('%Y'),
+                month=start.strftime('%Y%m'),
+                day=day,
+                time_type=time_type,
+
+                start=start,
+                end=end,
+                diff_sec=(end - start).total_seconds(),
+
+                zip_path=str(_rel_file),
+                zip_ver=engine.ver,
+                **statics_d,
+            ))
+        return splits, dict(add_to_set__tags='splited', set__doc_num=len(splits))
+
+    # 按(日期, 时段)切分排好序的df，一次groupby同时得到所有切分和它们的统计量。
+    # 返回[(day, time_type, df, statics_d)]，行数少于200的切分不返回；有不在任何时段内的数据时返回None。
+    #   - day: 'yyyymmdd'，夜盘0点之后的数据归到前一天，见`calc_trading_day()`
+    #   - statics_d: `TickSplitPklFilesDoc`的统计量，另外包含`start`/`end`
+    def _split_frames(self, df):
+        codes = calc_split_code(df['UpdateTime'])
+        unknow_num = int((codes < 0).sum())
         if unknow_num:
             logger.error(f'calc time_type error: {self!r}, unknow_num={unknow_num}')
-            # update_d = {**update_d, **dict(add_to_set__tags='time_error', set__doc_num=0)}
-            # self.update(**update_d)
-            # self.reload()
-            return
-
-        df['UpdateTime_delay'] = df['UpdateTime'] + datetime.timedelta(hours=-3, minutes=-20)
-        df['UpdateTime_day'] = df['UpdateTime_delay'].map(lambda x: x.strftime('%Y%m%d'))
-        df = df.drop(['UpdateTime_delay'], axis=1)
-
-        days = df['UpdateTime_day'].unique()
-        time_types = df['time_type'].unique()
-
-        # logger.info(f'DELETE({cnt}): {self!r}')
-
-        cnt = 0
-        for day in days:
-            for time_type in time_types:
-                # 相关路径的计算
-                __f_name = f'{self.InstrumentID}_{self.day}_{day}_{time_type}.pkl'
-                _rel_file = self._rel_path / __f_name   # to save in db
-                _file = self.abs_path / __f_name
-
-                _df = df[(df.UpdateTime_day == day) & (df.time_type == time_type)]
-                if _df.empty:
-                    continue
-                if _df.shape[0] < 200:
-                    continue
-
-                _df = _df.sort_values('UpdateTime')     # 一定要排序！！！
-
-                start = _df['UpdateTime'].min()
-                end = _df['UpdateTime'].max()
-                try:
-                    diff = end - start
-                    diff_sec = diff.total_seconds()
-                except Exception:
-                    logger.error(f'[{day}-{time_type}]: calc diff_sec error: {self!r}, {start}, {end}')
-                    continue
+            return None
 
-                # 一些统计量
-                try:
-                    statics_d = dict(
-                        zip_line_num=_df.shape[0],
-                        open=_df.iloc[0]['LastPrice'],
-                        close=_df.iloc[-1]['LastPrice'],
-                        high=_df['LastPrice'].max(),
-                        low=_df['LastPrice'].min(),
-                        mean=_df['LastPrice'].mean(),
-
-                        OpenInterest=_df.iloc[-1]['OpenInterest'],
-                        # Turnover=_df.iloc[-1]['Turnover'],                 # 成交总额
-                        volume_sum=_df['LastVolume'].sum(),
-                    )
-                except Exception:
-                    raise Exception(f'get statistic error: {self!r}')
-
-                _df.to_pickle(_file, compression=PICKLE_COMPRESSION)
-
-                TickSplitPklFilesDoc(
-                    file_doc=self,
-                    MarketID=self.MarketID,
-                    category=self.category,
-                    InstrumentID=self.InstrumentID,
-                    data_type=self.data_type,
-                    isDominant=self.isDominant,
-                    is2ndDominant=self.is2ndDominant,
-
-                    year=start.strftime('%Y'),
-                    month=start.strftime('%Y%m'),
-                    day=day,
-                    time_type=time_type,
-
-                    start=start,
-                    end=end,
-                    diff_sec=diff_sec,
-
-                    zip_path=str(_rel_file),
-                    **statics_d,
-                ).save()
-
-                cnt += 1
-        self.update(add_to_set__tags='splited', set__doc_num=cnt)
-        # self.reload()
+        days = calc_trading_day(df['UpdateTime'])
+        grouped = df.groupby([days, codes], sort=True)
+        stats = grouped.agg(
+                    zip_line_num=('LastPrice', 'size'),
+                    open=('LastPrice', 'first'),
+                    close=('LastPrice', 'last'),
+                    high=('LastPrice', 'max'),
+                    low=('LastPrice', 'min'),
+                    mean=('LastPrice', 'mean'),
+                    OpenInterest=('OpenInterest', 'last'),
+                    # Turnover=('Turnover', 'last'),                # 成交总额
+                    volume_sum=('LastVolume', 'sum'),
+                    start=('UpdateTime', 'min'),
+                    end=('UpdateTime', 'max'),
+                )
+        stats = stats[stats.zip_line_num >= 200]
+
+        indices = grouped.indices
+        time_types = list(SPLIT_PERIODS)
+        splits = []
+        for key, statics_d in zip(stats.index, stats.to_dict('records')):
+            day, code = key
+            day = pd.Timestamp(day).strftime('%Y%m%d')
+            time_type = time_types[code]
+            _df = df.take(indices[key]).reset_index(drop=True).assign(time_type=time_type, UpdateTime_day=day)
+            splits.append((day, time_type, _df, statics_d))
+        return splits
+
+    # `csv_to_pickle()`是否处理这类文件
+    @staticmethod
+    def ingestable(MarketID, subID):
+        # TODO: 缺少2019之后市场3的数据
+        if MarketID != 3:         # 中金所不处理，处理方式和其他不一样
+            return False
+        return subID == '9999'
 
     # 保存tick到pkl文件
-    def csv_to_pickle(self, force=False):
-        # TODO: 缺少2019之后市场3的数据
-        if self.MarketID != 3:         # 中金所不处理，处理方式和其他不一样
+    #   - chunk_rows: 分块处理原始文件，见`_csv_to_pickle_chunked()`。None表示使用`INGEST_CHUNK_ROWS`，0表示整个文件一次加载
+    # 整个文件处理时分为几个阶段，`ingest_pipeline()`中各阶段在不同的线程中并行执行：
+    #   - _need_ingest(): 是否需要处理
+    #   - _ingest_transform(): 解析、清洗、标记交易时段、排序、统计
+    #   - _ingest_store(): 压缩、写文件
+    #   - 写入元数据
+    def csv_to_pickle(self, force=False, chunk_rows=None):
+        if not self._need_ingest(force):
             return
-        if self.subID != '9999':
+
+        chunk_rows = INGEST_CHUNK_ROWS if chunk_rows is None else chunk_rows
+        if chunk_rows and self._csv_to_pickle_chunked(chunk_rows):
             return
 
-        update_d = dict(set__doc_num=0)
+        df, update_d = self._ingest_transform()
+        if df is not None:
+            update_d = self._ingest_store(df, update_d)
+        meta_buffer.update(self, **update_d)
+
+    def _need_ingest(self, force=False):
+        if not self.ingestable(self.MarketID, self.subID):
+            return False
 
         if not force:
-            if 'empty_df' in self.tags or 'load_df_fail' in self.tags:        # self.diff_sec < 0
+            if set(self.tags) & set(INGEST_SKIP_TAGS):        # self.diff_sec < 0
                 logger.warn(f'Pls check: {self!r}')
-                return
+                return False
             if self.zip_exists():
-                logger.warn(f'pkl already exists: {self!r}')
-                return
+                if self.zip_path:
+                    logger.warn(f'pkl already exists: {self!r}')
+                    return False
+                # 文件已经生成，但元数据没有写入(进程崩溃时`meta_buffer`中的修改丢失)，重新处理
+                logger.info(f'pkl exists but not recorded, reprocess: {self!r}')
+        return True
+
+    # 返回(df, update_d)，df为None表示不需要保存，update_d为要写入的元数据
+    #   - source: 原始数据，默认为原始文件，也可以是已经读到内存中的file-like对象
+    def _ingest_transform(self, source=None):
+        update_d = dict(set__doc_num=0)
 
         try:
-            df, line_num = self._load_df_from_csv()
+            df, line_num = self._load_df_from_csv(source)
             update_d = {**update_d, **dict(set__line_num=line_num)}
         except Exception:
             logger.error(f'Load df fail: {self!r}')
-            self.update(add_to_set__tags='load_df_fail')
-            # self.reload()
-            return
+            return None, dict(add_to_set__tags='load_df_fail')
 
         if df.empty:
             logger.error(f'df.empty error: {self!r}')
-            self.update(add_to_set__tags='empty_df', set__doc_num=0)
-            # self.reload()
-            return
+            return None, dict(add_to_set__tags='empty_df', set__doc_num=0)
         if df.shape[0] < 200:
             logger.error(f'df.empty error: {self!r}')
-            self.update(add_to_set__tags='too_small', set__zip_line_num=df.shape[0], set__doc_num=0)
-            return
+            return None, dict(add_to_set__tags='too_small', set__zip_line_num=df.shape[0], set__doc_num=0)
         if len(df.columns) < 10:
             logger.error(f'df parse col error: {self!r}')
-            self.update(add_to_set__tags='col_error', set__doc_num=0)
-            # self.reload()
-            return
+            return None, dict(add_to_set__tags='col_error', set__doc_num=0)
 
         # 处理时间信息
         start = df['UpdateTime'].min()
@@ -404,110 +460,128 @@ class TickFilesDoc(Document):
             diff = end - start
             diff_sec = diff.total_seconds()
             update_d = {**update_d, **dict(set__start=start, set__end=end, set__diff_sec=diff_sec)}
-            # self.update(set__start=start, set__end=end, set__diff_sec=diff_sec)
-            # self.reload()
         except Exception:
             logger.error(f'calc diff_sec error: {self!r}, {start}, {end}')
-            self.update(add_to_set__tags='diff_sec_error', set__doc_num=0, **update_d)
-            # self.reload()
-            return
+            return None, dict(add_to_set__tags='diff_sec_error', **update_d)
 
-        # 将日夜盘交易时间拉会到同一天处理：
-        #    09:00:00 -> 05:40:00
-        #    10:15:00 -> 06:55:00
-        #    10:30:00 -> 07:10:00
-        #    11:30:00 -> 08:10:00
-        #    13:30:00 -> 10:10:00
-        #    15:00:00 -> 11:40:00
-        #    21:00:00 -> 17:40:00
-        #    02:30:00 -> 23:10:00
-        df['UpdateTime_delay'] = df['UpdateTime'] + datetime.timedelta(hours=-3, minutes=-20)
-        df['_UpdateTime_hour'] = df['UpdateTime_delay'].map(lambda x: (x.hour))
-        time_period = dict(
-            fam=(4, 6),     # 05:40:00 <= _ <= 06:55:00,    4 <= _ <= 6
-            bam=(7, 8),     # 07:10:00 <= _ <= 08:10:00,    7 <= _ <= 8
-            pm=(9, 14),     # 10:10:00 <= _ <= 11:40:00,    9 <= _ <= 14
-            night=(15, 24), # 17:40:00 <= _ <= 23:10:00,   15 <= _ <= 24
-        )
-
-        df['time_type'] = 'unknow'
-        for _type, _time in time_period.items():
-            _start, _end = _time
-            # print(_type, _start, _end)
-            df.loc[(df._UpdateTime_hour >= _start) & (df._UpdateTime_hour <= _end), ['time_type']] = _type
+        # 交易时段，见`sessions.py`
+        df['time_type'] = calc_time_type(df['UpdateTime'])
 
         unknow_num = df[df.time_type == 'unknow'].shape[0]
         if unknow_num:
             logger.error(f'calc time_type error: {self!r}, unknow_num={unknow_num}')
-            self.update(add_to_set__tags='time_error', set__doc_num=0, **update_d)
-            # self.reload()
-            return
+            return None, dict(add_to_set__tags='time_error', **update_d)
 
-        df = df.drop(['UpdateTime_delay', '_UpdateTime_hour'], axis=1)
+        df = df.sort_values('UpdateTime', kind='mergesort')     # 按时间有序存储，按时间范围读取时才能跳过数据
 
         if df.shape[0] < 200:
             update_d = {**update_d, **dict(add_to_set__tags='too_small')}
 
-        # save pickle
+        # 统计量和其它元数据一起写入
+        update_d = {**update_d, **TickStats().add(df).to_update()}
+        return df, update_d
+
+    # 保存文件，返回加上文件信息后的update_d
+    def _ingest_store(self, df, update_d):
+        # save pickle，按品种选择存储格式。force重新生成时，删掉旧格式的文件。
+        old_file = self.file if self.zip_path else None
+        self.zip_ver = get_storage_ver(self.category)
         self._to_pkl(df)
+        if old_file and old_file != self.file:
+            delete_file(old_file, recursion=False)
 
-        # update tick_doc
-        self.update(set__zip_line_num=df.shape[0], set__zip_path=str(self.rel_file), **update_d)
-        # self.reload()
-        # return self
+        return {**update_d, **dict(set__zip_line_num=df.shape[0], set__zip_path=str(self.rel_file), set__zip_ver=self.zip_ver,
+                                   set__zip_checksum=file_checksum(self.file))}
 
     def _to_pkl(self, df):
         self.abs_path.mkdir(parents=True, exist_ok=True)
-        df.to_pickle(self.file, compression=PICKLE_COMPRESSION)
-
-    # 从源数据中加载数据
-    def _load_df_from_csv(self):
-        tmpPath = RAW_DATA_PATH / self.path
-        pd_data = pd.read_csv(
-                    tmpPath,
-                    names=['InstrumentID', 'MarketID', 'LastPrice', 'LastVolume', 'hhmmss', 'Reserved', 'UpdateTime', 'AskPrice1',
-                           'AskVolume1', 'BidPrice1', 'BidVolume1', 'AskPrice2', 'AskVolume2', 'BidPrice2', 'BidVolume2',
-                           'AskPrice3', 'AskVolume3', 'BidPrice3', 'BidVolume3', 'AskPrice4', 'AskVolume4', 'BidPrice4', 'BidVolume4',
-                           'AskPrice5', 'AskVolume5', 'BidPrice5', 'BidVolume5', 'OpenInterest', 'Turnover', 'AvePrice', 'invol', 'outvol',
-                           'Attr1', 'Volume1', 'Attr2', 'Volume2', 'HighestPrice', 'LowestPrice', 'SettlePrice', 'OpenPrice', 'mainID', 'fill'],
-                    low_memory=False, parse_dates=['UpdateTime'], dtype={'hhmmss': str}
-                    # low_memory=False, parse_dates=['UpdateTime'], dtype={'hhmmss': str}, error_bad_lines=False, warn_bad_lines=False
-                )
-
-        # TODO: 先不要删，观察下这些特征
-        # drop_cols = [
-        #                 # 'AskPrice1', 'AskVolume1', 'BidPrice1', 'BidVolume1',
-        #                 'AskPrice2', 'AskVolume2', 'BidPrice2', 'BidVolume2',
-        #                 'AskPrice3', 'AskVolume3', 'BidPrice3', 'BidVolume3',
-        #                 'AskPrice4', 'AskVolume4', 'BidPrice4', 'BidVolume4',
-        #                 'AskPrice5', 'AskVolume5', 'BidPrice5', 'BidVolume5',
-        #                 'Reserved', 'invol', 'outvol',
-        #                 'Attr1', 'Volume1', 'Attr2', 'Volume2',
-        #                 'fill',
-        #             ]
-
-        # # 删掉不需要的列
-        # if self.subID == '0000':           # 指数
-        #     drop_cols += ['HighestPrice', 'LowestPrice', 'OpenPrice', 'SettlePrice', 'Turnover', 'AvePrice', 'mainID']
-        # elif self.subID == '9999':         # 主力
-        #     drop_cols += ['SettlePrice']
-        # else:                                       # ticks
-        #     drop_cols += ['SettlePrice', 'mainID']
-        # pd_data.drop(drop_cols, axis=1, inplace=True)
+        self.engine.write(df, self.file)
+
+    # 分块入库：每次解析`chunk_rows`行，清洗、标记交易时段后追加写入，内存占用和文件大小无关。
+    # 只能写入可以追加的格式，品种的存储格式不支持时使用`STREAM_STORAGE_VER`。
+    # 块之间时间乱序、类型不一致、解析失败等情况返回False，由调用方整个文件重新处理。
+    def _csv_to_pickle_chunked(self, chunk_rows):
+        old_file = self.file if self.zip_path else None
+        old_ver = self.zip_ver
+        self.zip_ver = get_storage_ver(self.category)
+        if not self.engine.appendable:
+            self.zip_ver = STREAM_STORAGE_VER
+
+        line_num = 0
+        start = end = None
+        stats = TickStats()
+        update_d = dict(set__doc_num=0)
+        self.abs_path.mkdir(parents=True, exist_ok=True)
+        writer = self.engine.open_writer(self.file)
+        try:
+            columns = get_raw_columns(self.MarketID, self.subID, full=True)
+            for df, _line_num in iter_raw_csv(RAW_DATA_PATH / self.path, columns, chunk_rows):
+                line_num += _line_num
+                df = wash_raw_df(df)
+                if df.empty:
+                    continue
+                if len(df.columns) < 10:
+                    logger.error(f'df parse col error: {self!r}')
+                    writer.abort()
+                    self.zip_ver = old_ver
+                    meta_buffer.update(self, add_to_set__tags='col_error', set__line_num=line_num, **update_d)
+                    return True
+
+                df = df.assign(time_type=calc_time_type(df['UpdateTime']))
+                unknow_num = df[df.time_type == 'unknow'].shape[0]
+                if unknow_num:
+                    logger.error(f'calc time_type error: {self!r}, unknow_num={unknow_num}')
+                    writer.abort()
+                    self.zip_ver = old_ver
+                    meta_buffer.update(self, add_to_set__tags='time_error', set__line_num=line_num, **update_d)
+                    return True
+
+                df = df.sort_values('UpdateTime', kind='mergesort')
+                if end is not None and df['UpdateTime'].iloc[0] < end:
+                    raise ModelException('UpdateTime is out of order between chunks.')
+                start = df['UpdateTime'].iloc[0] if start is None else start
+                end = df['UpdateTime'].iloc[-1]
+                writer.write(df)
+                stats.add(df)
+        except Exception:
+            logger.warning(f'Chunked ingest fail, load the whole file instead: {self!r}', exc_info=1)
+            writer.abort()
+            self.zip_ver = old_ver
+            return False
 
+        update_d = {**update_d, **dict(set__line_num=line_num)}
+        if writer.rows == 0:
+            logger.error(f'df.empty error: {self!r}')
+            writer.abort()
+            self.zip_ver = old_ver
+            meta_buffer.update(self, add_to_set__tags='empty_df', **update_d)
+            return True
+        if writer.rows < 200:
+            logger.error(f'df.empty error: {self!r}')
+            writer.abort()
+            self.zip_ver = old_ver
+            meta_buffer.update(self, add_to_set__tags='too_small', set__zip_line_num=writer.rows, **update_d)
+            return True
+
+        writer.commit()
+        if old_file and old_file != self.file:
+            delete_file(old_file, recursion=False)
+        diff_sec = (end - start).total_seconds()
+        update_d = {**update_d, **stats.to_update()}
+        meta_buffer.update(self, set__start=start, set__end=end, set__diff_sec=diff_sec, set__zip_line_num=writer.rows,
+                           set__zip_path=str(self.rel_file), set__zip_ver=self.zip_ver, set__zip_checksum=file_checksum(self.file), **update_d)
+        return True
+
+    # 从源数据中加载数据。先保留所有列，观察下这些特征。
+    def _load_df_from_csv(self, source=None):
+        source = RAW_DATA_PATH / self.path if source is None else source
+        pd_data = read_raw_csv(source, get_raw_columns(self.MarketID, self.subID, full=True))
         line_num = pd_data.shape[0]
 
-        # 处理时间字段
-        pd_data = pd_data[(pd_data.UpdateTime < MAX_DATE) & (pd_data.UpdateTime > MIN_DATE)]
-        pd_data['UpdateTime'] = pd.to_datetime(pd_data.UpdateTime)
-        # 处理交易量字段
-        pd_data = pd_data[pd_data.LastVolume >= 0]
-
+        pd_data = wash_raw_df(pd_data)
         if line_num > 7000 and line_num != pd_data.shape[0]:
             logger.info(f'[{self.path}]: after washing: {line_num}->{pd_data.shape[0]}.')
 
-        # pd_data['subID'] = pd_data.InstrumentID.str[-4:]
-
         return pd_data, line_num
 
 
@@ -562,7 +636,7 @@ class TickSplitPklFilesDoc(Document):
     # pkl压缩文件
     zip_path = StringField()                # 存放清理后的数据
     zip_line_num = IntField()
-    # zip_ver = IntField()
+    zip_ver = IntField(default=1)           # 存储格式，见`storage.py`
 
     # 特征文件
     # feature_path = StringField()           # 提取特征后的文件保存路径
@@ -607,6 +681,9 @@ class TickSplitPklFilesDoc(Document):
     def file(self):
         return TICKS_PATH / self.zip_path
     @property
+    def engine(self):       # 存储引擎，由`zip_ver`决定
+        return get_engine(self.zip_ver)
+    @property
     def _f_name(self):
         return self.file.name
     @property
@@ -641,12 +718,42 @@ class TickSplitPklFilesDoc(Document):
         self.file_doc.update(pull__tags='splited', set__doc_num=0)
         self.delete()
 
+    # 批量替换切分：file_splits = {file_doc的pk: `TickFilesDoc._split_to_files()`返回的splits}
+    # 以前的切分一次查出来，删除它们的特征文件和不再使用的数据文件(同名的已经被新文件覆盖)，再用一次`insert_many`写入新的切分。
+    # 返回写入的doc数
+    @classmethod
+    def replace_splits(cls, file_splits):
+        if not file_splits:
+            return 0
+        new_files = {split['zip_path'] for splits in file_splits.values() for split in splits}
+        old_ids = []
+        stale_files = []
+        for old in cls.objects(file_doc__in=list(file_splits)).only('id', 'zip_path', 'feature_files').as_pymongo():
+            old_ids.append(old['_id'])
+            if not old.get('zip_path'):
+                continue
+            _file = TICKS_PATH / old['zip_path']
+            _feature_path = _file.parent / f'{_file.stem}_feature'
+            stale_files += [_feature_path / _f for _f in old.get('feature_files', [])]
+            if old['zip_path'] not in new_files:
+                stale_files.append(_file)
+        delete_files(stale_files)
+        if old_ids:
+            cls.objects(id__in=old_ids).delete()
+
+        docs = [cls(**split) for splits in file_splits.values() for split in splits]
+        if docs:
+            cls.objects.insert(docs, load_bulk=False)
+        return len(docs)
+
     # 加载ticks
-    def load_ticks(self):
+    #   - columns: 只加载指定的列
+    #   - start/end: 只加载`UpdateTime`在[start, end]之间的数据
+    def load_ticks(self, columns=None, start=None, end=None):
         if not self.zip_exists():
             logger.warn(f'ERROR: Not Exists: {self!r}')
             return None
-        _df = pd.read_pickle(self.file, compression=PICKLE_COMPRESSION)
+        _df = tick_cache.load(self.file, self.engine, columns=columns, start=start, end=end)
         return _df
 
     # def _to_pkl(self, df):
@@ -665,14 +772,12 @@ class TickSplitPklFilesDoc(Document):
                     _path = _path.parent
             except Exception:
                 pass
-        self.update(set__feature_files=[], set__feature_num=0)
-        self.reload()
+        meta_buffer.update(self, set__feature_files=[], set__feature_num=0)
 
     def save_features(self, df, name):
         self.feature_path.mkdir(parents=True, exist_ok=True)
         df.to_pickle(self.feature_path/name, compression=PICKLE_COMPRESSION)
-        self.update(push__feature_files=name, inc__feature_num=1, set__feature_time=datetime.datetime.now())
-        self.reload()
+        meta_buffer.update(self, push__feature_files=name, inc__feature_num=1, set__feature_time=datetime.datetime.now())
 
     def load_feature(self):
         pass
@@ -1,14 +1,18 @@
 # import datetime
+import hashlib
 import logging
+import numpy as np
+import pandas as pd
+from bson import ObjectId
 from mongoengine import *
-# import pandas as pd
 # from pathlib import Path
 # from ..apis.apis import format_file_size, format_time
 # from tqdm import tqdm_notebook as tqdm
 
 __all__ = (
         'STORED_CATEGORY_LIST', 'KLINE_BINS_LIST',
-        'get_dyn_ticks_doc', 'get_dyn_dominant_ticks_doc', 'KlineDoc', 'StatisDayDoc',
+        'get_dyn_ticks_doc', 'get_dyn_dominant_ticks_doc', 'bulk_insert_ticks', 'KlineDoc', 'StatisDayDoc',
+        'KlineProgressDoc', 'bulk_write_klines', 'load_klines_df',
         'ModelException',
     )
 
@@ -139,6 +143,53 @@ def get_dyn_ticks_doc(_collection_name):
     return TicksDoc
 
 
+# 批量写入tick数据，代替逐行`save()`。
+#   - doc_cls: `get_dyn_ticks_doc()`返回的类，只写入doc中定义了的列
+#   - file_key: 数据来源(如原始文件的相对路径)，和行号一起生成确定的`_id`
+#   - batch_size: 每次`insert_many`的条数
+# `_id`由`UpdateTime`的秒数(4字节，保持按时间有序) + file_key的hash(4字节) + 行号(4字节)组成，
+# 同一个文件重复导入时`_id`相同，已经存在的行跳过(忽略duplicate key错误)，中断后重新导入即可继续。
+# 返回新写入的条数。
+def bulk_insert_ticks(doc_cls, df, file_key, batch_size=10000):
+    if df.empty:
+        return 0
+    from pymongo.errors import BulkWriteError
+
+    fields = [name for name in doc_cls._fields if name not in ['id', 'tags']]
+    ids = _tick_ids(df['UpdateTime'], file_key)
+    valid = df['UpdateTime'].notna().to_numpy()         # 时间解析失败的行无法写入
+    df = df.loc[valid, [col for col in df.columns if col in fields]]
+    ids = [_id for _id, ok in zip(ids, valid) if ok]
+
+    collection = doc_cls._get_collection()
+    inserted = 0
+    for i in range(0, df.shape[0], batch_size):
+        records = df.iloc[i:i+batch_size].to_dict('records')
+        for _id, record in zip(ids[i:i+batch_size], records):
+            record['_id'] = _id
+            record['tags'] = []
+        try:
+            inserted += len(collection.insert_many(records, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            others = [err for err in errors if err.get('code') != 11000]
+            if others:
+                raise
+            inserted += e.details.get('nInserted', 0)
+            logger.debug(f'[{file_key}]: skip {len(errors)} existing ticks.')
+    return inserted
+
+
+def _tick_ids(update_time, file_key):
+    n = update_time.shape[0]
+    buf = np.empty((n, 12), dtype=np.uint8)
+    seconds = (update_time.to_numpy(dtype='datetime64[s]').astype('i8') & 0xffffffff).astype('>u4')
+    buf[:, :4] = seconds.view(np.uint8).reshape(n, 4)
+    buf[:, 4:8] = np.frombuffer(hashlib.blake2b(str(file_key).encode(), digest_size=4).digest(), dtype=np.uint8)
+    buf[:, 8:] = np.arange(n, dtype='>u4').view(np.uint8).reshape(n, 4)
+    return [ObjectId(row.tobytes()) for row in buf]
+
+
 # 主力合约(dominant contract) tick数据集。实现分表存储。
 # 没必要单独存储！！！在`KlineDoc`中加`isDominant`字段即可。
 def get_dyn_dominant_ticks_doc(_collection_name):
@@ -204,6 +255,7 @@ class KlineDoc(Document):
         'index_background': True,
         'auto_create_index': True,          # 每次操作都检查。TODO: Disabling this will improve performance.
         'indexes': [
+            ('InstrumentID', 'level', 'TradingTime'),       # `bulk_write_klines()`的upsert条件。不是唯一索引，已有的数据可能有重复
             'TradingTime',
             'InstrumentID',
             'level',
@@ -257,6 +309,23 @@ class KlineDoc(Document):
     #     return queryset.filter(status__ne='drop')
 
 
+# K线增量更新的进度，每个(合约, 粒度)一个doc，见`update_kline_by_id()`
+class KlineProgressDoc(Document):
+    meta = {
+        'collection': 'kline_progress',
+        'db_alias': 'kline',
+        'index_background': True,
+        'auto_create_index': True,          # 每次操作都检查。TODO: Disabling this will improve performance.
+        'indexes': [
+            ('InstrumentID', 'level'),
+        ]
+    }
+    InstrumentID = StringField()            # 合约代码
+    level = StringField()                   # K线粒度，日K为'1d'
+    last_bar = DateTimeField()              # 最后一根K线的`TradingTime`，可能不完整，下次从它所在的交易日开始重新计算
+    update_time = DateTimeField()
+
+
 class StatisDayDoc(Document):
     meta = {
         'collection': 'day_related',
@@ -264,6 +333,7 @@ class StatisDayDoc(Document):
         'index_background': True,
         'auto_create_index': True,          # 每次操作都检查。TODO: Disabling this will improve performance.
         'indexes': [
+            ('InstrumentID', 'TradingTime'),                # `bulk_write_klines()`的upsert条件。不是唯一索引，已有的数据可能有重复
             'TradingTime',
             'InstrumentID',
             'category',
@@ -333,3 +403,71 @@ class StatisInstrumentDoc(Document):
 
     tick_num = IntField()                       #
     highest_price = FloatField()                #
+
+
+# 批量写入K线(`KlineDoc`/`StatisDayDoc`)，直接用pymongo，不创建mongoengine对象。
+# 写入的字段和默认值同mongoengine的`to_mongo()`，和已有的数据格式一致。
+#   - kline_df: `gen_kline_from_pd()`的结果，doc中没有的列忽略
+#   - upsert: False时用无序的`insert_many`，调用方需要先删除旧数据；
+#             True时按(InstrumentID, level, TradingTime)upsert(StatisDayDoc没有level)，只更新kline_df中的列，可以重复执行
+# 返回写入的条数
+def bulk_write_klines(doc_cls, kline_df, upsert=False, batch_size=10000):
+    if kline_df.empty:
+        return 0
+    from pymongo import UpdateOne
+
+    fields = _db_fields(doc_cls)
+    kline_df = kline_df[[col for col in kline_df.columns if col in fields]]
+    # 和`IntField.to_mongo()`一样保存为整数
+    int_cols = [col for col in kline_df.columns if isinstance(doc_cls._fields[col], IntField) and kline_df[col].dtype.kind == 'f' and kline_df[col].notna().all()]
+    kline_df = kline_df.astype({col: 'int64' for col in int_cols})
+    defaults = doc_cls().to_mongo().to_dict()
+    keys = [key for key in ['InstrumentID', 'level', 'TradingTime'] if key in fields]
+
+    collection = doc_cls._get_collection()
+    cnt = 0
+    for i in range(0, kline_df.shape[0], batch_size):
+        records = kline_df.iloc[i:i+batch_size].to_dict('records')
+        if upsert:
+            # 默认值只在新建时写入，已有K线的`isDominant`/`tags`等不在kline_df中的字段保持不变
+            ops = [UpdateOne({key: record[key] for key in keys},
+                             {'$set': record, '$setOnInsert': {k: v for k, v in defaults.items() if k not in record}}, upsert=True)
+                   for record in records]
+            res = collection.bulk_write(ops, ordered=False)
+            cnt += res.upserted_count + res.modified_count
+        else:
+            cnt += len(collection.insert_many([{**defaults, **record} for record in records], ordered=False).inserted_ids)
+    return cnt
+
+
+# 批量读取K线为df，直接用pymongo按批解码，不创建mongoengine对象。
+#   - columns: 只加载这些字段，None表示doc中的所有字段(不包括`_id`)，列的顺序同doc的定义
+#   - q_f: 查询条件，同mongoengine
+# 安装了pymongoarrow时直接解码为Arrow数组。
+def load_klines_df(doc_cls, columns=None, batch_size=10000, **q_f):
+    columns = list(columns or _db_fields(doc_cls))
+    queryset = doc_cls.objects(**q_f)
+    projection = {'_id': 0, **{col: 1 for col in columns}}
+    try:
+        from pymongoarrow.api import find_pandas_all
+    except ImportError:
+        find_pandas_all = None
+    if find_pandas_all is not None:
+        df = find_pandas_all(doc_cls._get_collection(), queryset._query, projection=projection)
+        return df.reindex(columns=columns)
+
+    frames = []
+    batch = []
+    for record in queryset.only(*columns).exclude('id').as_pymongo().batch_size(batch_size):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            frames.append(pd.DataFrame.from_records(batch, columns=columns))
+            batch = []
+    if batch or not frames:
+        frames.append(pd.DataFrame.from_records(batch, columns=columns))
+    return pd.concat(frames, ignore_index=True)
+
+
+# doc中的字段名，按定义的顺序，不包括`id`
+def _db_fields(doc_cls):
+    return [name for name in doc_cls._fields_ordered if name != 'id']
@@ -1,10 +1,15 @@
-import datetime
 import logging
+import numpy as np
 import pandas as pd
 from pathlib import Path
 from tqdm import tqdm_notebook as tqdm
 from .tick_file_doc import TickFilesDoc
 from .conf import *
+from .storage import get_engine, get_storage_ver
+from .raw_csv import get_raw_columns, read_raw_csv, wash_raw_df
+from .sessions import calc_time_type
+from .tick_stats import TickStats
+from .meta_buffer import meta_buffer
 
 __all__ = (
         'PickleDbTick', 'PickleDbTicks',
@@ -33,6 +38,7 @@ class PickleDbTick():
         self.rel_file = None   # 相对路径，to save in db
         self.file = None       # 绝对路径
         if tick_doc.zip_path:
+            self.engine = get_engine(tick_doc.zip_ver)
             self.rel_file = Path(tick_doc.zip_path)   # 相对路径，to save in db
             self._rel_path = self.rel_file.parent
             self.abs_path = TICKS_PATH / self._rel_path
@@ -41,9 +47,10 @@ class PickleDbTick():
         else:
             # mkt / cat / 合约 / day / f'{合约}_{day}_{zip_ver}.pkl'
             # 4/AG/AG1401/20140108/AG1401_20140108_1.pkl
+            self.engine = get_engine(get_storage_ver(tick_doc.category))     # 还没有生成文件，按品种选择存储格式
             self._rel_path = Path(f'{tick_doc.MarketID}/{tick_doc.category}/{tick_doc.InstrumentID}/{tick_doc.month}/')
             self.abs_path = TICKS_PATH / self._rel_path
-            self.f_name = f'{tick_doc.InstrumentID}_{tick_doc.day}.pkl'
+            self.f_name = f'{tick_doc.InstrumentID}_{tick_doc.day}{self.engine.suffix}'
             self.rel_file = self._rel_path / self.f_name   # to save in db
             self.file = self.abs_path / self.f_name
 
@@ -69,13 +76,13 @@ class PickleDbTick():
         self.tick_doc.update(set__zip_line_num=0, set__zip_path=None)
         self.tick_doc.reload()
 
-    # 加载ticks
-    def load_ticks(self):
+    # 加载ticks，`columns`只加载指定的列
+    def load_ticks(self, columns=None):
         if not self.file.exists():
             if self.tick_doc.zip_path and 'empty_df' not in self.tick_doc.tags:
                 logger.error(f'ERROR: tick[{self.tick_doc.pk}] has not stored, but file[{self.tick_doc.zip_path}] exists!')
             return None
-        _df = pd.read_pickle(self.file, compression=PICKLE_COMPRESSION)
+        _df = self.engine.read(self.file, columns=columns)
         return _df
 
     # 保存tick到pkl文件
@@ -89,23 +96,23 @@ class PickleDbTick():
                 logger.warn(f'Pls check tick_doc: {self.tick_doc!r}')
                 return
             if pkl.zip_exists():
-                logger.warn(f'pkl already exists: {self.tick_doc!r}')
-                return
+                if self.tick_doc.zip_path:
+                    logger.warn(f'pkl already exists: {self.tick_doc!r}')
+                    return
+                # 文件已经生成，但元数据没有写入(进程崩溃时`meta_buffer`中的修改丢失)，重新处理
+                logger.info(f'pkl exists but not recorded, reprocess: {self.tick_doc!r}')
 
         try:
             df, line_num = self._load_df_from_csv()
-            self.tick_doc.update(set__line_num=line_num)
-            self.tick_doc.reload()
+            meta_buffer.update(self.tick_doc, set__line_num=line_num)
         except Exception:
             logger.error(f'Load df fail: {self.tick_doc!r}')
-            self.tick_doc.update(add_to_set__tags='load_df_fail')
-            self.tick_doc.reload()
+            meta_buffer.update(self.tick_doc, add_to_set__tags='load_df_fail')
             return
 
         if df.empty:
             logger.error(f'df.empty error: {self.tick_doc!r}')
-            self.tick_doc.update(add_to_set__tags='empty_df', set__doc_num=0)
-            self.tick_doc.reload()
+            meta_buffer.update(self.tick_doc, add_to_set__tags='empty_df', set__doc_num=0)
             return
 
         # 处理时间信息
@@ -116,166 +123,217 @@ class PickleDbTick():
             diff_sec = diff.total_seconds()
         except Exception:
             logger.error(f'calc diff_sec error: {self.tick_doc!r}, {start}, {end}')
-            self.tick_doc.update(add_to_set__tags='diff_sec_error', set__doc_num=0)
-            self.tick_doc.reload()
+            meta_buffer.update(self.tick_doc, add_to_set__tags='diff_sec_error', set__doc_num=0)
             return
-        self.tick_doc.update(set__start=start, set__end=end, set__diff_sec=diff_sec)
-        self.tick_doc.reload()
+        meta_buffer.update(self.tick_doc, set__start=start, set__end=end, set__diff_sec=diff_sec)
 
-        # 将日夜盘交易时间拉会到同一天处理：
-        #    09:00:00 -> 05:40:00
-        #    10:15:00 -> 06:55:00
-        #    10:30:00 -> 07:10:00
-        #    11:30:00 -> 08:10:00
-        #    13:30:00 -> 10:10:00
-        #    15:00:00 -> 11:40:00
-        #    21:00:00 -> 17:40:00
-        #    02:30:00 -> 23:10:00
-        df['UpdateTime_delay'] = df['UpdateTime'] + datetime.timedelta(hours=-3, minutes=-20)
-        df['_UpdateTime_hour'] = df['UpdateTime_delay'].map(lambda x: (x.hour))
-        time_period = dict(
-            fam=(4, 6),     # 05:40:00 <= _ <= 06:55:00,    4 <= _ <= 6
-            bam=(7, 8),     # 07:10:00 <= _ <= 08:10:00,    7 <= _ <= 8
-            pm=(9, 14),     # 10:10:00 <= _ <= 11:40:00,    9 <= _ <= 14
-            night=(15, 24), # 17:40:00 <= _ <= 23:10:00,   15 <= _ <= 24
-        )
-
-        df['time_type'] = 'unknow'
-        for _type, _time in time_period.items():
-            _start, _end = _time
-            # print(_type, _start, _end)
-            df.loc[(df._UpdateTime_hour >= _start) & (df._UpdateTime_hour <= _end), ['time_type']] = _type
+        # 交易时段，见`sessions.py`
+        df['time_type'] = calc_time_type(df['UpdateTime'])
 
         unknow_num = df[df.time_type == 'unknow'].shape[0]
         if unknow_num:
             logger.error(f'calc time_type error: {self.tick_doc!r}, unknow_num={unknow_num}')
-            self.tick_doc.update(add_to_set__tags='time_error', set__doc_num=0)
-            self.tick_doc.reload()
+            meta_buffer.update(self.tick_doc, add_to_set__tags='time_error', set__doc_num=0)
             return
 
-        df = df.drop(['UpdateTime_delay', '_UpdateTime_hour'], axis=1)
+        df = df.sort_values('UpdateTime', kind='mergesort')     # 按时间有序存储，按时间范围读取时才能跳过数据
 
         # save pickle
         self._to_pkl(df)
         # self.abs_path.mkdir(parents=True, exist_ok=True)
         # df.to_pickle(self.file, compression=PICKLE_COMPRESSION)
 
-        # update tick_doc
-        self.tick_doc.update(set__zip_line_num=df.shape[0], set__zip_path=str(self.rel_file))
-        self.tick_doc.reload()
+        # update tick_doc，统计量一起写入
+        meta_buffer.update(self.tick_doc, set__zip_line_num=df.shape[0], set__zip_path=str(self.rel_file), set__zip_ver=self.engine.ver,
+                           **TickStats().add(df).to_update())
 
     def _to_pkl(self, df):
         self.abs_path.mkdir(parents=True, exist_ok=True)
-        df.to_pickle(self.file, compression=PICKLE_COMPRESSION)
+        self.engine.write(df, self.file)
 
-    # 从源数据中加载数据
+    # 从源数据中加载数据，只解析需要的列
     def _load_df_from_csv(self):
         tmpPath = RAW_DATA_PATH / self.tick_doc.path
-        pd_data = pd.read_csv(
-                    tmpPath,
-                    names=['InstrumentID', 'MarketID', 'LastPrice', 'LastVolume', 'hhmmss', 'Reserved', 'UpdateTime', 'AskPrice1',
-                           'AskVolume1', 'BidPrice1', 'BidVolume1', 'AskPrice2', 'AskVolume2', 'BidPrice2', 'BidVolume2',
-                           'AskPrice3', 'AskVolume3', 'BidPrice3', 'BidVolume3', 'AskPrice4', 'AskVolume4', 'BidPrice4', 'BidVolume4',
-                           'AskPrice5', 'AskVolume5', 'BidPrice5', 'BidVolume5', 'OpenInterest', 'Turnover', 'AvePrice', 'invol', 'outvol',
-                           'Attr1', 'Volume1', 'Attr2', 'Volume2', 'HighestPrice', 'LowestPrice', 'SettlePrice', 'OpenPrice', 'mainID', 'fill'],
-                    low_memory=False, parse_dates=['UpdateTime'], dtype={'hhmmss': str}, error_bad_lines=False, warn_bad_lines=False
-                )
-
-        drop_cols = [
-                        # 'AskPrice1', 'AskVolume1', 'BidPrice1', 'BidVolume1',
-                        'AskPrice2', 'AskVolume2', 'BidPrice2', 'BidVolume2',
-                        'AskPrice3', 'AskVolume3', 'BidPrice3', 'BidVolume3',
-                        'AskPrice4', 'AskVolume4', 'BidPrice4', 'BidVolume4',
-                        'AskPrice5', 'AskVolume5', 'BidPrice5', 'BidVolume5',
-                        'Reserved', 'invol', 'outvol',
-                        'Attr1', 'Volume1', 'Attr2', 'Volume2',
-                        'fill',
-                    ]
-
-        # 删掉不需要的列
-        if self.tick_doc.subID == '0000':           # 指数
-            drop_cols += ['HighestPrice', 'LowestPrice', 'OpenPrice', 'SettlePrice', 'Turnover', 'AvePrice', 'mainID']
-        elif self.tick_doc.subID == '9999':         # 主力
-            drop_cols += ['SettlePrice']
-        else:                                       # ticks
-            drop_cols += ['SettlePrice', 'mainID']
-        pd_data.drop(drop_cols, axis=1, inplace=True)
-
+        columns = get_raw_columns(self.tick_doc.MarketID, self.tick_doc.subID)
+        pd_data = read_raw_csv(tmpPath, columns, skip_bad_lines=True)
         line_num = pd_data.shape[0]
 
-        # 处理时间字段
-        pd_data = pd_data[(pd_data.UpdateTime < MAX_DATE) & (pd_data.UpdateTime > MIN_DATE)]
-        pd_data['UpdateTime'] = pd.to_datetime(pd_data.UpdateTime)
-        # 处理交易量字段
-        pd_data = pd_data[pd_data.LastVolume >= 0]
-
+        pd_data = wash_raw_df(pd_data)
         if line_num > 7000 and line_num != pd_data.shape[0]:
             logger.info(f'[{self.tick_doc.path}]: after washing: {line_num}->{pd_data.shape[0]}.')
 
-        # pd_data['subID'] = pd_data.InstrumentID.str[-4:]
-
         return pd_data, line_num
 
 
 # 批量加载tick数据
+#   - catalog: `TickCatalog`，指定时从本地快照中选择文件，不访问Mongo。此时`self.ticks`为None，筛选结果在`self.files`中。
 class PickleDbTicks():
-    def __init__(self, q_f, main_cls='main'):
+    def __init__(self, q_f, main_cls='main', catalog=None):
         self.main_cls = main_cls
-        if main_cls == 'main':
-            self.ticks = TickFilesDoc.main(**q_f)
-        elif main_cls == 'sub_main':
-            self.ticks = TickFilesDoc.sub_main(**q_f)
+        self.catalog = catalog
+        self.ticks = None
+        self.files = None
+        if catalog is not None:
+            self.files = catalog.query(main_cls=main_cls, **q_f)
+            self.total = self.files.shape[0]
         else:
-            self.ticks = TickFilesDoc.objects(**q_f)
-        self.total = self.ticks.count()
+            if main_cls == 'main':
+                self.ticks = TickFilesDoc.main(**q_f)
+            elif main_cls == 'sub_main':
+                self.ticks = TickFilesDoc.sub_main(**q_f)
+            else:
+                self.ticks = TickFilesDoc.objects(**q_f)
+            self.total = self.ticks.count()
 
         # logger.info(f'total={self.total}')
 
     # 加载`q_f`筛选到的数据
-    def load_ticks(self, with_clean=True):
-        df_l = []
+    #   - columns: 只从文件中加载这些列，如：['UpdateTime', 'LastPrice', 'LastVolume', 'BidPrice1', 'AskPrice1']
+    #   - start/end: 只加载`UpdateTime`在[start, end]之间的数据。先用`TickFilesDoc`的`start`/`end`跳过整个文件，
+    #     文件内再按时间索引只读需要的部分。
+    #   - workers: 并发加载文件的数量，<=1时顺序加载。结果的顺序和顺序加载一致。
+    #   - use_thread: 使用线程池，否则使用进程池。解压主要在C代码里，一般线程池就够了。
+    # 文件按`start`顺序加载，每个文件本身是按时间排序的，所以按`zip_line_num`预分配好内存后逐个拷贝即可，
+    # 不需要`pd.concat`和整体排序。只有文件之间时间有重叠时才做一次归并排序。
+    def load_ticks(self, with_clean=True, columns=None, start=None, end=None, workers=0, use_thread=True):
+        ticks, columns, start, end = self._prepare_load(columns, start, end)
+
+        buf = _FrameBuffer(sum(tick.zip_line_num or 0 for tick in ticks))
+        last_time = None
+        overlap = False
         with tqdm(total=self.total, desc=f'Progress:', disable=True) as pbar:
-            for tick in self.ticks:
+            for tick, _df in self._iter_tick_dfs(ticks, columns, start, end, workers, use_thread):
                 pbar.update(1)
                 # pkl = PickleDbTick(tick)
-                _df = tick.load_ticks()
                 if _df.empty:
-                    logger.warning(f'{tick.path} load df fail.')
+                    if start is None and end is None:       # 按时间范围加载时，文件内可能没有数据
+                        logger.warning(f'{tick.path} load df fail.')
                     continue
-                _df['day'] = tick.day
 
-                df_l.append(_df)
+                if not _df['UpdateTime'].is_monotonic_increasing:      # 老文件没有排序
+                    _df = _df.sort_values('UpdateTime', kind='mergesort')
+                if last_time is not None and _df['UpdateTime'].iloc[0] < last_time:
+                    overlap = True
+                last_time = max(last_time, _df['UpdateTime'].iloc[-1]) if last_time is not None else _df['UpdateTime'].iloc[-1]
 
-        # df.sort_values('UpdateTime', inplace=True)
-        df = pd.concat(df_l, sort=False)
+                if with_clean:
+                    _df = _df.drop(CLEAN_DROP_COLS, axis=1, errors='ignore')
+                _df['day'] = tick.day
+                buf.append(_df)
+
+        df = buf.to_frame()
+        if overlap:
+            df = df.sort_values('UpdateTime', kind='mergesort').reset_index(drop=True)
 
         # clean df
         if with_clean:
-            drop_cols = [
-                # 'InstrumentID', 'MarketID', 'mainID', 'day',
-                # 'AskPrice2', 'AskPrice3', 'AskPrice4', 'AskPrice5',
-                # 'AskVolume2', 'AskVolume3', 'AskVolume4', 'AskVolume5',
-                # 'BidPrice2', 'BidPrice3', 'BidPrice4', 'BidPrice5',
-                # 'BidVolume2', 'BidVolume3', 'BidVolume4', 'BidVolume5',
-                'hhmmss',
-                'Reserved',
-                'Attr1', 'Volume1',
-                'Attr2', 'Volume2',
-                'AvePrice',
-                'OpenPrice', 'HighestPrice', 'LowestPrice',
-                'SettlePrice',
-                'invol', 'outvol',
-                'fill',
-            ]
-            df = df.drop(drop_cols, axis=1)
-            for col in ['InstrumentID', 'MarketID', 'mainID', 'day', 'time_type']:
-                df[col] = df[col].astype('category')
-
-        df.sort_values('UpdateTime', inplace=True)
+            df = _clean_df(df)
+
         return df
 
+    # 逐块返回`q_f`筛选到的数据，内存中只需要保留一块数据，适合长时间段的处理。
+    # 每块都按时间排序，`with_clean`的处理和`load_ticks`一致。
+    #   - chunk:
+    #       - 'day': 每个文件一块
+    #       - 'session': 按交易时段(`time_type`连续相同的部分)切分
+    #       - int: 每块N行，最后一块可能不足N行
+    #   - 其它参数同`load_ticks`
+    def iter_ticks(self, chunk='day', with_clean=True, columns=None, start=None, end=None, workers=0, use_thread=True):
+        if not (chunk in ['day', 'session'] or (isinstance(chunk, int) and chunk > 0)):
+            raise PickleDbException(f'Invalid chunk={chunk}.')
+        if chunk == 'session' and columns is not None and 'time_type' not in columns:
+            columns = [*columns, 'time_type']
+        ticks, columns, start, end = self._prepare_load(columns, start, end)
+
+        buf = []        # chunk为行数时，缓存不足N行的数据
+        buf_rows = 0
+        for tick, _df in self._iter_tick_dfs(ticks, columns, start, end, workers, use_thread):
+            if _df.empty:
+                if start is None and end is None:
+                    logger.warning(f'{tick.path} load df fail.')
+                continue
+            _df['day'] = tick.day
+            _df = _df.sort_values('UpdateTime', kind='mergesort')
+
+            if chunk == 'day':
+                yield _clean_df(_df) if with_clean else _df
+            elif chunk == 'session':
+                session_id = (_df['time_type'] != _df['time_type'].shift()).cumsum()
+                for _, _s in _df.groupby(session_id, sort=False):
+                    yield _clean_df(_s) if with_clean else _s
+            else:
+                buf.append(_df)
+                buf_rows += _df.shape[0]
+                if buf_rows < chunk:
+                    continue
+                df = pd.concat(buf, sort=False)
+                n = (buf_rows // chunk) * chunk
+                for i in range(0, n, chunk):
+                    _chunk = df.iloc[i:i+chunk]
+                    yield _clean_df(_chunk) if with_clean else _chunk
+                buf = [df.iloc[n:]]
+                buf_rows -= n
+
+        if buf_rows:
+            df = pd.concat(buf, sort=False)
+            yield _clean_df(df) if with_clean else df
+
+    # 根据参数处理查询，返回按`start`排序的`TickFilesDoc`列表
+    def _prepare_load(self, columns, start, end):
+        if columns is not None and 'UpdateTime' not in columns:
+            columns = ['UpdateTime', *columns]      # 排序需要
+        if start is not None:
+            start = pd.Timestamp(start)
+        if end is not None:
+            end = pd.Timestamp(end)
+
+        if self.catalog is not None:
+            files = self.files
+            if start is not None:
+                files = files[files['end'] >= start]
+            if end is not None:
+                files = files[files['start'] <= end]
+            ticks = self.catalog.to_docs(files.sort_values('start', kind='mergesort'))
+        else:
+            ticks = self.ticks
+            if start is not None:
+                ticks = ticks.filter(end__gte=start)
+            if end is not None:
+                ticks = ticks.filter(start__lte=end)
+            ticks = list(ticks.order_by('start'))
+        return ticks, columns, start, end
+
+    # 筛选到的所有交易日
+    def days(self):
+        if self.catalog is not None:
+            return sorted(self.files['day'].dropna().unique())
+        return sorted(self.ticks.distinct('day'))
+
+    # 按`ticks`的顺序返回(tick, df)
+    def _iter_tick_dfs(self, ticks, columns, start, end, workers=0, use_thread=True):
+        if workers <= 1:
+            for tick in ticks:
+                yield tick, tick.load_ticks(columns=columns, start=start, end=end)
+            return
+
+        ticks = list(ticks)
+        if not ticks:
+            return
+        if use_thread:
+            from multiprocessing.dummy import Pool
+        else:
+            from multiprocessing import Pool
+        params = [(tick, columns, start, end) for tick in ticks]
+        with Pool(min(workers, len(ticks))) as pool:
+            # imap保持输入顺序，同时已经加载好的文件可以先处理
+            for tick, _df in zip(ticks, pool.imap(_load_tick, params)):
+                yield tick, _df
+
     # 从`TickFilesDoc`加载日K
     def load_days(self):
+        if self.catalog is not None:
+            return self.files.drop(['_id', 'tags', 'zip_ver', 'zip_path', 'stored', 'data_type'], axis=1, errors='ignore').reset_index(drop=True)
+
         buf = []
         for tick in self.ticks:
             item = tick.to_mongo().to_dict()
@@ -286,3 +344,119 @@ class PickleDbTicks():
         df = pd.DataFrame.from_dict(buf)
 
         return df
+
+
+# 进程池中加载单个文件
+def _load_tick(params):
+    tick, columns, start, end = params
+    return tick.load_ticks(columns=columns, start=start, end=end)
+
+
+# `with_clean`时删掉的列
+CLEAN_DROP_COLS = [
+    # 'InstrumentID', 'MarketID', 'mainID', 'day',
+    # 'AskPrice2', 'AskPrice3', 'AskPrice4', 'AskPrice5',
+    # 'AskVolume2', 'AskVolume3', 'AskVolume4', 'AskVolume5',
+    # 'BidPrice2', 'BidPrice3', 'BidPrice4', 'BidPrice5',
+    # 'BidVolume2', 'BidVolume3', 'BidVolume4', 'BidVolume5',
+    'hhmmss',
+    'Reserved',
+    'Attr1', 'Volume1',
+    'Attr2', 'Volume2',
+    'AvePrice',
+    'OpenPrice', 'HighestPrice', 'LowestPrice',
+    'SettlePrice',
+    'invol', 'outvol',
+    'fill',
+]
+
+
+# 删掉不需要的列，并把重复值多的列转为category
+def _clean_df(df):
+    df = df.drop(CLEAN_DROP_COLS, axis=1, errors='ignore')
+    for col in ['InstrumentID', 'MarketID', 'mainID', 'day', 'time_type']:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+
+# 按列预分配内存，逐个把df拷贝进来，最后生成一个df。
+# `capacity`只是预估的行数，不够时自动扩容；各个df的列和类型不一致时，缺失值用NaN/None填充，类型自动提升。
+class _FrameBuffer():
+    def __init__(self, capacity):
+        self.capacity = max(int(capacity or 0), 0)
+        self.size = 0
+        self.columns = {}       # col -> np.ndarray
+
+    def append(self, df):
+        n = df.shape[0]
+        end = self.size + n
+        if end > self.capacity:
+            self._resize(max(end, self.capacity * 2))
+
+        for col in df.columns:
+            values = df[col].to_numpy()
+            arr = self.columns.get(col)
+            if arr is None:
+                arr = self._new_column(values.dtype)
+            else:
+                dtype = _common_dtype(arr.dtype, values.dtype)
+                if dtype != arr.dtype:
+                    arr = arr.astype(dtype)
+            arr[self.size:end] = values
+            self.columns[col] = arr
+
+        # 这个df中没有的列
+        for col, arr in self.columns.items():
+            if col not in df.columns:
+                arr = _with_na(arr)
+                arr[self.size:end] = _na_value(arr.dtype)
+                self.columns[col] = arr
+
+        self.size = end
+
+    def _new_column(self, dtype):
+        dtype = _with_na(np.empty(0, dtype=dtype)).dtype if self.size else dtype
+        arr = np.empty(self.capacity, dtype=dtype)
+        if self.size:
+            arr[:self.size] = _na_value(dtype)
+        return arr
+
+    def _resize(self, capacity):
+        for col, arr in self.columns.items():
+            _arr = np.empty(capacity, dtype=arr.dtype)
+            _arr[:self.size] = arr[:self.size]
+            self.columns[col] = _arr
+        self.capacity = capacity
+
+    def to_frame(self):
+        if self.capacity > self.size * 1.25:       # 预估偏大时释放多余的内存
+            self._resize(self.size)
+        return pd.DataFrame({col: arr[:self.size] for col, arr in self.columns.items()}, copy=False)
+
+
+# 两个列的公共类型：数值之间按numpy的规则提升，datetime64/timedelta64的单位不同时取更精确的单位，
+# 只有真正不兼容的类型(如数值和字符串、datetime和数值)才用object
+def _common_dtype(a, b):
+    if a == b:
+        return a
+    if (a.kind in 'biuf' and b.kind in 'biuf') or (a.kind == b.kind and a.kind in 'mMUS'):
+        return np.promote_types(a, b)
+    return np.dtype(object)
+
+
+# 可以存放缺失值的类型
+def _with_na(arr):
+    if arr.dtype.kind in 'iu':
+        return arr.astype('float64')
+    if arr.dtype.kind == 'b':
+        return arr.astype(object)
+    return arr
+
+
+def _na_value(dtype):
+    if dtype.kind in 'mM':
+        return np.datetime64('NaT') if dtype.kind == 'M' else np.timedelta64('NaT')
+    if dtype.kind == 'f':
+        return np.nan
+    return None
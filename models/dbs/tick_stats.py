@@ -0,0 +1,86 @@
+import numpy as np
+
+__all__ = (
+        'TickStats',
+    )
+
+
+# tick文件的统计量，对应`TickFilesDoc`中的`open/close/high/low/mean/OpenInterest/Turnover/Turnover_calc/volume_sum`。
+# 入库时在已经解析好的df上计算，不需要再加载一遍文件。
+# 可以分块累加(分块入库)，df需要按`UpdateTime`排序，块之间也要有序。
+# 用法：
+#   stats = TickStats().add(df)
+#   doc.update(**stats.to_update())
+class TickStats():
+    def __init__(self):
+        self.rows = 0
+        self.open = None
+        self.close = None
+        self.high = None
+        self.low = None
+        self.OpenInterest = None
+        self.Turnover = None
+        self.Turnover_calc = 0.0
+        self.volume_sum = 0
+        self._price_sum = 0.0
+        self._price_cnt = 0
+
+    @property
+    def mean(self):
+        return self._price_sum / self._price_cnt if self._price_cnt else None
+
+    def add(self, df):
+        if df.empty:
+            return self
+        self.rows += df.shape[0]
+
+        price = df['LastPrice'].to_numpy(dtype='float64')
+        valid = ~np.isnan(price)
+        if valid.any():
+            _price = price[valid]
+            if self.open is None:
+                self.open = _price[0]
+            self.close = _price[-1]
+            self.high = _price.max() if self.high is None else max(self.high, _price.max())
+            self.low = _price.min() if self.low is None else min(self.low, _price.min())
+            self._price_sum += _price.sum()
+            self._price_cnt += _price.shape[0]
+
+        volume = df['LastVolume'].to_numpy(dtype='float64')
+        self.volume_sum += np.nansum(volume)
+        self.Turnover_calc += np.nansum(price * volume) * 10      # 同`Turnover_calc`字段的说明
+
+        if 'OpenInterest' in df.columns:
+            self.OpenInterest = df['OpenInterest'].iloc[-1]
+        if 'Turnover' in df.columns:
+            self.Turnover = df['Turnover'].iloc[-1]
+        return self
+
+    # 转为`update()`的参数，numpy类型转为python类型
+    def to_update(self):
+        if not self.rows:
+            return {}
+        values = dict(
+            open=_to_float(self.open),
+            close=_to_float(self.close),
+            high=_to_float(self.high),
+            low=_to_float(self.low),
+            mean=_to_float(self.mean),
+            OpenInterest=_to_int(self.OpenInterest),
+            Turnover=_to_float(self.Turnover),
+            Turnover_calc=_to_float(self.Turnover_calc),
+            volume_sum=_to_int(self.volume_sum),
+        )
+        return {f'set__{key}': value for key, value in values.items() if value is not None}
+
+
+def _to_float(value):
+    if value is None or np.isnan(value):
+        return None
+    return float(value)
+
+
+def _to_int(value):
+    if value is None or np.isnan(value):
+        return None
+    return int(value)
@@ -1,3 +1,4 @@
+import hashlib
 from pathlib import Path
 
 
@@ -13,3 +14,32 @@ def delete_file(file_or_dir: Path, recursion: bool=True):
             file_or_dir = file_or_dir.parent
     except Exception:
         print(f'delete {file_or_dir} fail.')
+
+
+# 批量删除文件，再删除变空的上级目录(每个目录只检查一次)
+def delete_files(files):
+    dirs = set()
+    for _file in files:
+        try:
+            _file.unlink()
+            dirs.add(_file.parent)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            print(f'delete {_file} fail.')
+    for _dir in sorted(dirs, key=lambda d: len(d.parts), reverse=True):
+        try:
+            while _dir.exists() and not any(_dir.iterdir()):
+                _dir.rmdir()
+                _dir = _dir.parent
+        except Exception:
+            pass
+
+
+# 文件内容的校验和
+def file_checksum(file: Path, chunk_size: int=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
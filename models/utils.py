@@ -75,17 +75,17 @@ def calc_reward(df_op, op_type, stop_loss_th, multiplier):
     return reward
 
 
-def random_load_data(cat):
+# `catalog`: `TickCatalog`，指定时不访问Mongo
+def random_load_data(cat, catalog=None):
     # 查找该主力一共有哪些天
-    ticks = PickleDbTicks(dict(category=cat, subID='9999'), main_cls='')
-    all_days = ticks.ticks.distinct('day')
-    all_days = sorted(all_days)
+    ticks = PickleDbTicks(dict(category=cat, subID='9999'), main_cls='', catalog=catalog)
+    all_days = ticks.days()
     # sel_day = random.choice(all_days)
     sel_day_idx = random.randint(0, len(all_days)-2)
     sel_day = all_days[sel_day_idx:sel_day_idx+2]
     
     # 加载数据
-    ticks = PickleDbTicks(dict(category=cat, subID='9999', day__in=sel_day), main_cls='')
+    ticks = PickleDbTicks(dict(category=cat, subID='9999', day__in=sel_day), main_cls='', catalog=catalog)
     df = ticks.load_ticks()
     drop_cols = [
         'InstrumentID', 'MarketID', 'mainID',
@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+# 生成随机的ticks，`times`为`UpdateTime`
+@pytest.fixture(scope='session')
+def make_ticks():
+    def _make_ticks(times, seed=0):
+        rng = np.random.default_rng(seed)
+        n = len(times)
+        return pd.DataFrame({
+            'UpdateTime': times,
+            'LastPrice': 100 + rng.standard_normal(n).cumsum(),
+            'LastVolume': rng.integers(0, 50, n).astype('float64'),
+            'OpenInterest': rng.integers(0, 1000, n),
+            'Turnover': rng.random(n) * 1e6,
+            'AvePrice': rng.random(n),
+            'HighestPrice': rng.random(n),
+            'LowestPrice': rng.random(n),
+            'OpenPrice': rng.random(n),
+        })
+    return _make_ticks
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+from models.dbs.tick_pickle import _FrameBuffer
+
+
+def _frame(start, n, **extra):
+    return pd.DataFrame({
+        'UpdateTime': pd.date_range(start, periods=n, freq='500ms'),
+        'LastPrice': np.arange(n, dtype='float64') + 3500,
+        **extra,
+    })
+
+
+# 结果和`pd.concat`一致
+def _check(dfs, capacity):
+    buf = _FrameBuffer(capacity)
+    for df in dfs:
+        buf.append(df)
+    pd.testing.assert_frame_equal(buf.to_frame(), pd.concat(dfs, ignore_index=True))
+    return buf
+
+
+@pytest.mark.parametrize('capacity', [0, 5, 30, 1000])
+def test_same_as_concat(capacity):
+    dfs = [_frame('2019-03-01 09:00', 10), _frame('2019-03-01 10:00', 7), _frame('2019-03-01 11:00', 13)]
+    buf = _check(dfs, capacity)
+    assert buf.size == 30
+
+
+def test_empty_frames():
+    dfs = [_frame('2019-03-01 09:00', 10), _frame('2019-03-01 10:00', 0), _frame('2019-03-01 11:00', 3)]
+    _check(dfs, 13)
+
+
+# 预估偏大时释放多余的内存
+def test_shrink_overestimated_capacity():
+    buf = _FrameBuffer(1000)
+    buf.append(_frame('2019-03-01 09:00', 10))
+    df = buf.to_frame()
+    assert buf.capacity == 10 and df.shape[0] == 10
+
+
+# 各个df的列不一致时缺失值用NaN/NaT填充
+def test_missing_columns():
+    dfs = [
+        _frame('2019-03-01 09:00', 4, BidPrice1=np.ones(4)),
+        _frame('2019-03-01 10:00', 3),
+        _frame('2019-03-01 11:00', 2, AskTime=pd.date_range('2019-03-01', periods=2)),
+    ]
+    _check(dfs, 9)
+
+
+def test_int_columns():
+    dfs = [
+        _frame('2019-03-01 09:00', 4, Volume=np.arange(4, dtype='int64')),
+        _frame('2019-03-01 10:00', 3, Volume=np.arange(3, dtype='int32')),
+    ]
+    buf = _check(dfs, 0)
+    assert buf.columns['Volume'].dtype == np.dtype('int64')
+
+
+# 类型不一致时和`pd.concat`一样提升，不退回object
+@pytest.mark.parametrize('a, b', [
+    (np.arange(4, dtype='int64'), np.linspace(0, 1, 3)),
+    (np.linspace(0, 1, 4).astype('float32'), np.linspace(0, 1, 3)),
+    (pd.date_range('2019-03-01', periods=4).values.astype('datetime64[us]'), pd.date_range('2019-03-02', periods=3).values.astype('datetime64[ns]')),
+    (np.ones(4, dtype='timedelta64[s]'), np.ones(3, dtype='timedelta64[ms]')),
+])
+def test_promote_dtype(a, b):
+    dfs = [_frame('2019-03-01 09:00', 4, x=a), _frame('2019-03-01 10:00', 3, x=b)]
+    buf = _check(dfs, 7)
+    assert buf.columns['x'].dtype != np.dtype(object)
+
+
+def test_incompatible_dtype():
+    dfs = [_frame('2019-03-01 09:00', 2, x=[1, 2]), _frame('2019-03-01 10:00', 1, x=np.array(['a'], dtype=object))]
+    buf = _FrameBuffer(3)
+    for df in dfs:
+        buf.append(df)
+    assert buf.to_frame()['x'].tolist() == [1, 2, 'a']
+
+
+# int列在后面的df中缺失时变成float
+def test_missing_int_column():
+    dfs = [_frame('2019-03-01 09:00', 2), _frame('2019-03-01 10:00', 3, Volume=np.arange(3)), _frame('2019-03-01 11:00', 2)]
+    _check(dfs, 0)
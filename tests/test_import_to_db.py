@@ -0,0 +1,23 @@
+import pandas as pd
+from import_to_db import load_df
+
+# `import_to_db.py`导入的原始文件：41列，没有`mainID`
+LINES = [
+    'HC2210,4,4000.0,10,090000,0,2022-06-06 09:00:00.500,4001.0,5,3999.0,7,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,123456,40000000.0,4000.5,0,0,0,0,0,0,4010.0,3990.0,0,3995.0,\n',
+    'HC2210,4,4002.0,3,090001,0,2022-06-06 09:00:01.000,4003.0,2,4001.0,9,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,123460,40012006.0,4000.6,0,0,0,0,0,0,4010.0,3990.0,0,3995.0,\n',
+]
+
+
+def test_load_df_41_columns(tmp_path):
+    assert len(LINES[0].split(',')) == 41
+    file = tmp_path / '20220606.spt'
+    file.write_text(''.join(LINES))
+    df = load_df(file, '2210')
+    assert df.shape[0] == 2
+    assert df['InstrumentID'].tolist() == ['HC2210', 'HC2210']
+    assert df['LastPrice'].tolist() == [4000.0, 4002.0]
+    assert df['UpdateTime'].tolist() == [pd.Timestamp('2022-06-06 09:00:00.500'), pd.Timestamp('2022-06-06 09:00:01')]
+    assert df['OpenInterest'].tolist() == [123456, 123460]
+    assert df['OpenPrice'].tolist() == [3995.0, 3995.0]
+    assert df['subID'].tolist() == ['2210', '2210']
+    assert 'mainID' not in df.columns
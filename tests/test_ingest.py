@@ -0,0 +1,169 @@
+import os
+import json
+import pytest
+from models.apis import ingest
+from models.apis.ingest import IngestJournal
+
+
+# `TickFilesDoc.objects(**q_f).only(...).as_pymongo()`
+class FakeObjects():
+    def __init__(self, docs):
+        self.docs = docs
+        self.queries = []
+
+    def __call__(self, **q_f):
+        self.queries.append(q_f)
+        docs = [doc for doc in self.docs if all(doc.get(k) == v for k, v in q_f.items())]
+        return type('QuerySet', (), dict(only=lambda *args: type('QuerySet', (), dict(as_pymongo=lambda: docs))))
+
+
+# 代替`ingest.py`中的`TickFilesDoc`，不访问Mongo
+def _stub_doc_cls(monkeypatch, docs, ingestable=True):
+    objects = FakeObjects(docs)
+    monkeypatch.setattr(ingest, 'TickFilesDoc', type('TickFilesDoc', (), dict(
+        objects=objects,
+        ingestable=staticmethod(lambda MarketID, subID: ingestable),
+    )))
+    return objects
+
+
+@pytest.fixture
+def raw_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest, 'RAW_DATA_PATH', tmp_path)
+    return tmp_path
+
+
+def _raw_file(raw_path, relative_file, data=b'x' * 10, mtime=1000):
+    file = raw_path / relative_file
+    file.parent.mkdir(parents=True, exist_ok=True)
+    file.write_bytes(data)
+    os.utime(file, (mtime, mtime))
+    return relative_file
+
+
+def _doc(relative_file, **kwargs):
+    return dict(path=relative_file, year='2019', MarketID=4, category='AG', size=10, mtime=1000, zip_path='x.pkl', line_num=100,
+                tags=[], subID='1906', **kwargs)
+
+
+def test_scan_raw_files(raw_path):
+    a = _raw_file(raw_path, '2019/4/AG/AG1906/2019/201903/20190301.spt')
+    b = _raw_file(raw_path, '2019/4/CU/CU1906/2019/201903/20190301.spt', b'x' * 20, mtime=2000)
+    _raw_file(raw_path, '2019/4/AG/AG1906/2019/201903/20190301.txt')
+    _raw_file(raw_path, '2019/5/AG/AG1906/2019/201903/20190301.spt')
+    assert sorted(ingest._scan_raw_files(2019, 4)) == [(a, 10, 1000), (b, 20, 2000)]
+    assert list(ingest._scan_raw_files(2019, 4, 'A*')) == [(a, 10, 1000)]
+    assert list(ingest._scan_raw_files(2018, 4)) == []
+    assert sorted(ingest.find_raw_files(2019, 4)) == [a, b]
+
+
+def test_discover(raw_path, monkeypatch):
+    unchanged = _raw_file(raw_path, '2019/4/AG/AG1906/2019/201903/20190301.spt')
+    new = _raw_file(raw_path, '2019/4/AG/AG1906/2019/201903/20190304.spt')
+    resized = _raw_file(raw_path, '2019/4/AG/AG1906/2019/201903/20190305.spt', b'x' * 11)
+    touched = _raw_file(raw_path, '2019/4/AG/AG1906/2019/201903/20190306.spt', mtime=2000)
+    no_mtime = _raw_file(raw_path, '2019/4/AG/AG1906/2019/201903/20190307.spt', mtime=2000)
+    unzipped = _raw_file(raw_path, '2019/4/AG/AG1906/2019/201903/20190308.spt')
+    skipped = _raw_file(raw_path, '2019/4/AG/AG1906/2019/201903/20190311.spt')
+    docs = [
+        _doc(unchanged),
+        _doc(resized),
+        _doc(touched),
+        {**_doc(no_mtime), 'mtime': None},                  # 以前没有记录mtime的只比较size
+        {**_doc(unzipped), 'zip_path': None, 'line_num': None},
+        {**_doc(skipped), 'zip_path': None, 'line_num': None, 'tags': ['empty_df']},
+    ]
+    objects = _stub_doc_cls(monkeypatch, docs)
+
+    assert sorted(ingest.discover_raw_files(2019, 4)) == sorted([new, resized, touched, unzipped])
+    assert objects.queries == [dict(year='2019', MarketID=4)]       # 只查询一次
+    assert ingest.discover_raw_files(2019, 4, 'AG') and objects.queries[-1] == dict(year='2019', MarketID=4, category='AG')
+
+
+# 不需要入库的品种，即使没有处理过也不返回
+def test_discover_not_ingestable(raw_path, monkeypatch):
+    unzipped = _raw_file(raw_path, '2019/4/AG/AG1906/2019/201903/20190308.spt')
+    _stub_doc_cls(monkeypatch, [{**_doc(unzipped), 'zip_path': None, 'line_num': None}], ingestable=False)
+    assert ingest.discover_raw_files(2019, 4) == []
+
+
+def _run(path, started, finished, commit=True):
+    journal = IngestJournal(path)
+    for relative_file in started:
+        journal.start(relative_file)
+    for relative_file, status in finished:
+        journal.finish(relative_file, status)
+    if commit:
+        journal.commit()
+    journal.close()
+
+
+def test_journal_resume(tmp_path):
+    path = tmp_path / 'journal.txt'
+    _run(path, ['a', 'b', 'c'], [('a', 'done'), ('b', 'exists')])
+    journal = IngestJournal(path)
+    assert journal.finished == {'a', 'b'}
+    assert journal.unfinished() == {'c'}
+    assert list(journal.resume(['a', 'b', 'c', 'd'])) == [('c', True), ('d', False)]
+    journal.close()
+
+
+# 元数据写入Mongo之前(commit之前)进程被杀掉，重新运行时仍然需要处理
+def test_journal_not_committed(tmp_path):
+    path = tmp_path / 'journal.txt'
+    _run(path, ['a', 'b'], [('a', 'done'), ('b', 'skipped')], commit=False)
+    journal = IngestJournal(path)
+    assert journal.finished == set()
+    assert list(journal.resume(['a', 'b', 'c'])) == [('a', True), ('b', True), ('c', False)]
+    journal.close()
+
+
+# 最后一行可能不完整
+def test_journal_truncated(tmp_path):
+    path = tmp_path / 'journal.txt'
+    _run(path, ['a', 'b'], [('a', 'done'), ('b', 'done')])
+    with open(path) as f:
+        lines = f.readlines()
+    with open(path, 'w') as f:
+        f.writelines(lines[:-1] + [lines[-1][:10]])
+    journal = IngestJournal(path)
+    assert journal.finished == {'a'}
+    assert [json.loads(line)['state'] for line in lines] == ['start', 'start', 'done', 'done']
+    journal.close()
+
+
+def test_journal_exit_on_error(tmp_path):
+    path = tmp_path / 'journal.txt'
+    with pytest.raises(ValueError):
+        with IngestJournal(path) as journal:
+            journal.start('a')
+            journal.finish('a', 'done')
+            raise ValueError
+    assert IngestJournal(path).unfinished() == {'a'}
+
+    with IngestJournal(path) as journal:
+        journal.start('a')
+        journal.finish('a', 'done')
+    assert IngestJournal(path).finished == {'a'}
+
+
+# 失败的文件不算完成，重新运行时再处理；之后处理成功的算完成
+def test_journal_retry_failed(tmp_path):
+    path = tmp_path / 'journal.txt'
+    _run(path, ['a', 'b', 'c'], [('a', 'done'), ('b', 'failed')])
+    journal = IngestJournal(path)
+    assert journal.finished == {'a'}
+    assert list(journal.resume(['a', 'b', 'c', 'd'])) == [('b', True), ('c', True), ('d', False)]
+    journal.close()
+
+    _run(path, ['b'], [('b', 'done')])
+    assert IngestJournal(path).finished == {'a', 'b'}
+    _run(path, ['a'], [('a', 'failed')])
+    assert IngestJournal(path).finished == {'b'}
+
+
+def test_journal_without_path():
+    with IngestJournal() as journal:
+        journal.start('a')
+        journal.finish('a', 'done')
+        assert list(journal.resume(['a', 'b'])) == [('a', False), ('b', False)]
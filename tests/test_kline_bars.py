@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+from models.apis.kline_bars import calc_base_bars, rollup_bars, _finish_bars
+
+
+# 随机的ticks，只在日盘fam(09:00-10:15)和夜盘的前两个小时，这些K线和按自然时间划分的结果一致
+@pytest.fixture(scope='module')
+def ticks(make_ticks):
+    rng = np.random.default_rng(0)
+    times = pd.date_range('2019-03-04 09:00', '2019-03-04 10:14:59', freq='500ms').append(
+            pd.date_range('2019-03-04 21:00', '2019-03-04 22:59:59', freq='500ms'))
+    return make_ticks(times[rng.random(len(times)) < 0.6], seed=1)
+
+
+@pytest.mark.parametrize('level', ['1min', '5min', '15min', '1H'])
+def test_rollup_matches_resample(ticks, level):
+    bars = _finish_bars(rollup_bars(calc_base_bars(ticks), level))
+    resampled = ticks.set_index('UpdateTime').resample(level.replace('H', 'h'))
+    expected = pd.DataFrame({
+        'open': resampled.LastPrice.first(),
+        'high': resampled.LastPrice.max(),
+        'low': resampled.LastPrice.min(),
+        'close': resampled.LastPrice.last(),
+        'TotalVolume': resampled.LastVolume.sum(),
+        'volume_std': resampled.LastVolume.std(),
+        'tick_num': resampled.Turnover.count(),
+    })
+    expected = expected[expected.tick_num > 0]
+
+    assert bars.index.tolist() == expected.index.tolist()
+    for col in expected.columns:
+        np.testing.assert_allclose(bars[col].to_numpy(dtype='float64'), expected[col].to_numpy(dtype='float64'), err_msg=col)
+
+
+def test_volume_std_single_tick():
+    df = pd.DataFrame({
+        'UpdateTime': pd.to_datetime(['2019-03-04 09:00:01', '2019-03-04 09:01:01', '2019-03-04 09:01:02']),
+        'LastPrice': [1.0, 2.0, 3.0], 'LastVolume': [5.0, 1.0, 3.0], 'OpenInterest': [1, 2, 3], 'Turnover': [1.0, 2.0, 3.0],
+        'AvePrice': 1.0, 'HighestPrice': 1.0, 'LowestPrice': 1.0, 'OpenPrice': 1.0,
+    })
+    bars = _finish_bars(calc_base_bars(df))
+    assert np.isnan(bars['volume_std'].iloc[0])         # 只有一个tick，样本标准差不存在
+    assert bars['volume_std'].iloc[1] == pytest.approx(np.std([1.0, 3.0], ddof=1))
+    assert '_vol_sumsq' not in bars.columns and '_vol_cnt' not in bars.columns
@@ -0,0 +1,266 @@
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import models.dbs      # noqa: F401
+from models.apis import gen_kline
+
+kline_store_mod = sys.modules['models.dbs.kline_store']     # `models.dbs.kline_store`是全局实例
+KlineStore = kline_store_mod.KlineStore
+
+
+# `KlinePartitionDoc.objects(**q_f)`，只实现`KlineStore`用到的查询
+class FakePartitions():
+    def __init__(self):
+        self.docs = {}      # (category, level, year) -> dict
+
+    def __call__(self, **q_f):
+        return _FakeQuerySet(self, q_f)
+
+
+class _FakeQuerySet():
+    def __init__(self, partitions, q_f):
+        self.partitions = partitions
+        self.q_f = q_f
+
+    def _match(self, doc):
+        for key, value in self.q_f.items():
+            if key == 'instruments__in':
+                ok = bool(set(value) & set(doc['instruments']))
+            elif key == 'end__gte':
+                ok = doc['end'] >= value
+            elif key == 'start__lte':
+                ok = doc['start'] <= value
+            else:
+                ok = doc.get(key) == value
+            if not ok:
+                return False
+        return True
+
+    def _docs(self):
+        return sorted((doc for doc in self.partitions.docs.values() if self._match(doc)), key=lambda doc: doc['year'])
+
+    def distinct(self, field):
+        return list({doc[field] for doc in self._docs()})
+
+    def delete(self):
+        for doc in self._docs():
+            del self.partitions.docs[doc['category'], doc['level'], doc['year']]
+
+    def update_one(self, upsert, **kwargs):
+        key = self.q_f['category'], self.q_f['level'], self.q_f['year']
+        doc = self.partitions.docs.setdefault(key, dict(self.q_f))
+        doc.update({key[len('set__'):]: value for key, value in kwargs.items()})
+
+    def only(self, *fields):
+        return self
+
+    def order_by(self, *keys):
+        return [type('KlinePartitionDoc', (), doc) for doc in self._docs()]
+
+
+@pytest.fixture
+def partitions(monkeypatch):
+    partitions = FakePartitions()
+    monkeypatch.setattr(kline_store_mod, 'KlinePartitionDoc', type('KlinePartitionDoc', (), dict(objects=partitions)))
+    return partitions
+
+
+@pytest.fixture
+def store(tmp_path, partitions):
+    return KlineStore(tmp_path)
+
+
+def _klines(_id, start, n, level='1min', freq='1min', close=None):
+    return pd.DataFrame({
+        'TradingTime': pd.date_range(start, periods=n, freq=freq),
+        'InstrumentID': _id,
+        'category': _id[:2],
+        'level': level,
+        'close': np.arange(n, dtype='float64') if close is None else close,
+        'tick_num': np.arange(n, dtype='int64') + 1,
+    })
+
+
+def test_save_and_load(store, partitions):
+    a = _klines('AG1906', '2019-03-01 15:00', 5)
+    b = _klines('AG1912', '2019-03-01 15:00', 3)
+    assert store.save(pd.concat([b, a], ignore_index=True)) == 8
+    assert list(partitions.docs) == [('AG', '1min', '2019')]
+    doc = partitions.docs['AG', '1min', '2019']
+    assert (doc['rows'], doc['instruments'], doc['path']) == (8, ['AG1906', 'AG1912'], 'AG/1min/2019.parquet')
+    assert (store.root / doc['path']).exists()
+
+    df = store.load('AG', '1min')
+    pd.testing.assert_frame_equal(df, pd.concat([a, b], ignore_index=True).assign(isDominant=False))      # 按(InstrumentID, TradingTime)排序
+    pd.testing.assert_frame_equal(store.load('AG', '1min', ['AG1912']), b.assign(isDominant=False))
+    assert store.load('AG', '5min').empty
+
+
+def test_load_filters(store):
+    store.save(pd.concat([_klines('AG1906', '2018-12-31 23:58', 5), _klines('AG1912', '2019-01-01', 3)], ignore_index=True))
+    assert sorted(store.root.glob('AG/1min/*.parquet')) == [store.root / 'AG/1min/2018.parquet', store.root / 'AG/1min/2019.parquet']
+    df = store.load('AG', '1min', start='2019-01-01 00:01', end='2019-01-01 00:01')
+    assert df['InstrumentID'].tolist() == ['AG1906', 'AG1912']
+    df = store.load('AG', '1min', ['AG1906'], end='2018-12-31 23:59', columns=['TradingTime', 'close'])
+    assert list(df.columns) == ['TradingTime', 'close'] and df['close'].tolist() == [0.0, 1.0]
+
+
+# 再次写入一个合约时替换它所有的旧K线(包括其它年份的分区)，其它合约不变
+def test_save_replaces_instrument(store, partitions):
+    store.save(pd.concat([_klines('AG1906', '2018-12-31 23:58', 5), _klines('AG1912', '2019-01-01', 3)], ignore_index=True))
+    new = _klines('AG1906', '2019-01-02', 2, close=[10.0, 11.0])
+    assert store.save(new) == 2
+    df = store.load('AG', '1min')
+    assert df.groupby('InstrumentID').size().to_dict() == {'AG1906': 2, 'AG1912': 3}
+    assert df[df.InstrumentID == 'AG1906']['close'].tolist() == [10.0, 11.0]
+    # 2018年的分区只有AG1906，删掉
+    assert list(partitions.docs) == [('AG', '1min', '2019')]
+    assert not (store.root / 'AG/1min/2018.parquet').exists()
+
+
+def test_replace_partition(store, partitions):
+    store.save(_klines('AG1906', '2019-03-01 15:00', 5))
+    store.replace_partition('AG', '1min', '2019', _klines('AG1912', '2019-03-01 15:00', 2))
+    assert store.load('AG', '1min')['InstrumentID'].tolist() == ['AG1912', 'AG1912']
+    assert partitions.docs['AG', '1min', '2019']['instruments'] == ['AG1912']
+    store.replace_partition('AG', '1min', '2019', pd.DataFrame())
+    assert not partitions.docs
+    assert store.load('AG', '1min').empty
+
+
+# 增量写入只替换每个合约第一根新K线之后的部分
+def test_save_incremental(store):
+    store.save(pd.concat([_klines('AG1906', '2019-03-01 15:00', 5), _klines('AG1912', '2019-03-01 15:00', 3)], ignore_index=True))
+    new = _klines('AG1906', '2019-03-01 15:03', 4, close=[30.0, 40.0, 50.0, 60.0])
+    assert store.save(new, incremental=True) == 4
+    df = store.load('AG', '1min', ['AG1906'])
+    assert df['close'].tolist() == [0.0, 1.0, 2.0, 30.0, 40.0, 50.0, 60.0]
+    assert store.load('AG', '1min', ['AG1912']).shape[0] == 3
+
+
+def test_delete(store, partitions):
+    store.save(pd.concat([_klines('AG1906', '2018-12-31 23:58', 5), _klines('AG1912', '2019-01-01', 3)], ignore_index=True))
+    store.delete('AG', '1min', ['AG1906', 'AG2001'])
+    assert store.load('AG', '1min')['InstrumentID'].unique().tolist() == ['AG1912']
+    assert list(partitions.docs) == [('AG', '1min', '2019')]
+    store.delete('AG', '5min', ['AG1912'])
+    assert store.load('AG', '1min').shape[0] == 3
+
+
+def test_update_columns(store):
+    store.save(_klines('AG1906', '2019-03-01 15:00', 5, level='1d', freq='1D'))
+    flags = _klines('AG1906', '2019-03-02 15:00', 2, level='1d', freq='1D')[['InstrumentID', 'TradingTime']].assign(isDominant=True)
+    missing = pd.DataFrame(dict(InstrumentID=['AG1912'], TradingTime=[pd.Timestamp('2019-03-02 15:00')], isDominant=[True]))
+    assert store.update_columns('AG', '1d', pd.concat([flags, missing], ignore_index=True)) == 2
+    assert store.load('AG', '1d')['isDominant'].tolist() == [False, True, True, False, False]
+
+
+# 重新计算的K线没有`isDominant`，保留原来的值；新的K线用默认值
+@pytest.mark.parametrize('incremental', [False, True])
+def test_save_keeps_is_dominant(store, incremental):
+    store.save(_klines('AG1906', '2019-03-01 15:00', 3, level='1d', freq='1D'))
+    flags = _klines('AG1906', '2019-03-01 15:00', 3, level='1d', freq='1D')[['InstrumentID', 'TradingTime']].assign(isDominant=True)
+    store.update_columns('AG', '1d', flags)
+    new = _klines('AG1906', '2019-03-02 15:00', 3, level='1d', freq='1D', close=1.0) if incremental else \
+        _klines('AG1906', '2019-03-01 15:00', 4, level='1d', freq='1D', close=1.0)
+    store.save(new, incremental=incremental)
+    df = store.load('AG', '1d')
+    assert df['isDominant'].tolist() == [True, True, True, False]
+    assert df['isDominant'].dtype == bool
+
+
+# 记录`gen_kline`写入`kline_store`和`KlineProgressDoc`的调用
+class FakeStore():
+    enabled = True
+
+    def __init__(self):
+        self.calls = []
+
+    def save(self, kline_df, incremental=False):
+        self.calls.append(('save', kline_df['level'].iloc[0], sorted(kline_df['InstrumentID'].unique()), incremental))
+        return kline_df.shape[0]
+
+    def delete(self, category, level, instruments):
+        self.calls.append(('delete', level, sorted(instruments), category))
+
+
+@pytest.fixture
+def fake_store(monkeypatch):
+    store = FakeStore()
+    monkeypatch.setattr(gen_kline, 'kline_store', store)
+    monkeypatch.setattr(gen_kline, '_save_kline_progress', lambda _id, last_bars: store.calls.append(('progress', _id, sorted(last_bars))))
+    return store
+
+
+# 一批合约的同一粒度合并之后写入一次，进度在K线写入之后才保存
+def test_batch(fake_store):
+    with gen_kline._KlineStoreBatch() as batch:
+        for _id in ['AG1906', 'AG1912']:
+            batch.add(_id, {'1min': _klines(_id, '2019-03-01 15:00', 3), '1d': _klines(_id, '2019-03-01 15:00', 1, level='1d')})
+        assert fake_store.calls == []
+    assert fake_store.calls == [
+        ('save', '1min', ['AG1906', 'AG1912'], False),
+        ('save', '1d', ['AG1906', 'AG1912'], False),
+        ('progress', 'AG1906', ['1d', '1min']),
+        ('progress', 'AG1912', ['1d', '1min']),
+    ]
+
+
+# 全量计算时没有K线的合约删除以前的K线；增量计算时没有新K线不需要删除
+def test_batch_empty_klines(fake_store):
+    with gen_kline._KlineStoreBatch() as batch:
+        batch.add('AG1906', {'1min': _klines('AG1906', '2019-03-01 15:00', 3), '5min': _klines('AG1906', '2019-03-01 15:00', 0)})
+        batch.add('AG1912', {'1min': _klines('AG1912', '2019-03-01 15:00', 0), '5min': _klines('AG1912', '2019-03-01 15:00', 0)})
+        batch.add('CU1906', {'1min': _klines('CU1906', '2019-03-01 15:00', 0)})
+        batch.add('AG2001', {'1min': _klines('AG2001', '2019-03-01 15:00', 0)}, incremental=True)
+    assert fake_store.calls == [
+        ('save', '1min', ['AG1906'], False),
+        ('delete', '1min', ['AG1912'], 'AG'),
+        ('delete', '1min', ['CU1906'], 'CU'),
+        ('delete', '5min', ['AG1906', 'AG1912'], 'AG'),
+        ('progress', 'AG1906', ['1min']),
+        ('progress', 'AG1912', []),
+        ('progress', 'CU1906', []),
+        ('progress', 'AG2001', []),
+    ]
+
+
+def test_save_empty_klines_by_id(fake_store):
+    gen_kline.save_kline_by_id('AG1906', _klines('AG1906', '2019-03-01 15:00', 0), '5min')
+    gen_kline.save_1day_kline_by_id('AG1906', _klines('AG1906', '2019-03-01 15:00', 0, level='1d'))
+    assert fake_store.calls == [('delete', '5min', ['AG1906'], 'AG'), ('delete', '1d', ['AG1906'], 'AG')]
+
+
+# 出现异常时，已经计算完的合约先写入，再抛出原来的异常
+def test_batch_flush_on_error(fake_store):
+    with pytest.raises(ValueError):
+        with gen_kline._KlineStoreBatch() as batch:
+            batch.add('AG1906', {'1min': _klines('AG1906', '2019-03-01 15:00', 3)})
+            raise ValueError
+    assert [call[0] for call in fake_store.calls] == ['save', 'progress']
+
+
+def test_batch_flush_error_keeps_original_error(fake_store, monkeypatch):
+    def save(kline_df, incremental=False):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(fake_store, 'save', save)
+    with pytest.raises(ValueError):
+        with gen_kline._KlineStoreBatch() as batch:
+            batch.add('AG1906', {'1min': _klines('AG1906', '2019-03-01 15:00', 3)})
+            raise ValueError
+
+
+def test_batch_max_rows(fake_store):
+    batch = gen_kline._KlineStoreBatch(max_rows=5)
+    batch.add('AG1906', {'1min': _klines('AG1906', '2019-03-01 15:00', 3)})
+    assert fake_store.calls == []
+    batch.add('AG1912', {'1min': _klines('AG1912', '2019-03-01 15:00', 3)})
+    assert [call[0] for call in fake_store.calls] == ['save', 'progress', 'progress']
+    batch.flush()
+    assert len(fake_store.calls) == 3
+
+
+def test_disabled():
+    assert not KlineStore(None).enabled
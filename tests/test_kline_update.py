@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+from models.dbs.sessions import calc_trading_day_start
+from models.apis.gen_kline import KLINE_LEVELS, gen_klines_from_pd, _kline_trading_day
+
+LEVELS = [*KLINE_LEVELS, '1d']
+
+
+def _day_start(day):
+    return pd.Timestamp(calc_trading_day_start(np.datetime64(day)))
+
+
+def test_trading_day_start():
+    assert _day_start('2019-03-06') == pd.Timestamp('2019-03-05 18:20')       # 周三：周二的夜盘
+    assert _day_start('2019-03-04') == pd.Timestamp('2019-03-01 18:20')       # 周一：周五的夜盘
+    assert _day_start('2019-03-05') == pd.Timestamp('2019-03-02 18:20')       # 周二：周末的夜盘也归到周二
+
+
+def test_kline_trading_day():
+    assert _kline_trading_day(pd.Timestamp('2019-03-04'), '1d') == np.datetime64('2019-03-04')
+    # `TradingTime` = `UpdateTime` + 6h，周五21:00的夜盘K线属于周一
+    assert _kline_trading_day(pd.Timestamp('2019-03-02 03:00'), '1min') == np.datetime64('2019-03-04')
+    assert _kline_trading_day(pd.Timestamp('2019-03-02 07:30'), '1H') == np.datetime64('2019-03-04')
+    assert _kline_trading_day(pd.Timestamp('2019-03-04 15:00'), '5min') == np.datetime64('2019-03-04')
+
+
+# 一周的ticks：日盘、夜盘(跨0点)，周五夜盘到周六凌晨
+@pytest.fixture(scope='module')
+def ticks(make_ticks):
+    times = pd.date_range('2019-03-04 09:00', '2019-03-09 02:30', freq='2s')
+    tod = times.hour * 60 + times.minute
+    keep = ((tod >= 540) & (tod < 615)) | ((tod >= 630) & (tod < 690)) | ((tod >= 810) & (tod < 900)) | (tod >= 1260) | (tod < 150)
+    keep &= (times.dayofweek < 5) | ((times.dayofweek == 5) & (tod < 150))
+    keep &= ~((times.dayofweek == 0) & (tod < 150))
+    return make_ticks(times[keep], seed=1)
+
+
+# 按`update_kline_by_id()`的方式：先用截止时间之前的ticks计算，再从最后一根K线所在的交易日开始重新计算，
+# 用不早于最后一根K线的K线替换，结果和一次全量计算一致
+@pytest.mark.parametrize('cut', ['2019-03-06 22:07:31', '2019-03-07 00:30:01', '2019-03-08 14:59:00', '2019-03-09 01:00:00'])
+def test_incremental_rebuild_matches_full(ticks, cut):
+    full = gen_klines_from_pd('AG1906', ticks, LEVELS)
+    first = gen_klines_from_pd('AG1906', ticks[ticks.UpdateTime < pd.Timestamp(cut)], LEVELS)
+    progress = {level: kline_df['TradingTime'].max() for level, kline_df in first.items()}       # 每个粒度最后一根K线
+
+    day = min(_kline_trading_day(progress[level], level) for level in LEVELS)
+    start = pd.Timestamp(calc_trading_day_start(day))
+    assert start <= pd.Timestamp(cut)
+    new = gen_klines_from_pd('AG1906', ticks[ticks.UpdateTime >= start], LEVELS)
+
+    for level in LEVELS:
+        dirty = new[level][new[level].TradingTime >= progress[level]]
+        kept = first[level][first[level].TradingTime < progress[level]]
+        merged = pd.concat([kept, dirty], ignore_index=True)
+        pd.testing.assert_frame_equal(merged, full[level].reset_index(drop=True), check_dtype=False)
+
+
+# 截止时间落在K线中间时，第一次计算的最后一根K线不完整，增量计算时要重新计算它
+def test_partial_last_bar_is_recomputed(ticks):
+    cut = pd.Timestamp('2019-03-06 22:07:31')
+    full = gen_klines_from_pd('AG1906', ticks, ['5min'])['5min']
+    first = gen_klines_from_pd('AG1906', ticks[ticks.UpdateTime < cut], ['5min'])['5min']
+    last = first.iloc[-1]
+    assert last.TradingTime == pd.Timestamp('2019-03-06 22:05') + pd.Timedelta(hours=6)
+
+    complete = full[full.TradingTime == last.TradingTime].iloc[0]
+    assert last.tick_num < complete.tick_num
+
+    new = gen_klines_from_pd('AG1906', ticks[ticks.UpdateTime >= _day_start('2019-03-07')], ['5min'])['5min']
+    boundary = new[new.TradingTime == last.TradingTime].iloc[0]
+    assert boundary.tick_num == complete.tick_num
+    assert boundary.close == complete.close
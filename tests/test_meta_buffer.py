@@ -0,0 +1,90 @@
+import sys
+import pytest
+from pymongo.errors import BulkWriteError
+import models.dbs      # noqa: F401
+
+meta_buffer_mod = sys.modules['models.dbs.meta_buffer']     # `models.dbs.meta_buffer`是全局实例
+_merge_raw = meta_buffer_mod._merge_raw
+MetaUpdateBuffer = meta_buffer_mod.MetaUpdateBuffer
+
+
+def test_merge_set_and_inc():
+    dst = {'$set': {'a': 1}, '$inc': {'n': 1}}
+    assert _merge_raw(dst, {'$set': {'a': 2, 'b': 3}, '$inc': {'n': 2}})
+    assert dst == {'$set': {'a': 2, 'b': 3}, '$inc': {'n': 3}}
+
+
+def test_merge_set_unset_last_wins():
+    dst = {'$set': {'a': 1}}
+    assert _merge_raw(dst, {'$unset': {'a': ''}})
+    assert dst == {'$unset': {'a': ''}}
+    assert _merge_raw(dst, {'$set': {'a': 5}})
+    assert dst == {'$set': {'a': 5}}
+
+
+def test_merge_add_to_set_collects_each():
+    dst = {'$addToSet': {'tags': 'x'}}
+    assert _merge_raw(dst, {'$addToSet': {'tags': {'$each': ['y', 'z']}}})
+    assert dst == {'$addToSet': {'tags': {'$each': ['x', 'y', 'z']}}}
+
+
+def test_merge_conflict():
+    dst = {'$set': {'n': 1}}
+    assert not _merge_raw(dst, {'$inc': {'n': 1}})
+    assert not _merge_raw({'$set': {'a': 1}}, {'$pull': {'tags': 'x'}})
+    assert dst == {'$set': {'n': 1}}
+
+
+def test_setup_restored_after_with():
+    buffer = MetaUpdateBuffer(0, 5)
+    on_flush = lambda n: None       # noqa: E731
+    with buffer.setup(500, 1, on_flush=on_flush):
+        assert (buffer.flush_docs, buffer.flush_sec, buffer.on_flush) == (500, 1, on_flush)
+        with buffer.setup(10, 2):
+            assert buffer.flush_docs == 10
+        assert (buffer.flush_docs, buffer.on_flush) == (500, on_flush)
+    assert (buffer.flush_docs, buffer.flush_sec, buffer.on_flush) == (0, 5, None)
+    assert not buffer.enabled
+
+
+def test_setup_restored_on_error():
+    buffer = MetaUpdateBuffer(0, 5)
+    try:
+        with buffer.setup(500, 1):
+            raise ValueError
+    except ValueError:
+        pass
+    assert buffer.flush_docs == 0
+
+
+def test_with_buffer_keeps_settings():
+    buffer = MetaUpdateBuffer(0, 5)
+    with buffer.setup(500, 1):
+        with buffer:
+            pass
+        assert buffer.flush_docs == 500
+    assert buffer.flush_docs == 0
+
+
+# `bulk_write`部分失败时只保留失败的修改，成功的`$inc`不会重复执行
+def test_partial_bulk_write_failure(monkeypatch):
+    calls = []
+
+    class FakeCollection():
+        def bulk_write(self, ops, ordered=True):
+            calls.append([op._filter['_id'] for op in ops])
+            if len(calls) == 1:
+                raise BulkWriteError(dict(writeErrors=[dict(index=1, code=121, errmsg='Document failed validation')]))
+
+    monkeypatch.setattr(meta_buffer_mod, 'get_db', lambda alias: {'tick_files': FakeCollection()})
+    flushed = []
+    buffer = MetaUpdateBuffer(100, 1000, on_flush=flushed.append)
+    buffer.add_raw([(('ticks', 'tick_files', pk), {'$inc': {'n': 1}}) for pk in ['a', 'b', 'c']])
+    with pytest.raises(BulkWriteError):
+        buffer.flush()
+    assert [key[2] for key, _ in buffer.pop_pending()] == ['b']
+
+    buffer.add_raw([(('ticks', 'tick_files', 'b'), {'$inc': {'n': 1}})])
+    assert buffer.flush() == 1
+    assert calls == [['a', 'b', 'c'], ['b']]
+    assert flushed == [1] and len(buffer) == 0
@@ -0,0 +1,120 @@
+import io
+import pandas as pd
+import pytest
+from models.dbs.raw_csv import RAW_CSV_COLUMNS, RAW_CSV_COLUMNS_NO_MAIN, get_raw_columns, iter_raw_csv, read_raw_csv, wash_raw_df
+
+
+# 原始文件的一行：41个值，最后有一个逗号
+def raw_line(time='2019-03-01 09:00:00.500', price=3500.0, volume=2, InstrumentID='AG1906', mainID='', extra=''):
+    values = [InstrumentID, '4', price, volume, time[11:19].replace(':', ''), '0', time, price + 1, 5, price - 1, 7]
+    values += [0] * 16 + [123456, 35000000.0, price, 0, 0, 0, 0, 0, 0, price + 10, price - 10, 0, price - 5, mainID]
+    return ','.join(str(v) for v in values) + ',' + extra + '\n'
+
+
+def raw_file(lines):
+    return io.BytesIO(''.join(lines).encode())
+
+
+def test_raw_line_layout():
+    assert len(raw_line().split(',')) == len(RAW_CSV_COLUMNS)
+
+
+@pytest.mark.parametrize('MarketID, subID, has_level5, has_main, has_stat', [
+    (4, '1906', False, False, True),
+    (3, '1906', True, False, True),
+    (4, '9999', False, True, True),
+    (4, '0000', False, False, False),
+])
+def test_get_raw_columns(MarketID, subID, has_level5, has_main, has_stat):
+    cols = get_raw_columns(MarketID, subID)
+    assert cols == [col for col in RAW_CSV_COLUMNS if col in cols]       # 原始文件中的顺序
+    assert {'InstrumentID', 'UpdateTime', 'LastPrice', 'LastVolume', 'AskPrice1', 'BidVolume1'} <= set(cols)
+    assert ('AskPrice5' in cols) == has_level5
+    assert ('mainID' in cols) == has_main
+    assert ('Turnover' in cols) == has_stat
+    assert 'fill' not in cols and 'Reserved' not in cols
+    assert get_raw_columns(MarketID, subID, full=True) == RAW_CSV_COLUMNS
+
+
+def test_read_columns_and_dtypes():
+    lines = [raw_line(f'2019-03-01 09:00:0{i}.500', 3500.0 + i, i) for i in range(5)]
+    df = read_raw_csv(raw_file(lines), get_raw_columns(4, '1906'))
+    assert list(df.columns) == get_raw_columns(4, '1906')
+    assert df['LastPrice'].tolist() == [3500.0, 3501.0, 3502.0, 3503.0, 3504.0]
+    assert df['LastVolume'].dtype == 'int64'
+    assert df['hhmmss'].tolist() == ['090000', '090001', '090002', '090003', '090004']
+    assert df['UpdateTime'].iloc[1] == pd.Timestamp('2019-03-01 09:00:01.500')
+
+
+# 41列(没有`mainID`)的文件，`columns`中的`mainID`忽略
+def test_read_without_main_column():
+    lines = [','.join(raw_line().split(',')[:40]) + ',\n' for _ in range(2)]
+    assert len(lines[0].split(',')) == len(RAW_CSV_COLUMNS_NO_MAIN)
+    df = read_raw_csv(raw_file(lines), get_raw_columns(4, '9999'), names=RAW_CSV_COLUMNS_NO_MAIN)
+    assert list(df.columns) == [col for col in get_raw_columns(4, '9999') if col != 'mainID']
+    assert df['OpenPrice'].tolist() == [3495.0, 3495.0]
+    assert df['UpdateTime'].notna().all()
+
+
+def test_read_from_path(tmp_path):
+    file = tmp_path / '20190301.spt'
+    file.write_text(raw_line() + raw_line('2019-03-01 09:00:01.000'))
+    df = read_raw_csv(file, ['UpdateTime', 'LastPrice'])
+    assert df.shape == (2, 2)
+
+
+# 没有毫秒的时间也能解析，解析不了的为NaT
+def test_time_formats():
+    lines = [raw_line('2019-03-01 09:00:00.500'), raw_line('2019-03-01 09:00:01'), raw_line('bad time 0000000000')]
+    df = read_raw_csv(raw_file(lines), ['UpdateTime'])
+    assert df['UpdateTime'].iloc[:2].tolist() == [pd.Timestamp('2019-03-01 09:00:00.500'), pd.Timestamp('2019-03-01 09:00:01')]
+    assert pd.isna(df['UpdateTime'].iloc[2])
+
+
+# 类型不符时自动推断类型，不会失败
+def test_fallback_on_bad_dtype():
+    lines = [raw_line(), raw_line(volume='abc')]
+    df = read_raw_csv(raw_file(lines), ['UpdateTime', 'LastVolume'])
+    assert df['LastVolume'].tolist() == ['2', 'abc']
+
+
+# 列数不对的行不会导致整个文件失败：多出的列忽略，不完整的行没有时间，清洗时删掉
+@pytest.mark.parametrize('skip_bad_lines', [False, True])
+def test_bad_lines(skip_bad_lines):
+    lines = [raw_line(), raw_line('2019-03-01 09:00:01.000', extra='1,2'), 'AG1906,4,3500\n', raw_line('2019-03-01 09:00:02.000')]
+    df = read_raw_csv(raw_file(lines), ['UpdateTime', 'LastPrice', 'LastVolume'], skip_bad_lines=skip_bad_lines)
+    df = wash_raw_df(df)
+    assert df['UpdateTime'].dt.second.tolist() == [0, 1, 2]
+
+
+def test_wash_raw_df():
+    lines = [raw_line(), raw_line('2010-03-01 09:00:00.000'), raw_line(volume=-1), raw_line('bad time 0000000000')]
+    df = wash_raw_df(read_raw_csv(raw_file(lines), ['UpdateTime', 'LastVolume']))
+    assert df.index.tolist() == [0]
+
+
+# 分块加载的结果和整个文件加载一致，index是行在文件中的序号
+@pytest.mark.parametrize('chunk_rows', [1, 7, 1000])
+def test_iter_same_as_read(chunk_rows):
+    lines = [raw_line(f'2019-03-01 09:{i // 60:02d}:{i % 60:02d}.500', 3500.0 + i, i) for i in range(3000)]
+    columns = get_raw_columns(4, '1906')
+    chunks = list(iter_raw_csv(raw_file(lines), columns, chunk_rows))
+    assert sum(line_num for _, line_num in chunks) == 3000
+    df = pd.concat([df for df, _ in chunks])
+    assert df.index.tolist() == list(range(3000))
+    pd.testing.assert_frame_equal(df, read_raw_csv(raw_file(lines), columns))
+
+
+@pytest.mark.filterwarnings('error::pytest.PytestUnraisableExceptionWarning')
+def test_iter_bad_lines():
+    lines = [raw_line(), 'AG1906,4,3500\n', raw_line('2019-03-01 09:00:02.000')]
+    with pytest.raises(ValueError):
+        list(iter_raw_csv(raw_file(lines), ['UpdateTime', 'LastPrice'], 100))
+    df = pd.concat([df for df, _ in iter_raw_csv(raw_file(lines), ['UpdateTime', 'LastPrice'], 100, skip_bad_lines=True)])
+    assert df.shape[0] == 2
+
+
+# 分块加载只按固定类型解析
+def test_iter_bad_dtype():
+    with pytest.raises(Exception):
+        list(iter_raw_csv(raw_file([raw_line(), raw_line(volume='abc')]), ['UpdateTime', 'LastVolume'], 100))
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+from models.dbs.sessions import TIME_PERIODS, calc_session_bins, calc_time_type
+
+NIGHT, FAM, PM = (list(TIME_PERIODS).index(name) for name in ['night', 'fam', 'pm'])
+
+
+def _bins(times, level):
+    codes, bins = calc_session_bins(pd.to_datetime(times, format='mixed'), level)
+    return codes.tolist(), [None if pd.isna(b) else pd.Timestamp(b).strftime('%m-%d %H:%M') for b in bins]
+
+
+# 周五夜盘跨过0点，K线从21:00开始划分，不按0点切开
+def test_night_session_crosses_midnight():
+    times = ['2019-03-01 21:00', '2019-03-01 23:59:59', '2019-03-02 00:00:01', '2019-03-02 02:29:59']
+    codes, bins = _bins(times, '2H')
+    assert codes == [NIGHT] * 4
+    assert bins == ['03-01 21:00', '03-01 23:00', '03-01 23:00', '03-02 01:00']
+
+
+# 周五夜盘(包括0点之后的)属于下周一的交易日
+def test_friday_night_lands_on_monday():
+    times = ['2019-03-01 21:00', '2019-03-02 01:00', '2019-03-04 09:00', '2019-03-04 14:59:59']
+    _, bins = _bins(times, '1d')
+    assert bins == ['03-04 00:00'] * 4
+    _, bins = _bins(['2019-03-04 21:00', '2019-03-05 00:30', '2019-03-04 14:00'], '1d')
+    assert bins == ['03-05 00:00', '03-05 00:00', '03-04 00:00']
+
+
+# K线从时段的开盘时间开始划分，时段的最后一根K线不完整，收盘时的tick归到最后一根K线
+def test_bins_anchored_at_session_open():
+    times = ['2019-03-04 09:00', '2019-03-04 10:14:59', '2019-03-04 10:15:00', '2019-03-04 13:30', '2019-03-04 14:59:59', '2019-03-04 15:00']
+    codes, bins = _bins(times, '1H')
+    assert codes == [FAM, FAM, FAM, PM, PM, PM]
+    assert bins == ['03-04 09:00', '03-04 10:00', '03-04 10:00', '03-04 13:30', '03-04 14:30', '03-04 14:30']
+    _, bins = _bins(times, '15min')
+    assert bins == ['03-04 09:00', '03-04 10:00', '03-04 10:00', '03-04 13:30', '03-04 14:45', '03-04 14:45']
+
+
+def test_unknown_time():
+    codes, bins = _bins(['2019-03-04 04:00', '2019-03-04 09:00'], '5min')
+    assert codes == [-1, FAM]
+    assert bins == [None, '03-04 09:00']
+    assert calc_time_type(pd.Series(pd.to_datetime(['2019-03-04 04:00', '2019-03-04 21:30']))).tolist() == ['unknow', 'night']
+
+
+def test_bins_accept_index_and_array():
+    times = pd.DatetimeIndex(['2019-03-04 09:03', '2019-03-04 09:07'])
+    for values in [times, times.to_numpy(), pd.Series(times)]:
+        _, bins = calc_session_bins(values, '5min')
+        assert bins.astype('datetime64[m]').astype(str).tolist() == ['2019-03-04T09:00', '2019-03-04T09:05']
+        assert bins.dtype == np.dtype('datetime64[ns]')
@@ -0,0 +1,65 @@
+from models.apis import split
+from models.dbs.utils import delete_files
+
+
+class _FakeSplitDoc():
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    def replace_splits(self, file_splits):
+        if self.fail:
+            raise RuntimeError('mongo down')
+        self.calls.append(dict(file_splits))
+        return sum(len(splits) for splits in file_splits.values())
+
+
+class _FakeBuffer():
+    def __init__(self):
+        self.items = []
+
+    def add_raw(self, items):
+        self.items += items
+
+
+def _patch(monkeypatch, fail=False):
+    doc, buffer = _FakeSplitDoc(fail), _FakeBuffer()
+    monkeypatch.setattr(split, 'TickSplitPklFilesDoc', doc)
+    monkeypatch.setattr(split, 'meta_buffer', buffer)
+    return doc, buffer
+
+
+def test_flush_every_batch_files(monkeypatch):
+    doc, buffer = _patch(monkeypatch)
+    batch = split._SplitBatch(batch_files=2)
+    batch.add('a', [{'zip_path': 'a1'}], [('ka', {'$set': {'splited': True}})])
+    batch.add('b', None, [('kb', {'$addToSet': {'tags': 'x'}})])        # 跳过的文件只有元数据修改
+    assert doc.calls == []
+    batch.add('c', [{'zip_path': 'c1'}, {'zip_path': 'c2'}], [('kc', {'$set': {'splited': True}})])
+    assert doc.calls == [{'a': [{'zip_path': 'a1'}], 'c': [{'zip_path': 'c1'}, {'zip_path': 'c2'}]}]
+    assert [key for key, _ in buffer.items] == ['ka', 'kb', 'kc']
+    assert batch.split_cnt == 3
+
+    batch.flush()       # 没有缓存的切分
+    assert batch.split_cnt == 3 and batch.failed == []
+
+
+def test_failed_flush_keeps_files_unmarked(monkeypatch):
+    doc, buffer = _patch(monkeypatch, fail=True)
+    batch = split._SplitBatch(batch_files=10)
+    batch.add('a', [{'zip_path': 'a1'}], [('ka', {'$set': {'splited': True}})])
+    batch.flush()       # 不抛出异常
+    assert [pk for pk, _ in batch.failed] == ['a']
+    assert buffer.items == []       # 切分没有写入，不能标记`splited`
+    assert batch.split_cnt == 0
+
+
+def test_delete_files_removes_empty_dirs(tmp_path):
+    keep = tmp_path / 'x' / 'keep.pkl'
+    files = [tmp_path / 'x' / 'y' / 'a.pkl', tmp_path / 'x' / 'y' / 'b.pkl', keep]
+    for _file in files:
+        _file.parent.mkdir(parents=True, exist_ok=True)
+        _file.write_bytes(b'')
+    delete_files(files[:2] + [tmp_path / 'missing.pkl'])
+    assert not (tmp_path / 'x' / 'y').exists()
+    assert keep.exists()
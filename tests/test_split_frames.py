@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+from models.dbs.sessions import calc_split_code, calc_trading_day
+from models.dbs.tick_file_doc import TickFilesDoc
+
+
+def _ticks(*ranges):
+    times = pd.DatetimeIndex(np.concatenate([pd.date_range(start, end, freq='500ms').to_numpy() for start, end in ranges]))
+    n = len(times)
+    return pd.DataFrame({
+        'UpdateTime': times,
+        'LastPrice': np.arange(n, dtype='float64'),
+        'LastVolume': np.ones(n),
+        'OpenInterest': np.arange(n),
+    })
+
+
+def test_calc_split_code_boundaries():
+    times = pd.Series(pd.to_datetime([
+        '2019-03-01 09:00:00', '2019-03-01 10:15:00', '2019-03-01 10:20:00', '2019-03-01 15:00:30',
+        '2019-03-01 21:00:00', '2019-03-02 00:30:00', '2019-03-02 03:00:00', '2019-03-02 03:00:01',
+    ]))
+    assert calc_split_code(times).tolist() == [0, 0, -1, 2, 3, 3, 3, -1]
+
+
+def test_calc_trading_day_midnight():
+    times = pd.Series(pd.to_datetime(['2019-03-01 23:59:59', '2019-03-02 00:00:01', '2019-03-02 02:30:00', '2019-03-04 09:00:00']))
+    assert calc_trading_day(times).astype(str).tolist() == ['2019-03-01', '2019-03-01', '2019-03-01', '2019-03-04']
+
+
+def test_split_frames_groups_by_day_and_period():
+    df = _ticks(
+        ('2019-03-01 09:00', '2019-03-01 09:10'),       # fam
+        ('2019-03-01 10:30', '2019-03-01 10:30:30'),    # bam, 61 rows, dropped
+        ('2019-03-01 23:50', '2019-03-02 00:10'),       # night across midnight
+    )
+    splits = TickFilesDoc()._split_frames(df)
+    assert [(day, time_type) for day, time_type, _, _ in splits] == [('20190301', 'fam'), ('20190301', 'night')]
+
+    day, time_type, night_df, stats = splits[1]
+    assert night_df.shape[0] == stats['zip_line_num'] == 20 * 60 * 2 + 1
+    assert (night_df['time_type'] == 'night').all() and (night_df['UpdateTime_day'] == '20190301').all()
+    assert stats['start'] == pd.Timestamp('2019-03-01 23:50') and stats['end'] == pd.Timestamp('2019-03-02 00:10')
+    assert stats['open'] == night_df['LastPrice'].iloc[0] and stats['close'] == night_df['LastPrice'].iloc[-1]
+    assert stats['volume_sum'] == night_df.shape[0]
+
+
+def test_split_frames_unknown_time():
+    df = _ticks(('2019-03-01 09:00', '2019-03-01 09:10'), ('2019-03-01 12:00', '2019-03-01 12:01'))
+    assert TickFilesDoc()._split_frames(df) is None
@@ -0,0 +1,154 @@
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from models.dbs import conf, storage
+from models.dbs.storage import StorageEngine, StorageException, get_engine, get_storage_ver, sweep_tmp_files
+
+ZIP_VERS = [conf.STORAGE_VER_PICKLE_ZIP, conf.STORAGE_VER_PARQUET_ZSTD, conf.STORAGE_VER_PARQUET_SNAPPY, conf.STORAGE_VER_FEATHER]
+
+
+@pytest.fixture
+def df():
+    n = 100
+    return pd.DataFrame({
+        'InstrumentID': 'AG1906',
+        'UpdateTime': pd.date_range('2019-03-01 09:00', periods=n, freq='500ms'),
+        'LastPrice': np.linspace(3500, 3600, n),
+        'Volume': np.arange(n, dtype='int64'),
+    })
+
+
+# 每10行一个row group/record batch，按时间读取时会跳过一部分
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(storage, 'STORAGE_CHUNK_ROWS', 10)
+
+
+def _write(engine, df, tmp_path):
+    file = tmp_path / f'ticks{engine.suffix}'
+    engine.write(df, file)
+    return file
+
+
+@pytest.mark.parametrize('zip_ver', ZIP_VERS)
+def test_round_trip(tmp_path, df, zip_ver):
+    engine = get_engine(zip_ver)
+    assert engine.ver == zip_ver
+    file = _write(engine, df, tmp_path)
+    pd.testing.assert_frame_equal(engine.read(file), df)
+
+
+# 写入失败时不留下文件，也不留下临时文件
+@pytest.mark.parametrize('zip_ver', ZIP_VERS)
+def test_write_failure_leaves_nothing(tmp_path, df, zip_ver, monkeypatch):
+    engine = get_engine(zip_ver)
+
+    def _write(df, file, **kwargs):
+        file.write_bytes(b'partial')
+        raise OSError('disk full')
+
+    monkeypatch.setattr(engine, '_write', _write)
+    with pytest.raises(OSError):
+        engine.write(df, tmp_path / f'ticks{engine.suffix}')
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_sweep_tmp_files(tmp_path):
+    proc = subprocess.Popen([sys.executable, '-c', 'pass'])
+    proc.wait()
+    old = time.time() - conf.STALE_TMP_SEC - 10
+    file = tmp_path / 'ticks.feather'
+    dead_old = tmp_path / f'.ticks.pkl.{proc.pid}.1.tmp'
+    dead_new = tmp_path / f'.ticks.feather.{proc.pid}.2.tmp'
+    alive_old = tmp_path / f'.ticks.feather.{os.getpid()}.3.tmp'
+    other = tmp_path / '.ticks.feather.x.tmp'
+    for _file in (dead_old, dead_new, alive_old, other):
+        _file.write_bytes(b'partial')
+    for _file in (dead_old, alive_old, other):
+        os.utime(_file, (old, old))
+
+    assert sweep_tmp_files(file) == 1
+    assert not dead_old.exists()
+    assert dead_new.exists() and alive_old.exists() and other.exists()
+
+
+def test_unknown_zip_ver():
+    with pytest.raises(StorageException):
+        get_engine(99)
+
+
+def test_incomplete_engine():
+    class NoReadEngine(StorageEngine):
+        def _write(self, df, file):
+            pass
+
+    with pytest.raises(TypeError):
+        NoReadEngine()
+
+
+def test_storage_ver_by_category(monkeypatch):
+    monkeypatch.setitem(conf.CATEGORY_STORAGE_VER, 'AG', conf.STORAGE_VER_FEATHER)
+    assert get_storage_ver('AG') == conf.STORAGE_VER_FEATHER
+    assert get_storage_ver('CU') == conf.DEFAULT_STORAGE_VER
+    assert get_engine().ver == conf.DEFAULT_STORAGE_VER
+
+
+@pytest.mark.parametrize('zip_ver', ZIP_VERS)
+def test_read_columns(tmp_path, df, zip_ver):
+    engine = get_engine(zip_ver)
+    file = _write(engine, df, tmp_path)
+    res = engine.read(file, columns=['Volume', 'not_exists', 'LastPrice'])
+    pd.testing.assert_frame_equal(res, df[['Volume', 'LastPrice']])
+
+
+@pytest.mark.parametrize('zip_ver', ZIP_VERS)
+@pytest.mark.parametrize('start, end', [
+    ('2019-03-01 09:00:05', '2019-03-01 09:00:20'),
+    ('2019-03-01 09:00:40', None),
+    (None, '2019-03-01 09:00:01'),
+    ('2019-03-01 10:00', None),
+])
+def test_read_time_range(tmp_path, df, zip_ver, start, end):
+    engine = get_engine(zip_ver)
+    file = _write(engine, df, tmp_path)
+    mask = pd.Series(True, index=df.index)
+    if start is not None:
+        mask &= df['UpdateTime'] >= pd.Timestamp(start)
+    if end is not None:
+        mask &= df['UpdateTime'] <= pd.Timestamp(end)
+    res = engine.read(file, start=start, end=end)
+    pd.testing.assert_frame_equal(res, df[mask].reset_index(drop=True))
+
+
+# 没有按时间筛选时保留文件中的index，筛选之后index从0开始
+@pytest.mark.parametrize('zip_ver', ZIP_VERS)
+def test_read_index(tmp_path, df, zip_ver):
+    engine = get_engine(zip_ver)
+    df.index = df.index + 5
+    file = _write(engine, df, tmp_path)
+    pd.testing.assert_frame_equal(engine.read(file), df)
+    pd.testing.assert_frame_equal(engine.read(file, columns=['Volume']), df[['Volume']])
+    res = engine.read(file, start='2019-03-01 09:00:30')
+    assert res.index.equals(pd.RangeIndex(len(res)))
+
+
+# 只加载需要的列，筛选用的`UpdateTime`不在`columns`中时不返回
+@pytest.mark.parametrize('zip_ver', ZIP_VERS)
+def test_read_columns_and_time_range(tmp_path, df, zip_ver):
+    engine = get_engine(zip_ver)
+    file = _write(engine, df, tmp_path)
+    res = engine.read(file, columns=['LastPrice'], start='2019-03-01 09:00:10', end='2019-03-01 09:00:14.500')
+    assert list(res.columns) == ['LastPrice']
+    assert res['LastPrice'].tolist() == df['LastPrice'][20:30].tolist()
+
+
+def test_select_batches():
+    ns = pd.Timestamp('2019-03-01').value
+    time_index = [[ns, ns + 10], [ns + 11, ns + 20], [ns + 21, ns + 30]]
+    assert storage._select_batches(time_index, pd.Timestamp(ns + 15), None) == [1, 2]
+    assert storage._select_batches(time_index, None, pd.Timestamp(ns + 10)) == [0]
+    assert storage._select_batches(time_index, pd.Timestamp(ns + 31), None) == []
@@ -0,0 +1,103 @@
+import os
+import pandas as pd
+import pytest
+from models.dbs.tick_cache import TickFrameCache
+
+
+# 记录调用参数，返回固定的df
+class FakeEngine():
+    def __init__(self, rows=100):
+        self.rows = rows
+        self.reads = []
+
+    def read(self, file, columns=None, start=None, end=None):
+        self.reads.append((file.name, columns, start, end))
+        return pd.DataFrame({'LastPrice': [float(i) for i in range(self.rows)], 'Volume': range(self.rows)})
+
+
+@pytest.fixture
+def file(tmp_path):
+    file = tmp_path / 'ticks.pkl'
+    file.write_bytes(b'v1')
+    return file
+
+
+def test_disabled_always_reads(file):
+    cache, engine = TickFrameCache(0), FakeEngine()
+    cache.load(file, engine)
+    cache.load(file, engine)
+    assert len(engine.reads) == 2
+    assert cache.stats()['frames'] == 0
+
+
+def test_hit_for_same_arguments(file):
+    cache, engine = TickFrameCache(1024**2), FakeEngine()
+    df = cache.load(file, engine, columns=['LastPrice'], start='2019-03-01 09:00')
+    res = cache.load(file, engine, columns=['LastPrice'], start='2019-03-01 09:00')
+    assert len(engine.reads) == 1
+    pd.testing.assert_frame_equal(res, df)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+# 列、时间范围不同是不同的缓存
+@pytest.mark.parametrize('kwargs', [
+    dict(),
+    dict(columns=['Volume']),
+    dict(columns=['LastPrice', 'Volume']),
+    dict(start='2019-03-01 09:00'),
+    dict(end='2019-03-01 15:00'),
+])
+def test_key_includes_arguments(file, kwargs):
+    cache, engine = TickFrameCache(1024**2), FakeEngine()
+    cache.load(file, engine, columns=['LastPrice'])
+    cache.load(file, engine, **kwargs)
+    assert len(engine.reads) == 2
+
+
+# 文件被替换后(mtime/size变化)重新加载
+def test_key_includes_file_stat(file):
+    cache, engine = TickFrameCache(1024**2), FakeEngine()
+    cache.load(file, engine)
+    file.write_bytes(b'version 2')
+    st = file.stat()
+    os.utime(file, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    cache.load(file, engine)
+    assert len(engine.reads) == 2
+
+
+def test_returned_frame_is_not_shared(file):
+    cache, engine = TickFrameCache(1024**2), FakeEngine()
+    df = cache.load(file, engine)
+    df.loc[0, 'LastPrice'] = -1
+    assert cache.load(file, engine).loc[0, 'LastPrice'] == 0
+
+
+def test_evict_least_recently_used(tmp_path):
+    engine = FakeEngine()
+    files = []
+    for name in 'abc':
+        files.append(tmp_path / f'{name}.pkl')
+        files[-1].write_bytes(b'')
+    nbytes = int(engine.read(files[0]).memory_usage(deep=True).sum())
+    engine.reads.clear()
+
+    cache = TickFrameCache(nbytes * 2)
+    cache.load(files[0], engine)
+    cache.load(files[1], engine)
+    cache.load(files[0], engine)        # a比b新
+    cache.load(files[2], engine)        # 淘汰b
+    assert cache.stats()['frames'] == 2 and cache.evictions == 1
+    cache.load(files[0], engine)
+    cache.load(files[1], engine)
+    assert [read[0] for read in engine.reads] == ['a.pkl', 'b.pkl', 'c.pkl', 'b.pkl']
+
+
+def test_resize(file):
+    cache, engine = TickFrameCache(1024**2), FakeEngine()
+    cache.load(file, engine)
+    cache.resize(1)
+    assert cache.stats()['nbytes'] == 0 and not cache._frames
+    cache.load(file, engine)            # 比容量大的df不缓存
+    assert cache.stats()['frames'] == 0
+    cache.resize(0)
+    assert not cache.enabled
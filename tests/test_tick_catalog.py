@@ -0,0 +1,88 @@
+import datetime
+import pandas as pd
+import pytest
+from bson import ObjectId
+from models.dbs.tick_catalog import CatalogException, TickCatalog, _mask
+
+IDS = [str(ObjectId()) for _ in range(4)]
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({
+        '_id': IDS,
+        'InstrumentID': ['AG1906', 'AG1906', 'AG1912', 'CU1906'],
+        'MarketID': [4, 4, 4, 4],
+        'subID': ['1906', '1906', '1912', '9999'],
+        'start': pd.to_datetime(['2019-03-01 09:00', '2019-03-04 09:00', '2019-03-04 09:00', None]),
+        'high': [3600.0, 3650.0, None, 50000.0],
+        'zip_path': ['a.pkl', 'b.pkl', None, 'd.pkl'],
+        'isDominant': [True, True, False, True],
+        'tags': [['too_small'], [], None, ['x', 'y']],
+    })
+
+
+def _rows(df, key, value):
+    return df['_id'][_mask(df, key, value)].map(IDS.index).tolist()
+
+
+@pytest.mark.parametrize('key, value, rows', [
+    ('InstrumentID', 'AG1906', [0, 1]),
+    ('zip_path', None, [2]),
+    ('zip_path__ne', None, [0, 1, 3]),
+    ('high__ne', None, [0, 1, 3]),
+    ('subID__ne', '1906', [2, 3]),
+    ('subID__in', ['1906', '1912'], [0, 1, 2]),
+    ('subID__nin', ['0000', '9999'], [0, 1, 2]),
+    ('high__exists', True, [0, 1, 3]),
+    ('not_exists', None, [0, 1, 2, 3]),
+    ('not_exists__exists', True, []),
+    ('high__gt', 3600, [1, 3]),
+    ('high__lte', 3700, [0, 1]),
+    ('start__gte', datetime.datetime(2019, 3, 2), [1, 2]),
+    ('start__lt', '2019-03-02', [0]),
+    ('id', IDS[2], [2]),
+    ('pk__in', [ObjectId(IDS[0]), IDS[3]], [0, 3]),
+])
+def test_mask(df, key, value, rows):
+    assert _rows(df, key, value) == rows
+
+
+# 列表字段：相等是包含，`[]`是精确匹配
+@pytest.mark.parametrize('key, value, rows', [
+    ('tags', 'x', [3]),
+    ('tags', [], [1, 2]),
+    ('tags', ['x', 'y'], [3]),
+    ('tags__ne', 'x', [0, 1, 2]),
+    ('tags__in', ['too_small', 'y'], [0, 3]),
+    ('tags__nin', ['invalid_day', 'too_small'], [1, 2, 3]),
+])
+def test_list_mask(df, key, value, rows):
+    assert _rows(df, key, value) == rows
+
+
+def test_unsupported(df):
+    with pytest.raises(CatalogException):
+        _mask(df, 'high__mod', 2)
+
+
+# 保存到parquet后再查询，结果转为`TickFilesDoc`
+def test_query_saved(tmp_path, df):
+    catalog = TickCatalog(tmp_path / 'catalog.parquet')
+    refresh_time = datetime.datetime(2019, 3, 5, 8)
+    catalog._save(df, refresh_time)
+
+    catalog = TickCatalog(tmp_path / 'catalog.parquet')
+    assert catalog.load().shape[0] == 4
+    assert catalog.refresh_time == refresh_time
+    assert catalog.query(main_cls=None, InstrumentID='CU1906')['_id'].tolist() == [IDS[3]]
+    res = catalog.query(InstrumentID__in=['AG1906', 'AG1912', 'CU1906'])      # 加上主力的条件
+    assert res['_id'].tolist() == [IDS[1]]
+
+    docs = TickCatalog.to_docs(catalog.query(main_cls=None, subID='1906'))
+    assert [(doc.id, doc.InstrumentID, doc.tags) for doc in docs] == [(ObjectId(IDS[0]), 'AG1906', ['too_small']), (ObjectId(IDS[1]), 'AG1906', [])]
+
+
+def test_not_refreshed(tmp_path):
+    with pytest.raises(CatalogException):
+        TickCatalog(tmp_path / 'catalog.parquet').load()
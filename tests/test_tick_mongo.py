@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pymongo.errors import BulkWriteError
+from models.dbs.tick_mongo import KlineDoc, StatisDayDoc, _tick_ids, bulk_insert_ticks, bulk_write_klines, get_dyn_ticks_doc
+
+
+# 只实现用到的接口，`_id`重复时和Mongo一样报11000
+class FakeCollection():
+    def __init__(self):
+        self.docs = {}
+        self._next_id = 0
+
+    def insert_many(self, records, ordered=True):
+        errors = []
+        inserted = []
+        for i, record in enumerate(records):
+            if '_id' not in record:         # 和pymongo一样生成`_id`
+                self._next_id += 1
+                record['_id'] = self._next_id
+            if record['_id'] in self.docs:
+                errors.append(dict(index=i, code=11000, errmsg='E11000 duplicate key error'))
+            else:
+                self.docs[record['_id']] = dict(record)
+                inserted.append(record['_id'])
+        if errors:
+            raise BulkWriteError(dict(writeErrors=errors, nInserted=len(inserted)))
+        return type('InsertManyResult', (), dict(inserted_ids=inserted))
+
+    # `ReplaceOne`/`UpdateOne`(只支持$set/$setOnInsert)，upsert
+    def bulk_write(self, ops, ordered=True):
+        upserted = modified = 0
+        for op in ops:
+            doc = next((doc for doc in self.docs.values() if all(doc.get(k) == v for k, v in op._filter.items())), None)
+            update = op._doc
+            if doc is None:
+                self._next_id += 1
+                doc = self.docs[self._next_id] = {'_id': self._next_id, **op._filter}
+                doc.update(update.get('$setOnInsert', {}))
+                upserted += 1
+            else:
+                modified += 1
+            if '$set' in update:
+                doc.update(update['$set'])
+            else:
+                _id = doc['_id']
+                doc.clear()
+                doc.update({'_id': _id, **update})
+        return type('BulkWriteResult', (), dict(upserted_count=upserted, modified_count=modified))
+
+
+doc_cls = get_dyn_ticks_doc('AG')
+
+
+@pytest.fixture
+def collection(monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(doc_cls, '_get_collection', lambda: collection)
+    return collection
+
+
+@pytest.fixture(params=[KlineDoc, StatisDayDoc])
+def kline_doc(request, monkeypatch):
+    collection = FakeCollection()
+    monkeypatch.setattr(request.param, '_get_collection', lambda: collection)
+    return request.param
+
+
+def _ticks(n=10):
+    return pd.DataFrame({
+        'InstrumentID': 'AG1906',
+        'UpdateTime': pd.date_range('2019-03-01 09:00', periods=n, freq='500ms'),
+        'LastPrice': np.linspace(3500, 3510, n),
+        'LastVolume': np.arange(n, dtype='int64'),
+        'Reserved': '0',        # doc中没有的列
+    })
+
+
+def test_tick_ids_deterministic():
+    update_time = _ticks()['UpdateTime']
+    ids = _tick_ids(update_time, 'AG/AG1906/201903/20190301.spt')
+    assert ids == _tick_ids(update_time, 'AG/AG1906/201903/20190301.spt')
+    assert len(set(ids)) == len(ids)
+    assert not set(ids) & set(_tick_ids(update_time, 'AG/AG1906/201903/20190304.spt'))
+
+
+# 前4个字节是时间(秒)，按`_id`排序就是按时间排序
+def test_tick_ids_ordered_by_time():
+    update_time = _ticks()['UpdateTime']
+    ids = _tick_ids(update_time, 'x')
+    assert ids == sorted(ids)
+    assert [_id.generation_time.replace(tzinfo=None) for _id in ids] == update_time.dt.floor('s').dt.to_pydatetime().tolist()
+
+
+def test_bulk_insert(collection):
+    df = _ticks()
+    df.loc[3, 'UpdateTime'] = pd.NaT       # 时间解析失败的行不写入
+    assert bulk_insert_ticks(doc_cls, df, file_key='x', batch_size=4) == 9
+    doc = next(iter(collection.docs.values()))
+    assert set(doc) == {'_id', 'InstrumentID', 'UpdateTime', 'LastPrice', 'LastVolume', 'tags'}
+    assert doc['tags'] == []
+
+
+# 重复导入时跳过已经存在的行，中断后可以继续
+def test_bulk_insert_resume(collection):
+    df = _ticks()
+    assert bulk_insert_ticks(doc_cls, df.iloc[:6], file_key='x', batch_size=4) == 6
+    assert bulk_insert_ticks(doc_cls, df, file_key='x', batch_size=4) == 4
+    assert bulk_insert_ticks(doc_cls, df, file_key='x', batch_size=4) == 0
+    assert len(collection.docs) == 10
+    assert bulk_insert_ticks(doc_cls, df.iloc[:0], file_key='x') == 0
+
+
+def test_bulk_insert_other_errors(collection, monkeypatch):
+    def insert_many(records, ordered=True):
+        raise BulkWriteError(dict(writeErrors=[dict(index=0, code=121, errmsg='Document failed validation')], nInserted=0))
+
+    monkeypatch.setattr(collection, 'insert_many', insert_many)
+    with pytest.raises(BulkWriteError):
+        bulk_insert_ticks(doc_cls, _ticks(), file_key='x')
+
+
+def _klines(n=5, **extra):
+    return pd.DataFrame({
+        'TradingTime': pd.date_range('2019-03-01 15:00', periods=n, freq='1min'),
+        'InstrumentID': 'AG1906',
+        'level': '1min',
+        'category': 'AG',
+        'open': np.linspace(3500, 3504, n),
+        'close': np.linspace(3501, 3505, n),
+        'OpenInterest': np.arange(n, dtype='float64') + 1000,
+        'LastPrice': 3500.0,        # doc中没有的列
+        **extra,
+    })
+
+
+def test_bulk_write_klines_insert(kline_doc):
+    collection = kline_doc._get_collection()
+    assert bulk_write_klines(kline_doc, _klines(), batch_size=2) == 5
+    doc = collection.docs[next(iter(collection.docs))]
+    assert 'LastPrice' not in doc
+    assert ('level' in doc) == (kline_doc is KlineDoc)
+    assert doc['isDominant'] is False       # 和`to_mongo()`一样写入默认值
+    assert isinstance(doc['OpenInterest'], int)     # 和`IntField`一样保存为整数
+    assert bulk_write_klines(kline_doc, _klines().iloc[:0]) == 0
+
+
+# 重复执行不会产生重复的K线
+def test_bulk_write_klines_upsert(kline_doc):
+    collection = kline_doc._get_collection()
+    assert bulk_write_klines(kline_doc, _klines(3), upsert=True) == 3
+    assert bulk_write_klines(kline_doc, _klines(5, close=1.0), upsert=True, batch_size=2) == 5
+    assert len(collection.docs) == 5
+    assert sorted(doc['close'] for doc in collection.docs.values()) == [1.0] * 5
+
+
+# upsert只更新kline_df中的列，已有K线的`isDominant`保持不变，新K线写入默认值
+def test_bulk_write_klines_upsert_keeps_other_fields(kline_doc):
+    collection = kline_doc._get_collection()
+    bulk_write_klines(kline_doc, _klines(3), upsert=True)
+    for doc in collection.docs.values():
+        doc['isDominant'] = True
+    bulk_write_klines(kline_doc, _klines(5, close=1.0), upsert=True)
+    docs = sorted(collection.docs.values(), key=lambda doc: doc['TradingTime'])
+    assert [doc['isDominant'] for doc in docs] == [True, True, True, False, False]
+    assert [doc['close'] for doc in docs] == [1.0] * 5
+
+
+# upsert条件的索引不是唯一索引，已有的集合中可能有重复的K线，创建唯一索引会失败
+@pytest.mark.parametrize('doc, keys', [
+    (KlineDoc, ['InstrumentID', 'level', 'TradingTime']),
+    (StatisDayDoc, ['InstrumentID', 'TradingTime']),
+])
+def test_upsert_key_index(doc, keys):
+    specs = [spec for spec in doc._meta['index_specs'] if [field for field, _ in spec['fields']] == keys]
+    assert len(specs) == 1
+    assert not specs[0].get('unique')
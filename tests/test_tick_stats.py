@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+from models.dbs.tick_stats import TickStats
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(13)
+    n = 1000
+    return pd.DataFrame({
+        'UpdateTime': pd.date_range('2019-03-01 09:00', periods=n, freq='500ms'),
+        'LastPrice': 3500 + rng.normal(0, 5, n).round(),
+        'LastVolume': rng.integers(0, 20, n),
+        'OpenInterest': 100000 + np.arange(n),
+        'Turnover': np.arange(n) * 1000.0,
+    })
+
+
+def test_stats(df):
+    price = df['LastPrice']
+    assert TickStats().add(df).to_update() == dict(
+        set__open=price.iloc[0],
+        set__close=price.iloc[-1],
+        set__high=price.max(),
+        set__low=price.min(),
+        set__mean=pytest.approx(price.mean()),
+        set__OpenInterest=100999,
+        set__Turnover=999000.0,
+        set__Turnover_calc=pytest.approx((price * df['LastVolume']).sum() * 10),
+        set__volume_sum=int(df['LastVolume'].sum()),
+    )
+
+
+# 分块累加和整个文件一次计算的结果一致
+@pytest.mark.parametrize('chunk_rows', [1, 7, 333])
+def test_chunks(df, chunk_rows):
+    stats = TickStats()
+    for i in range(0, df.shape[0], chunk_rows):
+        stats.add(df.iloc[i:i+chunk_rows])
+    res, expected = stats.to_update(), TickStats().add(df).to_update()
+    assert res.keys() == expected.keys()
+    for key, value in expected.items():
+        assert res[key] == pytest.approx(value)
+    assert stats.rows == df.shape[0]
+
+
+# 写入Mongo的值都是python类型
+def test_python_types(df):
+    for value in TickStats().add(df).to_update().values():
+        assert type(value) in (int, float)
+
+
+def test_nan_price(df):
+    df.loc[[0, 5, 999], 'LastPrice'] = np.nan
+    price = df['LastPrice']
+    update = TickStats().add(df).to_update()
+    assert update['set__open'] == price.iloc[1]
+    assert update['set__close'] == price.iloc[998]
+    assert update['set__mean'] == pytest.approx(price.mean())
+    assert update['set__Turnover_calc'] == pytest.approx((price * df['LastVolume']).sum() * 10)
+
+
+# 没有`OpenInterest`/`Turnover`列(如指数)时不更新这些字段
+def test_missing_columns(df):
+    update = TickStats().add(df.drop(columns=['OpenInterest', 'Turnover'])).to_update()
+    assert 'set__OpenInterest' not in update and 'set__Turnover' not in update
+
+
+def test_empty(df):
+    assert TickStats().to_update() == {}
+    assert TickStats().add(df.iloc[:0]).to_update() == {}
+    all_nan = df.assign(LastPrice=np.nan)
+    assert set(TickStats().add(all_nan).to_update()) == {'set__OpenInterest', 'set__Turnover', 'set__Turnover_calc', 'set__volume_sum'}